@@ -0,0 +1,144 @@
+"""
+Allocation benchmark for the measurement models.
+
+Run from the repository root, for example:
+
+    python -m benchmarks.bench_models --count 100000
+    python -m benchmarks.bench_models --kenter-meters 50 --kenter-days 30
+
+Compares the slotted models in modules.models with the previous plain class layout, which kept a
+__dict__ per instance and stored a Kenter series as a list of measurement objects.
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+from typing import Callable, Tuple
+
+from modules.models import FusionSolarInverterMeasurement, FusionSolarMeterMeasurement, KenterTransformerMeasurements
+
+
+class LegacyMeasurement:
+    """
+    Plain class with a per-instance __dict__, as the measurement models were before they were slotted.
+    """
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+def measure_allocations(build: Callable[[], object]) -> Tuple[int, float]:
+    """
+    Returns the bytes still allocated by the built object graph and the build time in seconds.
+    """
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    built = build()
+    duration_s = time.perf_counter() - started
+    allocated_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del built
+    return allocated_bytes, duration_s
+
+
+def inverter_kwargs(idx: int) -> dict:
+    return dict(
+        settings=None,
+        measurement_type="inverter",
+        data_source="openapi_realkpi",
+        station_name="station",
+        station_dn="NE=1",
+        device_dn="NE=2",
+        device_name="inverter",
+        device_model="SUN2000",
+        device_id="1000",
+        real_time_power_w=idx * 1.5,
+        lifetime_energy_wh=idx * 2.5,
+        day_energy_wh=idx * 0.5,
+        timestamp=1700000000.0 + idx,
+    )
+
+
+def meter_kwargs(idx: int) -> dict:
+    return dict(
+        settings=None,
+        measurement_type="grid_meter",
+        data_source="openapi_realkpi",
+        station_name="station",
+        station_dn="NE=1",
+        device_dn="NE=3",
+        device_name="meter",
+        device_model="DTSU666",
+        device_id="2000",
+        active_power_w=idx * -1.5,
+        timestamp=1700000000.0 + idx,
+    )
+
+
+def build_legacy_kenter_series(meters: int, points: int) -> list:
+    return [
+        LegacyMeasurement(
+            descriptive_name=f"transformer{meter}",
+            connection_id="871600000000000000",
+            metering_point_id="6000000",
+            channel_id="16180",
+            measurements=[LegacyMeasurement(timestamp=1700000000 + idx * 900, interval_energy_wh=idx * 1.25, interval_power_avg_w=idx * 5.0) for idx in range(points)],
+        )
+        for meter in range(meters)
+    ]
+
+
+def build_kenter_series(meters: int, points: int) -> list:
+    series_list = []
+    for meter in range(meters):
+        series = KenterTransformerMeasurements(descriptive_name=f"transformer{meter}", connection_id="871600000000000000", metering_point_id="6000000", channel_id="16180")
+        for idx in range(points):
+            series.append(1700000000 + idx * 900, idx * 1.25, idx * 5.0)
+        series_list.append(series)
+    return series_list
+
+
+def print_comparison(name: str, count: int, legacy: Tuple[int, float], current: Tuple[int, float]) -> None:
+    legacy_bytes, legacy_s = legacy
+    current_bytes, current_s = current
+    print(
+        f"{name:>20} x{count:<9d} legacy {legacy_bytes / 1024 / 1024:8.2f}MiB ({legacy_bytes / count:6.1f}B/item, {legacy_s:6.3f}s)  "
+        f"slotted {current_bytes / 1024 / 1024:8.2f}MiB ({current_bytes / count:6.1f}B/item, {current_s:6.3f}s)  saving {100 * (1 - current_bytes / legacy_bytes):5.1f}%"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyFusionSolarDataRelay measurement model allocation benchmark")
+    parser.add_argument("--count", type=int, default=100000, help="Number of inverter and grid meter measurements to allocate")
+    parser.add_argument("--kenter-meters", type=int, default=20, help="Number of Kenter metering points in the backfill")
+    parser.add_argument("--kenter-days", type=int, default=30, help="Number of backfilled days per Kenter metering point, 96 intervals per day")
+    args = parser.parse_args()
+
+    count = args.count
+    print_comparison(
+        "inverter",
+        count,
+        measure_allocations(lambda: [LegacyMeasurement(**inverter_kwargs(idx)) for idx in range(count)]),
+        measure_allocations(lambda: [FusionSolarInverterMeasurement(**inverter_kwargs(idx)) for idx in range(count)]),
+    )
+    print_comparison(
+        "grid meter",
+        count,
+        measure_allocations(lambda: [LegacyMeasurement(**meter_kwargs(idx)) for idx in range(count)]),
+        measure_allocations(lambda: [FusionSolarMeterMeasurement(**meter_kwargs(idx)) for idx in range(count)]),
+    )
+
+    points = args.kenter_days * 96
+    print_comparison(
+        "kenter intervals",
+        args.kenter_meters * points,
+        measure_allocations(lambda: build_legacy_kenter_series(args.kenter_meters, points)),
+        measure_allocations(lambda: build_kenter_series(args.kenter_meters, points)),
+    )
+
+
+if __name__ == "__main__":
+    main()
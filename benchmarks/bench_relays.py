@@ -0,0 +1,207 @@
+"""
+End-to-end load benchmark for the relay classes, against local stand-ins for all upstream APIs and sinks.
+
+Run from the repository root, for example:
+
+    python -m benchmarks.bench_relays --devices 10,100,1000,10000 --cycles 3
+    python -m benchmarks.bench_relays --devices 1000 --relays open_api --sinks influxdb --influxdb-version 1
+
+For every device count a fresh fake fleet is started and the real RelayFusionSolarOpenApi,
+RelayFusionSolarKiosk and RelayKenter classes process it cycle after cycle. The first cycle of
+each relay is reported separately as "cold", it includes logins and metadata (station/device list) loading.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+from benchmarks.fake_servers import FakeServers
+from modules.conf_models import PyFusionSolarSettings, FusionSolarKioskSettings, FusionSolarOpenApiAccountSettings, KenterMeterSettings
+from modules.metrics import metrics
+from modules.relay_fusionsolar_kiosk import RelayFusionSolarKiosk
+from modules.relay_fusionsolar_open_api import RelayFusionSolarOpenApi
+from modules.relay_kenter import RelayKenter
+
+RELAYS = {
+    "open_api": (RelayFusionSolarOpenApi, "process_fusionsolar_open_apis"),
+    "kiosk": (RelayFusionSolarKiosk, "process_fusionsolar_kiosks"),
+    "kenter": (RelayKenter, "process_kenter_meters"),
+}
+
+
+def make_conf(servers: FakeServers, device_count: int, relays: List[str], sinks: List[str], influxdb_version: int, account_count: int = 1, influxdb_client: str = "native", influxdb_target: str = "influxdb") -> PyFusionSolarSettings:
+    kiosks = [FusionSolarKioskSettings(descriptive_name=f"kiosk{idx:05d}", api_url=f"{servers.base_url}/rest/pvms/web/kiosk/v1/station-kiosk-file?kk=", api_kkid=f"kk{idx:05d}") for idx in range(device_count)] if "kiosk" in relays else []
+    kenter_meters = (
+        [KenterMeterSettings(descriptive_name=f"transformer{idx:05d}", connection_id=f"8716000000{idx:08d}", metering_point_id=f"{6000000 + idx}", channel_id="16180") for idx in range(device_count)]
+        if "kenter" in relays
+        else []
+    )
+    # A single account is configured the legacy way, with fusionsolar_open_api_user_name
+    accounts = [FusionSolarOpenApiAccountSettings(descriptive_name=f"bench{idx}", user_name=f"bench{idx}", system_code="bench") for idx in range(account_count)] if account_count > 1 else []
+
+    return PyFusionSolarSettings(
+        site_descriptive_name="bench",
+        fusionsolar_kiosk_module_enabled="kiosk" in relays,
+        fusionsolar_kiosks=kiosks,
+        fusionsolar_open_api_module_enabled="open_api" in relays,
+        fusionsolar_open_api_url=servers.base_url,
+        fusionsolar_open_api_user_name="bench",
+        fusionsolar_open_api_system_code="bench",
+        fusionsolar_open_api_accounts=accounts,
+        # Requests are sent back to back, to measure throughput
+        fusionsolar_open_api_request_spread_fraction=0,
+        fusionsolar_open_api_min_request_interval_seconds=0,
+        kenter_module_enabled="kenter" in relays,
+        kenter_api_url=servers.base_url,
+        kenter_token_url=f"{servers.base_url}/connect/token",
+        kenter_metering_points=kenter_meters,
+        kenter_request_interval_seconds=0,
+        influxdb_module_enabled="influxdb" in sinks,
+        influxdb_is_v2=influxdb_version == 2,
+        influxdb_client=influxdb_client,
+        influxdb_target=influxdb_target,
+        influxdb_host="127.0.0.1",
+        influxdb_port=servers.http_port,
+        influxdb_v2_protocol="http",
+        influxdb_v2_org="acme",
+        mqtt_module_enabled="mqtt" in sinks,
+        mqtt_host="127.0.0.1",
+        mqtt_port=servers.mqtt_port,
+    )
+
+
+def reset_rate_limits(relay) -> None:
+    # The OpenAPI fetchers allow one request per device type per minute, benchmarks run cycles back to back
+    for fs_open_api in getattr(relay, "fs_open_apis", []):
+        fs_open_api.last_request_times.clear()
+
+
+def measurement_count() -> float:
+    return sum(counter["value"] for counter in metrics.snapshot()["counters"] if counter["name"] == "measurements_total")
+
+
+def run_cycle(relay, process_method_name: str, servers: FakeServers, trace_memory: bool) -> Dict[str, float]:
+    reset_rate_limits(relay)
+    gc.collect()
+    stats_before = servers.wait_until_idle()
+    measurements_before = measurement_count()
+    if trace_memory:
+        tracemalloc.start()
+
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    getattr(relay, process_method_name)()
+    cpu_seconds = time.process_time() - cpu_started
+    wall_seconds = time.perf_counter() - wall_started
+
+    result = {}
+    if trace_memory:
+        result["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+
+    stats_after = servers.wait_until_idle()
+    measurements = measurement_count() - measurements_before
+    result.update(
+        {
+            "wall_s": wall_seconds,
+            "cpu_s": cpu_seconds,
+            "measurements": measurements,
+            "measurements_per_s": measurements / wall_seconds if wall_seconds else 0,
+            "upstream_requests": stats_after["http_requests"] - stats_before["http_requests"] - (stats_after["influxdb_writes"] - stats_before["influxdb_writes"]),
+            "influxdb_lines": stats_after["influxdb_lines"] - stats_before["influxdb_lines"],
+            "mqtt_publishes": stats_after["mqtt_publishes"] - stats_before["mqtt_publishes"],
+            "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+    )
+    return result
+
+
+def run_benchmark(args, logger: logging.Logger) -> List[Dict]:
+    results = []
+    relays = args.relays.split(",")
+    sinks = [sink for sink in args.sinks.split(",") if sink]
+
+    for device_count in (int(count) for count in args.devices.split(",")):
+        with FakeServers(device_count, token_ttl_requests=args.token_ttl_requests, rate_limit_every=args.rate_limit_every, account_count=args.accounts, api_latency_s=args.api_latency_ms / 1000) as servers, tempfile.TemporaryDirectory() as work_dir:
+            # The OpenAPI fetcher writes its metadata cache relative to the working directory
+            os.makedirs(os.path.join(work_dir, "cache"))
+            previous_cwd = os.getcwd()
+            os.chdir(work_dir)
+            try:
+                conf = make_conf(servers, device_count, relays, sinks, args.influxdb_version, args.accounts, args.influxdb_client, args.influxdb_target)
+                for relay_name in relays:
+                    relay_class, process_method_name = RELAYS[relay_name]
+                    relay = relay_class(conf, logger)
+                    cycles = [run_cycle(relay, process_method_name, servers, args.tracemalloc) for _ in range(args.cycles)]
+                    results.append({"relay": relay_name, "devices": device_count, "cold": cycles[0], "warm": cycles[1:]})
+                    print_result(results[-1])
+            finally:
+                os.chdir(previous_cwd)
+
+    return results
+
+
+def print_result(result: Dict) -> None:
+    def fmt(cycle: Dict) -> str:
+        line = (
+            f"wall {cycle['wall_s']:8.3f}s  cpu {cycle['cpu_s']:8.3f}s  {cycle['measurements_per_s']:10.1f} meas/s  "
+            f"upstream req {cycle['upstream_requests']:6d}  influx lines {cycle['influxdb_lines']:7d}  mqtt msgs {cycle['mqtt_publishes']:6d}  rss peak {cycle['rss_peak_mb']:7.1f}MB"
+        )
+        if "tracemalloc_peak_mb" in cycle:
+            line += f"  alloc peak {cycle['tracemalloc_peak_mb']:7.1f}MB"
+        return line
+
+    print(f"{result['relay']:>8} {result['devices']:>6} devices  cold: {fmt(result['cold'])}")
+    if result["warm"]:
+        wall = [cycle["wall_s"] for cycle in result["warm"]]
+        cpu = [cycle["cpu_s"] for cycle in result["warm"]]
+        throughput = [cycle["measurements_per_s"] for cycle in result["warm"]]
+        print(
+            f"{'':>8} {'':>6}          warm: wall mean {statistics.mean(wall):8.3f}s  max {max(wall):8.3f}s  cpu mean {statistics.mean(cpu):8.3f}s  "
+            f"{statistics.mean(throughput):10.1f} meas/s over {len(wall)} cycles"
+        )
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyFusionSolarDataRelay end-to-end load benchmark")
+    parser.add_argument("--devices", default="10,100,1000,10000", help="Comma separated device counts to benchmark")
+    parser.add_argument("--cycles", type=int, default=3, help="Cycles per relay and device count, the first one is reported as cold")
+    parser.add_argument("--relays", default="open_api,kiosk,kenter", help="Comma separated relays: open_api, kiosk, kenter")
+    parser.add_argument("--sinks", default="influxdb,mqtt", help="Comma separated sinks: influxdb, mqtt (empty for none)")
+    parser.add_argument("--influxdb-version", type=int, choices=[1, 2], default=2)
+    parser.add_argument("--influxdb-target", choices=["influxdb", "victoriametrics"], default="influxdb", help="victoriametrics sends Kenter bulk imports to /api/v1/import, its points are counted as influx lines")
+    parser.add_argument("--influxdb-client", choices=["native", "library"], default="native", help="InfluxDB writer, library requires the influxdb and influxdb-client packages")
+    parser.add_argument("--token-ttl-requests", type=int, default=0, help="Expire the OpenAPI token after N requests (failCode 305), 0 to disable")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth getDevRealKpi request with failCode 407, 0 to disable")
+    parser.add_argument("--accounts", type=int, default=1, help="Spread the OpenAPI stations over N accounts, polled concurrently")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="Simulated round trip time of each OpenAPI request")
+    parser.add_argument("--tracemalloc", action="store_true", help="Trace Python allocations per cycle (slows down the relay)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json-out", help="Write all results to this JSON file")
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    logger.setLevel(args.log_level.upper())
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(stream_handler)
+
+    results = run_benchmark(args, logger)
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
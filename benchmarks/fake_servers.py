@@ -0,0 +1,362 @@
+"""
+Local stand-ins for the upstream APIs and sinks used by PyFusionSolarDataRelay, for load benchmarks.
+
+A single HTTP server covers the FusionSolar OpenAPI, the FusionSolar kiosk backend, the Kenter token and
+measurement endpoints and the InfluxDB v1/v2 write endpoints. A minimal MQTT 3.1.1 broker accepts
+QoS 0 publishes. All servers run in a separate process, so they do not skew the relay CPU and memory figures.
+"""
+
+import gzip
+import html
+import json
+import multiprocessing
+import re
+import socketserver
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+KENTER_MEASUREMENTS_PATH_RE = re.compile(r"^/meetdata/v2/measurements/connections/([^/]+)/metering-points/([^/]+)/days/(\d+)/(\d+)/(\d+)$")
+
+
+class FakeFleet:
+    """
+    Deterministic fleet of stations, devices, kiosks and Kenter metering points for a given device count.
+    Stations are spread round robin over account_count OpenAPI accounts, user name bench0, bench1, etc.
+    """
+
+    def __init__(self, device_count: int, token_ttl_requests: int = 0, rate_limit_every: int = 0, account_count: int = 1, api_latency_s: float = 0):
+        self.device_count = device_count
+        self.station_count = max(1, device_count // 20)
+        self.meter_count = max(1, device_count // 10)
+        self.token_ttl_requests = token_ttl_requests
+        self.rate_limit_every = rate_limit_every
+        self.account_count = max(1, account_count)
+        self.api_latency_s = api_latency_s
+
+        self.stations = [{"stationCode": f"NE={33000000 + idx}", "stationName": f"station{idx:05d}", "capacity": 1.5, "stationAddr": "", "stationLinkman": ""} for idx in range(self.station_count)]
+        self.devices = []
+        for idx in range(device_count):
+            self.devices.append({"id": 1000000000 + idx, "devDn": f"NE={34000000 + idx}", "devName": f"inverter{idx:05d}", "stationCode": self.stations[idx % self.station_count]["stationCode"], "devTypeId": 1, "model": "SUN2000-100KTL"})
+        for idx in range(self.meter_count):
+            self.devices.append({"id": 2000000000 + idx, "devDn": f"NE={35000000 + idx}", "devName": f"meter{idx:05d}", "stationCode": self.stations[idx % self.station_count]["stationCode"], "devTypeId": 17, "model": "DTSU666-H"})
+
+        self.kiosk_kkids = [f"kk{idx:05d}" for idx in range(device_count)]
+        self.kenter_connections = [(f"8716000000{idx:08d}", f"{6000000 + idx}") for idx in range(device_count)]
+
+        # Static responses are encoded once, the servers are not what we want to measure
+        self.station_list_bodies = []
+        self.device_list_bodies = []
+        for account_idx in range(self.account_count):
+            account_stations = self.stations[account_idx :: self.account_count]
+            account_station_codes = {station["stationCode"] for station in account_stations}
+            account_devices = [device for device in self.devices if device["stationCode"] in account_station_codes]
+            self.station_list_bodies.append(json.dumps({"success": True, "failCode": 0, "data": account_stations}).encode("utf-8"))
+            self.device_list_bodies.append(json.dumps({"success": True, "failCode": 0, "data": account_devices}).encode("utf-8"))
+        self.kenter_meters_body = json.dumps([{"connectionId": conn, "meteringPoints": [{"meteringPointId": mp, "productType": "Electricity", "meteringPointType": "OP", "meterNumber": mp}]} for conn, mp in self.kenter_connections]).encode("utf-8")
+
+        self.lock = threading.Lock()
+        self.token_serial = 0
+        # Current token per account, and the number of requests made with it
+        self.tokens = {}
+        self.token_requests = {}
+        self.realkpi_requests = 0
+        self.stats = {"http_requests": 0, "fail_code_305": 0, "fail_code_407": 0, "influxdb_writes": 0, "influxdb_lines": 0, "influxdb_bytes": 0, "mqtt_publishes": 0, "mqtt_connections": 0, "history_requests": 0, "history_points": 0}
+
+    def count(self, stat: str, amount: int = 1) -> None:
+        with self.lock:
+            self.stats[stat] += amount
+
+    def account_index(self, user_name: str) -> int:
+        digits = re.sub(r"\D", "", user_name or "")
+        return int(digits) % self.account_count if digits else 0
+
+    def login(self, user_name: str) -> str:
+        account_idx = self.account_index(user_name)
+        with self.lock:
+            self.token_serial += 1
+            token = f"token{self.token_serial}"
+            self.tokens[account_idx] = token
+            self.token_requests[account_idx] = 0
+            return token
+
+    def check_token(self, token: str):
+        """
+        Returns the account index for a valid token, or None if the token is invalid or expired.
+        """
+        with self.lock:
+            account_idx = next((idx for idx, account_token in self.tokens.items() if account_token == token), None)
+            if not token or account_idx is None:
+                self.stats["fail_code_305"] += 1
+                return None
+            self.token_requests[account_idx] += 1
+            if self.token_ttl_requests and self.token_requests[account_idx] > self.token_ttl_requests:
+                # Expire the token, the next request has to log in again
+                del self.tokens[account_idx]
+                self.stats["fail_code_305"] += 1
+                return None
+            return account_idx
+
+    def check_realkpi_rate_limit(self) -> bool:
+        with self.lock:
+            self.realkpi_requests += 1
+            if self.rate_limit_every and self.realkpi_requests % self.rate_limit_every == 0:
+                self.stats["fail_code_407"] += 1
+                return False
+            return True
+
+    def realkpi_body(self, dev_type_id: int, dev_ids: str) -> bytes:
+        minute_of_day = datetime.now().hour * 60 + datetime.now().minute
+        data = []
+        for dev_id in (int(dev_id) for dev_id in dev_ids.split(",") if dev_id):
+            if dev_type_id == 1:
+                data_item_map = {"active_power": round(50 + (dev_id + minute_of_day) % 50, 3), "total_cap": 150000.0 + dev_id % 1000, "day_cap": 120.5, "run_state": 1}
+            else:
+                data_item_map = {"active_power": -1000.0 - dev_id % 500, "run_state": 1}
+            data.append({"devId": dev_id, "dataItemMap": data_item_map})
+        return json.dumps({"success": True, "failCode": 0, "data": data}).encode("utf-8")
+
+    def history_body(self, dev_type_id: int, dev_ids: str, start_time_ms: int, end_time_ms: int) -> bytes:
+        # 5 minute points, like /thirdData/getDevHistoryKpi
+        data = []
+        for dev_id in (int(dev_id) for dev_id in dev_ids.split(",") if dev_id):
+            for collect_time_ms in range(start_time_ms - start_time_ms % 300000 + 300000, end_time_ms + 1, 300000):
+                if dev_type_id == 1:
+                    data_item_map = {"active_power": round(50 + (dev_id + collect_time_ms // 60000) % 50, 3), "total_cap": 150000.0 + dev_id % 1000, "day_cap": 120.5}
+                else:
+                    data_item_map = {"active_power": -1000.0 - dev_id % 500}
+                data.append({"devId": dev_id, "collectTime": collect_time_ms, "dataItemMap": data_item_map})
+        self.count("history_requests")
+        self.count("history_points", len(data))
+        return json.dumps({"success": True, "failCode": 0, "data": data}).encode("utf-8")
+
+    def kiosk_body(self, kkid: str) -> bytes:
+        kiosk_data = {
+            "realKpi": {"realTimePower": 42.5, "cumulativeEnergy": 150000.0 + len(kkid), "dailyEnergy": 120.5},
+            "stationOverview": {"stationName": f"kiosk station {kkid}", "stationDn": f"NE={kkid}"},
+        }
+        return json.dumps({"success": True, "data": html.escape(json.dumps(kiosk_data))}).encode("utf-8")
+
+    def kenter_measurements_body(self, year: int, month: int, day: int) -> bytes:
+        day_start = datetime(year, month, day).timestamp()
+        measurements = [{"timestamp": int(day_start + (idx + 1) * 900), "value": 1.25 + (idx % 7) * 0.1, "origin": "Measured", "status": "Valid"} for idx in range(96)]
+        return json.dumps([{"channelId": "16180", "Measurements": measurements}]).encode("utf-8")
+
+
+def make_http_handler(fleet: FakeFleet):
+    class FakeHttpHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def read_body(self) -> bytes:
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def respond(self, status: int, body: bytes = b"", content_type: str = "application/json", headers: dict = None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def respond_fail_code(self, fail_code: int):
+            self.respond(200, json.dumps({"success": False, "failCode": fail_code, "message": "fake failure", "data": None}).encode("utf-8"))
+
+        def do_GET(self):
+            parsed_url = urlparse(self.path)
+            path = parsed_url.path
+            if path == "/_bench/stats":
+                # Not counted, so polling the stats does not change them
+                with fleet.lock:
+                    stats_body = json.dumps(fleet.stats).encode("utf-8")
+                self.respond(200, stats_body)
+                return
+
+            fleet.count("http_requests")
+            if path == "/rest/pvms/web/kiosk/v1/station-kiosk-file":
+                kkid = parse_qs(parsed_url.query).get("kk", [""])[0]
+                self.respond(200, fleet.kiosk_body(kkid))
+            elif path == "/meetdata/v2/meters":
+                self.respond(200, fleet.kenter_meters_body)
+            elif KENTER_MEASUREMENTS_PATH_RE.match(path):
+                year, month, day = (int(part) for part in KENTER_MEASUREMENTS_PATH_RE.match(path).groups()[2:])
+                self.respond(200, fleet.kenter_measurements_body(year, month, day))
+            elif path in ("/ping", "/health"):
+                self.respond(204)
+            elif path == "/api/v2/buckets":
+                name = parse_qs(parsed_url.query).get("name", ["fusionsolar"])[0]
+                self.respond(200, json.dumps({"buckets": [{"id": "b0", "name": name, "orgID": "o0", "retentionRules": []}]}).encode("utf-8"))
+            elif path == "/api/v2/orgs":
+                self.respond(200, json.dumps({"orgs": [{"id": "o0", "name": "acme"}]}).encode("utf-8"))
+            else:
+                self.respond(404, b"{}")
+
+        def do_POST(self):
+            fleet.count("http_requests")
+            parsed_url = urlparse(self.path)
+            path = parsed_url.path
+            body = self.read_body()
+
+            if path.startswith("/thirdData/") and fleet.api_latency_s:
+                # Simulated upstream round trip time, requests are served concurrently
+                time.sleep(fleet.api_latency_s)
+
+            if path == "/thirdData/login":
+                token = fleet.login(json.loads(body or b"{}").get("userName", ""))
+                self.respond(200, b'{"success": true, "failCode": 0, "data": null}', headers={"Set-Cookie": f"XSRF-TOKEN={token}; Path=/"})
+            elif path in ("/thirdData/getStationList", "/thirdData/getDevList", "/thirdData/getDevRealKpi", "/thirdData/getDevHistoryKpi"):
+                account_idx = fleet.check_token(self.headers.get("XSRF-TOKEN", ""))
+                if account_idx is None:
+                    self.respond_fail_code(305)
+                elif path == "/thirdData/getStationList":
+                    self.respond(200, fleet.station_list_bodies[account_idx])
+                elif path == "/thirdData/getDevList":
+                    self.respond(200, fleet.device_list_bodies[account_idx])
+                elif path == "/thirdData/getDevHistoryKpi":
+                    request_json = json.loads(body or b"{}")
+                    self.respond(200, fleet.history_body(int(request_json.get("devTypeId", 1)), str(request_json.get("devIds", "")), int(request_json["startTime"]), int(request_json["endTime"])))
+                elif not fleet.check_realkpi_rate_limit():
+                    self.respond_fail_code(407)
+                else:
+                    request_json = json.loads(body or b"{}")
+                    self.respond(200, fleet.realkpi_body(int(request_json.get("devTypeId", 1)), str(request_json.get("devIds", ""))))
+            elif path == "/connect/token":
+                self.respond(200, b'{"access_token": "kenter-token", "expires_in": 3600, "token_type": "Bearer"}')
+            elif path in ("/write", "/api/v2/write"):
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                fleet.count("influxdb_writes")
+                fleet.count("influxdb_lines", body.count(b"\n") + (1 if body and not body.endswith(b"\n") else 0))
+                fleet.count("influxdb_bytes", len(body))
+                self.respond(204)
+            elif path == "/api/v1/import":
+                # VictoriaMetrics JSON lines import, one line per series with its values and timestamps
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                fleet.count("influxdb_writes")
+                fleet.count("influxdb_lines", sum(len(json.loads(line)["timestamps"]) for line in body.splitlines() if line))
+                fleet.count("influxdb_bytes", len(body))
+                self.respond(204)
+            else:
+                self.respond(404, b"{}")
+
+    return FakeHttpHandler
+
+
+def make_mqtt_handler(fleet: FakeFleet):
+    class FakeMqttHandler(socketserver.BaseRequestHandler):
+        """
+        Just enough MQTT 3.1.1 for paho's publish.single: CONNECT, PUBLISH (QoS 0), PINGREQ and DISCONNECT.
+        """
+
+        def read_exact(self, length: int) -> bytes:
+            data = b""
+            while len(data) < length:
+                chunk = self.request.recv(length - len(data))
+                if not chunk:
+                    raise ConnectionError("Client closed connection")
+                data += chunk
+            return data
+
+        def handle(self):
+            fleet.count("mqtt_connections")
+            try:
+                while True:
+                    packet_type = self.read_exact(1)[0] >> 4
+                    remaining_length, multiplier = 0, 1
+                    while True:
+                        encoded_byte = self.read_exact(1)[0]
+                        remaining_length += (encoded_byte & 127) * multiplier
+                        multiplier *= 128
+                        if not encoded_byte & 128:
+                            break
+                    self.read_exact(remaining_length)
+
+                    if packet_type == 1:  # CONNECT
+                        self.request.sendall(b"\x20\x02\x00\x00")
+                    elif packet_type == 3:  # PUBLISH
+                        fleet.count("mqtt_publishes")
+                    elif packet_type == 12:  # PINGREQ
+                        self.request.sendall(b"\xd0\x00")
+                    elif packet_type == 14:  # DISCONNECT
+                        return
+            except (ConnectionError, OSError):
+                return
+
+    return FakeMqttHandler
+
+
+class ThreadingTcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve_fake_fleet(device_count: int, token_ttl_requests: int, rate_limit_every: int, account_count: int, api_latency_s: float, ports_queue) -> None:
+    fleet = FakeFleet(device_count, token_ttl_requests=token_ttl_requests, rate_limit_every=rate_limit_every, account_count=account_count, api_latency_s=api_latency_s)
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), make_http_handler(fleet))
+    httpd.daemon_threads = True
+    mqttd = ThreadingTcpServer(("127.0.0.1", 0), make_mqtt_handler(fleet))
+
+    threading.Thread(target=mqttd.serve_forever, daemon=True).start()
+    ports_queue.put({"http_port": httpd.server_address[1], "mqtt_port": mqttd.server_address[1]})
+    httpd.serve_forever()
+
+
+class FakeServers:
+    """
+    Runs the fake HTTP API/sink server and MQTT broker in a child process.
+    """
+
+    def __init__(self, device_count: int, token_ttl_requests: int = 0, rate_limit_every: int = 0, account_count: int = 1, api_latency_s: float = 0):
+        self.device_count = device_count
+        self.token_ttl_requests = token_ttl_requests
+        self.rate_limit_every = rate_limit_every
+        self.account_count = account_count
+        self.api_latency_s = api_latency_s
+        self.process = None
+        self.http_port = 0
+        self.mqtt_port = 0
+
+    def __enter__(self):
+        ports_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve_fake_fleet, args=(self.device_count, self.token_ttl_requests, self.rate_limit_every, self.account_count, self.api_latency_s, ports_queue), daemon=True)
+        self.process.start()
+        ports = ports_queue.get(timeout=30)
+        self.http_port = ports["http_port"]
+        self.mqtt_port = ports["mqtt_port"]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.terminate()
+        self.process.join(timeout=10)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.http_port}"
+
+    def stats(self) -> dict:
+        import requests
+
+        return requests.get(f"{self.base_url}/_bench/stats", timeout=10).json()
+
+    def wait_until_idle(self, settle_seconds: float = 0.2, timeout: float = 10) -> dict:
+        """
+        Wait until the request counters stop changing, so per-cycle sink counts are complete.
+        """
+        deadline = time.time() + timeout
+        previous = self.stats()
+        while time.time() < deadline:
+            time.sleep(settle_seconds)
+            current = self.stats()
+            if current == previous:
+                return current
+            previous = current
+        return previous
@@ -3,51 +3,102 @@ import logging
 import time
 from threading import Thread
 from modules.conf import Conf
+from modules.config_reload import config_reload
 from modules.relay_fusionsolar_kiosk import RelayFusionSolarKiosk
 from modules.relay_fusionsolar_open_api import RelayFusionSolarOpenApi
 from modules.relay_kenter import RelayKenter
+from modules.serve_http import ServeHttp
+from modules.cycle_profiler import CycleProfiler
+from modules.sharding import release_shard_coordinator
+from modules.device_state import flush_device_state_store
+from modules.log_pipeline import log_pipeline
+from modules.shutdown import shutdown, PHASE_CLEANUP
+from modules.supervisor import RelaySupervisor
 
 # Disable https cert verify disabled warning (Telerik Fiddler)
 import urllib3
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-# Logger
-logger: logging.Logger = logging.getLogger()
+# Logger, records are written to stdout by a listener thread
+logger: logging.Logger = log_pipeline.start()
 logger.setLevel(logging.DEBUG)
-streamHandler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-streamHandler.setFormatter(formatter)
-logger.addHandler(streamHandler)
 logger.info("PyFusionSolarDataRelay 2.0.5 started")
 
 # Config
 conf = Conf(logger).read_and_validate_config()
+log_pipeline.apply_settings(conf)
 if conf.debug_mode:
     logger.debug("Enabled verbose logging")
-    logger.setLevel(logging.DEBUG)
     logger.debug(conf.model_dump_json(indent=2, exclude_defaults=False))
-else:
-    logger.setLevel(logging.INFO)
-    # logger.info(conf.model_dump_json(indent=2, exclude_defaults=False))
+
+
+def start_relay(relay_class):
+    try:
+        relay = relay_class(conf, logger)
+        relay.start()
+    except Exception as e:
+        logger.exception(f"{relay_class.__name__} stopped because of an unhandled exception: {e}")
+        raise
+
 
 # Start RelayFusionSolar and KenterRelay
-try:
-    if __name__ == "__main__":
+relay_threads = []
+if __name__ == "__main__":
+    # SIGTERM (docker stop) and Ctrl-C stop the relays gracefully instead of killing in-progress cycles
+    shutdown.install_signal_handlers(logger)
+    CycleProfiler.install_signal_handler(conf, logger)
+    if conf.http_server_enabled:
+        http_server = ServeHttp(conf, logger)
+        http_server.start()
+        shutdown.register("ServeHttp", http_server.stop, PHASE_CLEANUP)
+    # Hand over this instance's stations to the other shard members right away
+    shutdown.register("ShardLease", release_shard_coordinator, PHASE_CLEANUP)
+    shutdown.register("DeviceState", flush_device_state_store, PHASE_CLEANUP)
+
+    if conf.supervisor_mode:
+        # One process per relay, blocks until all relays finished replaying or shutdown is requested
+        supervisor = RelaySupervisor(conf, logger)
+        supervisor.install_reload_signal_handler()
+        shutdown.register("RelaySupervisor", supervisor.stop)
+        supervisor.run()
+    else:
+        # SIGHUP or a changed config file reloads the settings without restarting the relays
+        config_reload.install_signal_handler(logger)
+        config_reload.start(conf, logger)
         if conf.fusionsolar_kiosk_module_enabled:
-            fs_thread = Thread(target=RelayFusionSolarKiosk, args=[conf, logger])
+            fs_thread = Thread(target=start_relay, args=[RelayFusionSolarKiosk], name="RelayFusionSolarKiosk")
             fs_thread.daemon = True
             fs_thread.start()
+            relay_threads.append(fs_thread)
         if conf.fusionsolar_open_api_module_enabled:
-            fs_thread = Thread(target=RelayFusionSolarOpenApi, args=[conf, logger])
+            fs_thread = Thread(target=start_relay, args=[RelayFusionSolarOpenApi], name="RelayFusionSolarOpenApi")
             fs_thread.daemon = True
             fs_thread.start()
+            relay_threads.append(fs_thread)
         if conf.kenter_module_enabled:
-            gr_thread = Thread(target=RelayKenter, args=[conf, logger])
+            gr_thread = Thread(target=start_relay, args=[RelayKenter], name="RelayKenter")
             gr_thread.daemon = True
             gr_thread.start()
-    while True:
-        time.sleep(1)
-except KeyboardInterrupt:
-    logger.info("Ctrl C - Stopping relay")
+            relay_threads.append(gr_thread)
+        reported_dead_threads = set()
+        while not shutdown.wait(1):
+            if conf.capture_mode == "replay":
+                if not any(thread.is_alive() for thread in relay_threads):
+                    logger.info("All captured API traffic replayed - Stopping relay")
+                    break
+                continue
+            for thread in relay_threads:
+                if not thread.is_alive() and thread.name not in reported_dead_threads:
+                    reported_dead_threads.add(thread.name)
+                    logger.error(f"{thread.name} thread has stopped, its input is no longer relayed. Use supervisor_mode to restart failed relays automatically.")
+
+    logger.info(f"Stopping relay, waiting up to {conf.shutdown_timeout_seconds:g}s for in-progress cycles and sink writes...")
+    shutdown_started = time.monotonic()
+    if shutdown.run_hooks(logger, conf.shutdown_timeout_seconds):
+        for thread in relay_threads:
+            thread.join(max(0.0, conf.shutdown_timeout_seconds - (time.monotonic() - shutdown_started)))
+        logger.info("Relay stopped")
+    else:
+        logger.warning("Relay stopped before all in-progress work finished")
     sys.exit(0)
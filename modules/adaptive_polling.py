@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+from dataclasses import fields
+from typing import Iterable, Optional
+from modules.conf_models import PyFusionSolarSettings
+from modules.metrics import metrics
+from modules.solar import is_daylight
+
+
+class AdaptivePolling:
+    """
+    Decides on each cron tick of a relay whether a cycle runs. In darkness, computed from the site coordinates, cycles
+    run at the night interval or not at all. When consecutive cycles return identical values the interval doubles
+    up to the maximum idle interval, and it returns to the cron interval as soon as values change or the sun rises.
+    The cron sets the fastest rate, so the API quota saved at night and on idle devices allows a faster daytime cron.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, relay_name: str):
+        self.conf = conf
+        self.logger = logger
+        self.relay_name = relay_name
+        self.lock = threading.Lock()
+        self.last_cycle_time: Optional[float] = None
+        self.interval_s: float = 0
+        self.unchanged_cycles = 0
+        self.in_darkness = False
+        self.cycle_values = set()
+        self.last_cycle_values = None
+        self.logger.debug(f"AdaptivePolling class instantiated for {relay_name}")
+
+    def solar_aware(self) -> bool:
+        return self.conf.site_latitude is not None and self.conf.site_longitude is not None
+
+    def should_poll(self, cron_interval_s: Optional[float], now: Optional[float] = None) -> bool:
+        """
+        Called on each cron tick, returns False if this tick is skipped.
+        """
+        if not self.conf.adaptive_polling_enabled:
+            return True
+        now = time.time() if now is None else now
+        cron_interval_s = cron_interval_s or 0
+        # Cron ticks fire slightly after the scheduled time, so the next tick is never missed by a few seconds
+        tolerance_s = cron_interval_s / 10
+
+        if self.solar_aware():
+            in_darkness = not is_daylight(self.conf.site_latitude, self.conf.site_longitude, now, self.conf.adaptive_polling_twilight_minutes * 60)
+            if in_darkness != self.in_darkness:
+                self.in_darkness = in_darkness
+                if in_darkness:
+                    night_interval = f"every {self.conf.adaptive_polling_night_interval_seconds}s" if self.conf.adaptive_polling_night_interval_seconds > 0 else "suspended"
+                    self.logger.info(f"Darkness at the site, {self.relay_name} polling {night_interval} until sunrise")
+                else:
+                    self.logger.info(f"Daylight at the site, {self.relay_name} polling resumes at the cron interval")
+                    self.unchanged_cycles = 0
+                    self.interval_s = 0
+                    return True
+            if in_darkness:
+                night_interval_s = self.conf.adaptive_polling_night_interval_seconds
+                if night_interval_s <= 0 or (self.last_cycle_time is not None and now - self.last_cycle_time < night_interval_s - tolerance_s):
+                    return self.skip("darkness")
+                return True
+
+        if self.last_cycle_time is not None and now - self.last_cycle_time < self.interval_s - tolerance_s:
+            return self.skip("unchanged")
+        return True
+
+    def skip(self, reason: str) -> bool:
+        metrics.inc("polls_skipped_total", relay=self.relay_name, reason=reason)
+        self.logger.debug(f"Skipping {self.relay_name} cycle, reason: {reason}")
+        return False
+
+    def observe(self, measurements: Iterable) -> None:
+        """
+        Add measurements of the running cycle, compared with the previous cycle when the cycle finishes.
+        """
+        # Everything except the settings and the poll time, a measurement with equal values is unchanged
+        values = {tuple(getattr(measurement, field.name) for field in fields(measurement) if field.name not in ("settings", "timestamp")) for measurement in measurements}
+        with self.lock:
+            self.cycle_values.update(values)
+
+    def cycle_finished(self, cron_interval_s: Optional[float], now: Optional[float] = None) -> None:
+        """
+        Called after each cycle, determines the interval until the next cycle.
+        """
+        with self.lock:
+            cycle_values, self.cycle_values = self.cycle_values, set()
+        self.last_cycle_time = time.time() if now is None else now
+        if not self.conf.adaptive_polling_enabled:
+            return
+
+        # A cycle without measurements, e.g. failed requests, does not count as idle
+        if cycle_values and cycle_values == self.last_cycle_values:
+            self.unchanged_cycles += 1
+        else:
+            self.unchanged_cycles = 0
+        if cycle_values:
+            self.last_cycle_values = cycle_values
+
+        interval_s = cron_interval_s or 0
+        if self.unchanged_cycles and self.conf.adaptive_polling_max_idle_interval_seconds > 0:
+            interval_s = min(interval_s * 2 ** min(self.unchanged_cycles, 16), max(interval_s, self.conf.adaptive_polling_max_idle_interval_seconds))
+        if interval_s != self.interval_s and (self.unchanged_cycles or self.interval_s):
+            self.logger.info(f"{self.relay_name} values {'unchanged for ' + str(self.unchanged_cycles) + ' cycle(s)' if self.unchanged_cycles else 'changed'}, polling every {interval_s:.0f}s")
+        self.interval_s = interval_s
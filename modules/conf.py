@@ -25,6 +25,14 @@ class Conf:
         else:
             self.logger.info(f"No DOTENV config file found in pyfusionsolar working dir. Using environment variables from environment or default settings.")
 
+        # YAML/JSON config file, environment variables override its settings
+        config_file = config_file_path()
+        self.logger.debug(f"Config file path: {config_file}")
+        if config_file.is_file():
+            self.logger.info(f"Config file exists, loading settings from {config_file}, environment variables override the settings in this file...")
+        else:
+            self.logger.info(f"No config file found at {config_file}, using environment variables and default settings.")
+
         # Class instantiating
         config = PyFusionSolarSettings()
         return config
\ No newline at end of file
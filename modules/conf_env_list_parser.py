@@ -1,37 +1,41 @@
 from pydantic.fields import FieldInfo
-from pydantic_settings import EnvSettingsSource
-import json
-import os
-from typing import Any
+from pydantic_settings import BaseSettings, EnvSettingsSource
+from typing import Any, Dict, List, Optional
+
+LIST_FIELDS = ["fusionsolar_kiosks", "kenter_metering_points", "fusionsolar_open_api_inverters", "fusionsolar_open_api_meters", "fusionsolar_open_api_accounts"]
 
 
 class ConfEnvListParser(EnvSettingsSource):
-    def prepare_field_value(self, field_name: str, field: FieldInfo, value: Any, value_is_complex: bool) -> Any:
-        if field_name in ["fusionsolar_kiosks", "kenter_metering_points", "fusionsolar_open_api_inverters", "fusionsolar_open_api_meters"]:
-            prefix = f"{field_name.upper()}__"
-            kiosks_map = {}
-            for key, val in os.environ.items():
-                key = key.upper()
-                if key.startswith(prefix):
-                    # Example: FUSIONSOLAR_KIOSKS__0__FUSIONSOLAR_KIOSK_API_URL
-                    # Split out the index and field name
-                    _, idx_str, field_found_name = key.split("__", 2)
-                    try:
-                        idx = int(idx_str)
-                    except ValueError:
-                        # If the middle portion is not an integer, ignore
-                        continue
-                    if idx not in kiosks_map:
-                        kiosks_map[idx] = {}
-                    # Put the raw string into the kiosk map under the correct field
-                    kiosks_map[idx][field_found_name.lower()] = val
+    def __init__(self, settings_cls: type[BaseSettings], file_lists: Optional[Dict[str, List[dict]]] = None):
+        super().__init__(settings_cls)
+        # Lists from the config file, indexed environment variables override items of these lists
+        self.file_lists = file_lists or {}
 
-            # Sort keys numerically and build a list
-            kiosks_list = []
-            for idx in sorted(kiosks_map.keys()):
-                kiosks_list.append(kiosks_map[idx])
+        # Index the environment once, instead of scanning it for each list field
+        # Example: FUSIONSOLAR_KIOSKS__0__API_URL, split out the list field, index and item field name
+        self.env_lists: Dict[str, Dict[int, Dict[str, str]]] = {}
+        for key, val in self.env_vars.items():
+            parts = key.lower().split("__", 2)
+            if len(parts) != 3 or parts[0] not in LIST_FIELDS:
+                continue
+            try:
+                idx = int(parts[1])
+            except ValueError:
+                # If the middle portion is not an integer, ignore
+                continue
+            self.env_lists.setdefault(parts[0], {}).setdefault(idx, {})[parts[2]] = val
 
-            value = json.dumps(kiosks_list)
+    def prepare_field_value(self, field_name: str, field: FieldInfo, value: Any, value_is_complex: bool) -> Any:
+        if field_name in LIST_FIELDS and field_name in self.env_lists:
+            items_map = self.env_lists[field_name]
+            items_list = [dict(item) for item in self.file_lists.get(field_name) or []]
+            # Indexes within the config file list override fields of that item, others are appended in index order
+            for idx in sorted(items_map.keys()):
+                if idx < len(items_list):
+                    items_list[idx].update(items_map[idx])
+                else:
+                    items_list.append(items_map[idx])
+            # Hand the list of dicts to pydantic as is, no need to round trip through a JSON string
+            return items_list
 
-        ret = super(ConfEnvListParser, self).prepare_field_value(field_name, field, value, value_is_complex)
-        return ret
+        return super(ConfEnvListParser, self).prepare_field_value(field_name, field, value, value_is_complex)
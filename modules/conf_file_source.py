@@ -0,0 +1,13 @@
+from pydantic_settings import YamlConfigSettingsSource
+import json
+import yaml
+from typing import Any
+
+
+class ConfFileSource(YamlConfigSettingsSource):
+    def _read_file(self, file_path) -> dict[str, Any]:
+        # JSON files are parsed with the json module, YAML with the libyaml based loader when available, both are much faster than the pure python YAML loader on large device lists
+        with file_path.open(encoding="utf-8") as config_file:
+            if file_path.suffix.lower() == ".json":
+                return json.load(config_file) or {}
+            return yaml.load(config_file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
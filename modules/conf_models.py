@@ -1,17 +1,26 @@
-from typing import List
-from pydantic import Field
+import os
+import pathlib
+from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field
 from pydantic_settings import (
     BaseSettings,
     PydanticBaseSettingsSource,
     SettingsConfigDict,
 )
 
-from modules.conf_env_list_parser import ConfEnvListParser
+from modules.conf_env_list_parser import ConfEnvListParser, LIST_FIELDS
+from modules.conf_file_source import ConfFileSource
 
+PROJECT_DIR = pathlib.Path(__file__).resolve().parent.parent
 
-class BaseMetricSettings(BaseSettings):
+
+# List item settings are plain models, a BaseSettings item would load and parse the whole environment for every configured device
+class BaseMetricSettings(BaseModel):
+    model_config = ConfigDict(extra="forbid")
     enabled: bool = Field(default=True)
     output_influxdb: bool = Field(default=True)
+    output_sqlite: bool = Field(default=True)
+    output_archive: bool = Field(default=True)
 
 
 class FusionSolarKioskSettings(BaseMetricSettings):
@@ -23,6 +32,15 @@ class FusionSolarKioskSettings(BaseMetricSettings):
     output_pvoutput_system_id: int = Field(default=0)
 
 
+class FusionSolarOpenApiAccountSettings(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    enabled: bool = Field(default=True)
+    descriptive_name: str = Field(default="account01", description="Unique name, used for the metadata cache file names and metric labels")
+    api_url: str = Field(default="", description="Leave empty to use fusionsolar_open_api_url")
+    user_name: str = Field(default="")
+    system_code: str = Field(default="")
+
+
 class FusionSolarOpenApiInverterSettings(BaseMetricSettings):
     descriptive_name: str = Field(default="inverter01")
     dev_id: str = Field(default="")
@@ -53,8 +71,39 @@ class PyFusionSolarSettings(BaseSettings):
     # General settings
     #
     debug_mode: bool = Field(default=False)
+    log_format: str = Field(default="text", description="text or json, one JSON object per line")
+    log_repeat_window_seconds: float = Field(default=300, description="Repeated identical warnings and errors from the same code location are rate limited per window, 0 disables rate limiting")
+    log_repeat_max_records: int = Field(default=5, description="Identical warnings and errors logged per code location per window, the number of suppressed records is logged afterwards")
+    config_file: str = Field(default="config.yaml", description="YAML or JSON config file, relative paths are relative to the project directory. Environment variables override the file")
+    config_watch_interval_seconds: float = Field(default=10, description="Reload the settings when the config file changed, checked at this interval. 0 disables watching, SIGHUP always reloads")
     fetch_on_startup: bool = Field(default=False, description="Do not wait for cron for initial data fetching")
     site_descriptive_name: str = Field(default="site01")
+    site_latitude: Optional[float] = Field(default=None, description="Site latitude in degrees, north positive, used to compute sunrise and sunset for adaptive polling")
+    site_longitude: Optional[float] = Field(default=None, description="Site longitude in degrees, east positive")
+    shutdown_timeout_seconds: float = Field(default=8, description="On SIGTERM or Ctrl-C, time allowed to finish the in-progress cycles and flush sinks. Keep below the docker stop grace period (10s by default)")
+    supervisor_mode: bool = Field(default=False, description="Run each enabled relay in its own process instead of a thread, restarting failed relay processes")
+    supervisor_restart_backoff_seconds: float = Field(default=5, description="Delay before the first restart of a failed relay process, doubled on every consecutive failure")
+    supervisor_restart_backoff_max_seconds: float = Field(default=300)
+    supervisor_stable_seconds: float = Field(default=600, description="A relay process running at least this long before failing is restarted with the initial backoff")
+    supervisor_metrics_interval_seconds: float = Field(default=15, description="Interval at which relay processes send their metrics to the supervisor")
+
+    #
+    # Timeouts and cycle budget
+    #
+    http_connect_timeout_seconds: float = Field(default=10, description="Connect timeout of upstream API and PVOutput requests")
+    http_read_timeout_seconds: float = Field(default=60, description="Maximum time without data from the server during upstream API and PVOutput requests")
+    scheduler_misfire_grace_seconds: int = Field(default=60, description="A cron tick which can not start on time, e.g. after an overrunning cycle, still runs this long after its scheduled time")
+    cycle_budget_enabled: bool = Field(default=True, description="Degrade cycles which take longer than the cron interval instead of falling further behind")
+    cycle_budget_fraction: float = Field(default=0.8, description="Fraction of the cron interval after which low priority sinks are skipped for the rest of the cycle")
+    cycle_budget_low_priority_sinks: List[str] = Field(default=["pvoutput", "backfill"], description="Sinks skipped past the soft deadline, of influxdb, mqtt, sqlite, archive, pvoutput and backfill (OpenAPI history backfill)")
+
+    #
+    # Adaptive polling
+    #
+    adaptive_polling_enabled: bool = Field(default=False, description="Skip kiosk and OpenAPI cron ticks in darkness and while values are unchanged, the cron sets the fastest rate")
+    adaptive_polling_night_interval_seconds: float = Field(default=3600, description="Polling interval between sunset and sunrise, 0 suspends polling in darkness. Requires site_latitude and site_longitude")
+    adaptive_polling_twilight_minutes: float = Field(default=30, description="Keep polling at the daytime rate this long before sunrise and after sunset")
+    adaptive_polling_max_idle_interval_seconds: float = Field(default=1800, description="The interval doubles on each cycle with unchanged values, up to this maximum. 0 disables slowing down")
 
     #
     # Inputs
@@ -72,6 +121,12 @@ class PyFusionSolarSettings(BaseSettings):
     fusionsolar_open_api_url: str = Field(default="https://eu5.fusionsolar.huawei.com")
     fusionsolar_open_api_user_name: str = Field(default="")
     fusionsolar_open_api_system_code: str = Field(default="")
+    fusionsolar_open_api_accounts: List[FusionSolarOpenApiAccountSettings] = Field(
+        default=[], description="Multiple OpenAPI accounts, each with its own token, rate limit budget and metadata cache. When empty, the single user_name/system_code account above is used."
+    )
+    fusionsolar_open_api_request_spread_fraction: float = Field(default=0.5, description="Spread the realtime requests of a cycle over this fraction of the cron interval, 0 sends them back to back")
+    fusionsolar_open_api_min_request_interval_seconds: float = Field(default=60, description="Minimum time between realtime requests for the same device type and account, the API flow control quota")
+    fusionsolar_open_api_max_parallel_accounts: int = Field(default=8, description="Maximum number of OpenAPI accounts polled concurrently within a cycle")
     fusionsolar_open_api_cron_hour: str = Field(default="*")
     fusionsolar_open_api_cron_minute: str = Field(
         default="*/5",
@@ -81,6 +136,12 @@ class PyFusionSolarSettings(BaseSettings):
     fusionsolar_open_api_meters: List[FusionSolarOpenApiMeterSettings] = Field(default=[])
     fusionsolar_open_api_mqtt_for_discovered_dev: bool = Field(default=True, description="Write KPI's to MQTT for devices discovered over the API without a matching dev_id")
     fusionsolar_open_api_influxdb_for_discovered_dev: bool = Field(default=True, description="Write KPI's to InfluxDB for devices discovered over the API without a matching dev_id")
+    fusionsolar_open_api_sqlite_for_discovered_dev: bool = Field(default=True, description="Write KPI's to SQLite for devices discovered over the API without a matching dev_id")
+    fusionsolar_open_api_archive_for_discovered_dev: bool = Field(default=True, description="Write KPI's to the archive for devices discovered over the API without a matching dev_id")
+    fusionsolar_open_api_backfill_enabled: bool = Field(default=False, description="Recover missed cycles from the 5 minute device history and write them to the InfluxDB, SQLite and archive sinks")
+    fusionsolar_open_api_backfill_gap_seconds: int = Field(default=0, description="Time since the last successful poll which counts as a gap, 0 for twice the cron interval")
+    fusionsolar_open_api_backfill_max_days: int = Field(default=7, description="Maximum age of the history which is backfilled")
+    fusionsolar_open_api_backfill_max_calls_per_cycle: int = Field(default=4, description="Maximum number of history calls per account per cycle, remaining gaps are filled in the next cycles")
 
     # Kenter Kenter.nl
     kenter_module_enabled: bool = Field(default=False)
@@ -95,6 +156,8 @@ class PyFusionSolarSettings(BaseSettings):
         default=0, description="Setting this to 30 would try to backfill gridkenter data on startup for any day between 3 days back (gridrelaydaysback) and 3+30=33 days back."
     )
     kenter_metering_points: List[KenterMeterSettings] = Field(default=[])
+    kenter_bulk_import_enabled: bool = Field(default=True, description="Send the meter-days of a cycle to InfluxDB in large compressed batches, requires influxdb_client native")
+    kenter_request_interval_seconds: float = Field(default=5, description="Pause between Kenter API requests to avoid HTTP status 429 (too many requests)")
 
     #
     # Outputs
@@ -105,6 +168,13 @@ class PyFusionSolarSettings(BaseSettings):
     influxdb_is_v2: bool = Field(default=True, description="Set to True to enable InfluxDB v2, or to False for InfluxDB v1 or VictoriaMetrics")
     influxdb_host: str = Field(default="localhost")
     influxdb_port: int = Field(default=8086)
+    influxdb_timeout_seconds: float = Field(default=10, description="Timeout of InfluxDB requests")
+    influxdb_client: str = Field(default="native", description="native (built-in line protocol writer) or library (influxdb or influxdb-client package)")
+    influxdb_gzip_enabled: bool = Field(default=True, description="Gzip request bodies of the native writer")
+    influxdb_batch_size: int = Field(default=5000, description="Maximum lines per request of the native writer")
+    influxdb_tag_mode: str = Field(default="full", description="full, or minimal to tag points with the device identity only and write descriptive tags to the device_metadata measurement on change")
+    influxdb_target: str = Field(default="influxdb", description="influxdb, or victoriametrics to send bulk imports to the VictoriaMetrics /api/v1/import endpoint")
+    influxdb_bulk_max_batch_bytes: int = Field(default=4000000, description="Uncompressed size at which a bulk import batch is sent")
     # InfluxDB v1 settings
     influxdb_v1_db_name: str = Field(default="fusionsolar")
     influxdb_v1_username: str = Field(default="fusionsolar")
@@ -124,11 +194,77 @@ class PyFusionSolarSettings(BaseSettings):
     mqtt_module_enabled: bool = Field(default=False)
     mqtt_host: str = Field(default="localhost")
     mqtt_port: int = Field(default=1883)
+    mqtt_timeout_seconds: float = Field(default=10, description="Deadline for connecting to the broker and publishing one message")
     mqtt_auth: bool = Field(default=False)
     mqtt_username: str = Field(default="fusionsolar")
     mqtt_password: str = Field(default="fusionsolar")
     mqtt_root_topic: str = Field(default="pyfusionsolar")
     mqtt_hass_discovery_enabled: bool = Field(default=True)
+    mqtt_payload_mode: str = Field(default="device", description="device publishes a state per device, station one state per station per cycle with the fields of all its devices and station totals")
+    mqtt_deadband_enabled: bool = Field(default=False, description="Only publish a state when a field changed beyond its deadband, or after mqtt_deadband_max_silence_seconds")
+    mqtt_deadband_power_w: float = Field(default=10, description="Absolute deadband of power fields")
+    mqtt_deadband_energy_wh: float = Field(default=0, description="Absolute deadband of energy fields, 0 publishes every counter increase")
+    mqtt_deadband_relative: float = Field(default=0.01, description="Relative deadband of power fields as a fraction of the last published value, a change must exceed both deadbands")
+    mqtt_deadband_max_silence_seconds: float = Field(default=900, description="Publish an unchanged state after this time, as a heartbeat")
+
+    # SQLite
+    sqlite_module_enabled: bool = Field(default=False)
+    sqlite_file: str = Field(default="cache/measurements.sqlite")
+    sqlite_batch_size: int = Field(default=1000, description="Pending rows at which an insert is done before the end of the cycle")
+    sqlite_retention_days: int = Field(default=365, description="Rows older than this are deleted, 0 keeps all rows")
+
+    # Daily archive files
+    archive_module_enabled: bool = Field(default=False)
+    archive_dir: str = Field(default="archive")
+    archive_format: str = Field(default="csv", description="csv or parquet, the file format of finished days. parquet requires pyarrow")
+    archive_retention_days: int = Field(default=0, description="Day files older than this are deleted, 0 keeps all days")
+
+    #
+    # Sharding over multiple relay instances
+    #
+    sharding_mode: str = Field(default="off", description="off, static (fixed shard index and count) or lease (members register in a shared SQLite lease table)")
+    sharding_shard_index: int = Field(default=0, description="Shard of this instance in static mode, 0 to sharding_shard_count - 1")
+    sharding_shard_count: int = Field(default=1, description="Number of instances in static mode")
+    sharding_lease_db: str = Field(default="cache/shard_leases.sqlite", description="SQLite lease file in lease mode, on storage shared by all instances")
+    sharding_member_id: str = Field(default="", description="Unique member id in lease mode, defaults to hostname and process id")
+    sharding_lease_ttl_seconds: float = Field(default=60, description="Members without a heartbeat for this long are removed and their stations rebalanced")
+    sharding_heartbeat_seconds: float = Field(default=15)
+    sharding_virtual_nodes: int = Field(default=160, description="Hash ring positions per member, more gives a more even split")
+
+    #
+    # Stream filters
+    #
+    device_state_file: str = Field(default="cache/device_state.sqlite", description="SQLite file with the last accepted counter values per device, so filters survive restarts. Empty keeps the state in memory only")
+    stream_filter_monotonic_counters: bool = Field(default=True, description="Emit the last accepted lifetime energy counter when a device reports a lower value")
+    stream_filter_max_counter_rate_w: float = Field(default=0, description="Reject lifetime energy counter increases implying a higher average power since the last accepted value, 0 disables")
+    stream_filter_grid_meter_quirk_threshold_w: float = Field(
+        default=-56553500, description="Grid meter power below this value is reported as 0, fusionsolar meter quirk where power drawn maxes out at 16 bits (66.55MW), plus 10MW pv capacity"
+    )
+
+    #
+    # Upstream API traffic capture
+    #
+    capture_mode: str = Field(default="off", description="off, record (write raw API responses to capture files) or replay (answer API requests from capture files)")
+    capture_dir: str = Field(default="cache/captures")
+    capture_replay_speed: float = Field(default=0, description="0 replays as fast as possible, 1 at original speed, 60 at 60x the original speed")
+
+    #
+    # Instrumentation
+    #
+    metrics_cycle_summary_enabled: bool = Field(default=True, description="Log a one line summary with stage timings and counters after each relay cycle")
+    http_server_enabled: bool = Field(default=False, description="Serve the metrics surface (/metrics, /metrics.json) over HTTP")
+    http_server_host: str = Field(default="0.0.0.0")
+    http_server_port: int = Field(default=8090)
+    measurement_buffer_enabled: bool = Field(default=False, description="Keep recent measurements in memory and serve windowed queries on /series/query of the HTTP server")
+    measurement_buffer_hours: float = Field(default=6, description="Maximum query window of the measurement buffer")
+    measurement_buffer_max_points: int = Field(default=720, description="Points kept per device field, bounds the memory used by the measurement buffer")
+    profile_cycles: int = Field(default=0, description="Profile the first N cycles of each selected relay with cProfile and tracemalloc")
+    profile_signal_cycles: int = Field(default=1, description="Number of cycles of each selected relay to profile after receiving SIGUSR1")
+    profile_relays: str = Field(default="fusionsolar_open_api,fusionsolar_kiosk,kenter", description="Comma separated list of relays to profile")
+    profile_dir: str = Field(default="cache/profiles")
+    profile_stats_lines: int = Field(default=40, description="Number of functions listed per sort order in the profile report")
+    profile_top_allocations: int = Field(default=25, description="Number of top allocation sites listed in the profile report")
+    profile_traceback_frames: int = Field(default=1, description="Number of frames stored per allocation by tracemalloc")
 
     @classmethod
     def settings_customise_sources(
@@ -139,4 +275,15 @@ class PyFusionSolarSettings(BaseSettings):
         dotenv_settings: PydanticBaseSettingsSource,
         file_secret_settings: PydanticBaseSettingsSource,
     ) -> tuple[PydanticBaseSettingsSource, ...]:
-        return (ConfEnvListParser(settings_cls),)
+        # Environment variables take precedence over the config file, indexed list variables override single list items
+        file_settings = ConfFileSource(settings_cls, yaml_file=config_file_path())
+        file_lists = {field_name: file_settings.init_kwargs[field_name] for field_name in LIST_FIELDS if isinstance(file_settings.init_kwargs.get(field_name), list)}
+        return (init_settings, ConfEnvListParser(settings_cls, file_lists), file_settings)
+
+
+def config_file_path() -> pathlib.Path:
+    """
+    Path of the config file, set by the CONFIG_FILE environment variable.
+    """
+    config_file = next((val for key, val in os.environ.items() if key.upper() == "CONFIG_FILE"), PyFusionSolarSettings.model_fields["config_file"].default)
+    return PROJECT_DIR / config_file
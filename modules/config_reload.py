@@ -0,0 +1,143 @@
+import logging
+import os
+import signal
+import threading
+from typing import Callable, List, Optional, Set, Tuple
+from modules.conf import Conf
+from modules.conf_models import PyFusionSolarSettings, config_file_path
+from modules.log_pipeline import log_pipeline
+from modules.metrics import metrics
+from modules.shutdown import shutdown
+
+# Settings which are only read at startup, changes are logged and applied on the next restart
+RESTART_REQUIRED_FIELDS = {
+    "config_file",
+    "supervisor_mode",
+    "fusionsolar_kiosk_module_enabled",
+    "fusionsolar_open_api_module_enabled",
+    "kenter_module_enabled",
+    "capture_mode",
+    "capture_dir",
+    "http_server_enabled",
+    "http_server_host",
+    "http_server_port",
+}
+RESTART_REQUIRED_PREFIXES = ("sharding_", "measurement_buffer_")
+
+
+class ConfigReloader:
+    """
+    Reloads the settings on SIGHUP or when the config file changes, without restarting the relays.
+    The changed fields are assigned on the shared settings object in place, so fetchers and sinks keep
+    their tokens, metadata caches and connections, and registered hooks update the derived indexes and
+    reschedule their cron jobs.
+    """
+
+    def __init__(self):
+        self.conf: Optional[PyFusionSolarSettings] = None
+        self.logger: Optional[logging.Logger] = None
+        self.reload_requested = threading.Event()
+        self.lock = threading.Lock()
+        self.hooks: List[Tuple[str, Callable[[Set[str]], None]]] = []
+        self.config_file_mtime = None
+
+    def register(self, name: str, hook: Callable[[Set[str]], None]) -> None:
+        """
+        Register a hook, called with the names of the changed settings after each reload.
+        """
+        with self.lock:
+            self.hooks.append((name, hook))
+
+    def install_signal_handler(self, logger: logging.Logger) -> None:
+        """
+        Reload the settings on SIGHUP. Must be called from the main thread.
+        """
+        if not hasattr(signal, "SIGHUP"):
+            logger.debug("SIGHUP not available on this platform, config reload by signal is disabled")
+            return
+
+        def handle_signal(signum, frame):
+            # Only set the event, the reload thread reloads
+            self.reload_requested.set()
+
+        signal.signal(signal.SIGHUP, handle_signal)
+        logger.debug("Send SIGHUP to the relay process to reload the settings")
+
+    def start(self, conf: PyFusionSolarSettings, logger: logging.Logger) -> None:
+        """
+        Start the thread which reloads the settings on request and watches the config file.
+        """
+        self.conf = conf
+        self.logger = logger
+        self.config_file_mtime = self.read_config_file_mtime()
+        reload_thread = threading.Thread(target=self.reload_loop, name="ConfigReload")
+        reload_thread.daemon = True
+        reload_thread.start()
+
+    def read_config_file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(config_file_path()).st_mtime
+        except OSError:
+            return None
+
+    def reload_loop(self) -> None:
+        while not shutdown.is_requested():
+            signalled = self.reload_requested.wait(self.conf.config_watch_interval_seconds or None)
+            self.reload_requested.clear()
+            if shutdown.is_requested():
+                return
+
+            config_file_mtime = self.read_config_file_mtime()
+            if signalled:
+                self.logger.info("Received SIGHUP, reloading settings...")
+            elif config_file_mtime != self.config_file_mtime:
+                self.logger.info(f"Config file {config_file_path()} changed, reloading settings...")
+            else:
+                continue
+            self.config_file_mtime = config_file_mtime
+            self.reload()
+
+    def reload(self) -> Set[str]:
+        """
+        Read and validate the settings again, apply the changes and run the hooks. Returns the applied fields.
+        An invalid config is logged and the running settings are kept.
+        """
+        try:
+            new_conf = Conf(self.logger).read_and_validate_config()
+        except Exception as e:
+            metrics.inc("config_reload_errors_total")
+            self.logger.exception(f"Invalid settings, keeping the running settings: {e}")
+            return set()
+
+        changed_fields = {field_name for field_name in PyFusionSolarSettings.model_fields if getattr(self.conf, field_name) != getattr(new_conf, field_name)}
+        restart_fields = {field_name for field_name in changed_fields if field_name in RESTART_REQUIRED_FIELDS or field_name.startswith(RESTART_REQUIRED_PREFIXES)}
+        applied_fields = changed_fields - restart_fields
+        if restart_fields:
+            self.logger.warning(f"Changed settings which require a restart, not applied: {', '.join(sorted(restart_fields))}")
+        if not applied_fields:
+            self.logger.info("Settings reloaded, no changes to apply")
+            return applied_fields
+
+        for field_name in applied_fields:
+            setattr(self.conf, field_name, getattr(new_conf, field_name))
+        try:
+            log_pipeline.apply_settings(self.conf)
+        except Exception as e:
+            self.logger.exception(f"Error applying reloaded log settings: {e}")
+
+        with self.lock:
+            hooks = list(self.hooks)
+        for name, hook in hooks:
+            try:
+                hook(applied_fields)
+            except Exception as e:
+                metrics.inc("config_reload_errors_total")
+                self.logger.exception(f"Error applying reloaded settings to {name}: {e}")
+
+        metrics.inc("config_reloads_total")
+        self.logger.info(f"Settings reloaded, applied: {', '.join(sorted(applied_fields))}")
+        return applied_fields
+
+
+# Process wide reloader, shared by all relays
+config_reload = ConfigReloader()
@@ -0,0 +1,56 @@
+import logging
+import threading
+import time
+from typing import Optional
+from modules.conf_models import PyFusionSolarSettings
+from modules.metrics import metrics
+
+
+class CycleBudget:
+    """
+    Time budget of one relay cycle, relative to the cron interval. Past the soft deadline, low priority sinks
+    are skipped so the primary sinks keep up. Past the cron interval, the remaining devices of the cycle are
+    skipped, the next cycle fetches fresh data for them anyway.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, relay: str, interval_s: Optional[float]):
+        self.conf = conf
+        self.logger = logger
+        self.relay = relay
+        self.started = time.monotonic()
+        # Without an interval (replays) or with budgeting disabled, a cycle is never cut short
+        self.interval_s = interval_s if conf.cycle_budget_enabled else None
+        self.lock = threading.Lock()
+        self.degraded_sinks = False
+        self.skipped_devices = 0
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def sink_allowed(self, sink: str) -> bool:
+        """
+        Whether a write to the sink fits the budget, low priority sinks are skipped past the soft deadline.
+        """
+        if self.interval_s is None or sink not in self.conf.cycle_budget_low_priority_sinks or self.elapsed() < self.interval_s * self.conf.cycle_budget_fraction:
+            return True
+        with self.lock:
+            if not self.degraded_sinks:
+                self.degraded_sinks = True
+                self.logger.warning(
+                    f"{self.relay} cycle used {self.elapsed():.0f}s of its {self.interval_s:.0f}s interval, skipping low priority sinks ({', '.join(self.conf.cycle_budget_low_priority_sinks)}) for the rest of the cycle"
+                )
+        metrics.inc("cycle_budget_skips_total", relay=self.relay, kind="sink", sink=sink)
+        return False
+
+    def device_allowed(self, device_count: int = 1) -> bool:
+        """
+        Whether the next device or batch of devices fits the budget, False once the cycle takes longer than the cron interval.
+        """
+        if self.interval_s is None or self.elapsed() < self.interval_s:
+            return True
+        with self.lock:
+            if not self.skipped_devices:
+                self.logger.warning(f"{self.relay} cycle exceeded its {self.interval_s:.0f}s interval, skipping the remaining devices of this cycle")
+            self.skipped_devices += device_count
+        metrics.inc("cycle_budget_skips_total", device_count, relay=self.relay, kind="device")
+        return False
@@ -0,0 +1,165 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import signal
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List
+from modules.conf_models import PyFusionSolarSettings
+
+# cProfile and tracemalloc are process wide on recent Python versions, only one cycle is profiled at a time
+PROFILE_LOCK = threading.Lock()
+
+
+class CycleProfiler:
+    """
+    Wraps the next N cycles of a relay in cProfile and tracemalloc, and dumps the sorted stats
+    and top allocation sites to the profile directory. Armed at startup by profile_cycles,
+    or at runtime for all relays by sending SIGUSR1 to the process.
+    """
+
+    instances = []
+    instances_lock = threading.Lock()
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, relay: str):
+        self.conf = conf
+        self.logger = logger
+        self.relay = relay
+        self.lock = threading.Lock()
+        self.remaining_cycles = 0
+        # Profiles of the worker threads of the cycle being profiled, merged into the cycle profile
+        self.thread_profilers = None
+        if self.is_relay_selected() and self.conf.profile_cycles > 0:
+            self.arm(self.conf.profile_cycles)
+
+        with CycleProfiler.instances_lock:
+            CycleProfiler.instances.append(self)
+
+    def is_relay_selected(self) -> bool:
+        selected_relays = [relay.strip() for relay in self.conf.profile_relays.split(",") if relay.strip()]
+        return not selected_relays or self.relay in selected_relays
+
+    def arm(self, cycles: int) -> None:
+        with self.lock:
+            self.remaining_cycles = cycles
+        self.logger.info(f"Profiling armed for the next {cycles} {self.relay} cycle(s), output directory: {self.conf.profile_dir}")
+
+    @classmethod
+    def arm_all(cls, cycles: int) -> None:
+        with cls.instances_lock:
+            instances = list(cls.instances)
+        for instance in instances:
+            if instance.is_relay_selected():
+                instance.arm(cycles)
+
+    @classmethod
+    def install_signal_handler(cls, conf: PyFusionSolarSettings, logger: logging.Logger) -> None:
+        """
+        Arm profiling of the next profile_signal_cycles cycles on SIGUSR1. Must be called from the main thread.
+        """
+        if not hasattr(signal, "SIGUSR1"):
+            logger.debug("SIGUSR1 not available on this platform, on-demand profiling by signal is disabled")
+            return
+
+        def handle_signal(signum, frame):
+            # Logging from a signal handler can deadlock, arm from a separate thread
+            threading.Thread(target=cls.arm_all, args=[conf.profile_signal_cycles], daemon=True).start()
+
+        signal.signal(signal.SIGUSR1, handle_signal)
+        logger.debug("Send SIGUSR1 to the relay process to profile the next cycles")
+
+    def take_cycle(self) -> bool:
+        with self.lock:
+            if self.remaining_cycles <= 0:
+                return False
+            if not PROFILE_LOCK.acquire(blocking=False):
+                self.logger.debug(f"Another cycle is being profiled, {self.relay} cycle will be profiled later")
+                return False
+            self.remaining_cycles -= 1
+            return True
+
+    @contextmanager
+    def profile(self):
+        if not self.take_cycle():
+            yield
+            return
+
+        started_tracemalloc = False
+        try:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.conf.profile_traceback_frames)
+                started_tracemalloc = True
+            tracemalloc.reset_peak()
+            profiler = cProfile.Profile()
+            with self.lock:
+                self.thread_profilers = []
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                duration_s = time.perf_counter() - started
+                with self.lock:
+                    thread_profilers, self.thread_profilers = self.thread_profilers, None
+                snapshot = tracemalloc.take_snapshot()
+                current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+                self.dump_profile([profiler] + thread_profilers, snapshot, duration_s, current_bytes, peak_bytes)
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+            PROFILE_LOCK.release()
+
+    @contextmanager
+    def profile_thread(self):
+        """
+        Profile the part of a cycle which runs on a worker thread, cProfile only profiles the thread that enabled it.
+        """
+        with self.lock:
+            profiling = self.thread_profilers is not None
+        profiler = cProfile.Profile() if profiling else None
+        try:
+            if profiler is not None:
+                profiler.enable()
+        except ValueError:
+            # Python 3.12 and later profile all threads from the cycle profiler, a second profiler can not be enabled
+            profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                with self.lock:
+                    if self.thread_profilers is not None:
+                        self.thread_profilers.append(profiler)
+
+    def dump_profile(self, profilers: List[cProfile.Profile], snapshot: tracemalloc.Snapshot, duration_s: float, current_bytes: int, peak_bytes: int) -> None:
+        try:
+            os.makedirs(self.conf.profile_dir, exist_ok=True)
+            file_path_base = os.path.join(self.conf.profile_dir, f"{self.relay}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+
+            # Raw stats can be loaded in pstats, snakeviz and similar tools
+            pstats.Stats(*profilers).dump_stats(f"{file_path_base}.pstats")
+
+            report = io.StringIO()
+            report.write(f"Profile of {self.relay} cycle, duration: {duration_s:.3f}s, worker threads: {len(profilers) - 1}\n\n")
+            for sort_key in ("cumulative", "tottime"):
+                report.write(f"=== CPU, sorted by {sort_key} ===\n")
+                pstats.Stats(*profilers, stream=report).strip_dirs().sort_stats(sort_key).print_stats(self.conf.profile_stats_lines)
+
+            snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")))
+            report.write(f"=== Allocations, traced memory at end of cycle: {current_bytes / 1024:.1f}KiB, peak during cycle: {peak_bytes / 1024:.1f}KiB ===\n")
+            for stat in snapshot.statistics("lineno")[: self.conf.profile_top_allocations]:
+                report.write(f"{stat}\n")
+
+            with open(f"{file_path_base}.txt", "w", encoding="utf-8") as report_file:
+                report_file.write(report.getvalue())
+
+            self.logger.info(f"Wrote {self.relay} cycle profile to {file_path_base}.txt and {file_path_base}.pstats")
+        except Exception as e:
+            self.logger.exception(f"Error writing {self.relay} cycle profile: {e}")
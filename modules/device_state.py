@@ -0,0 +1,99 @@
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+from modules.conf_models import PyFusionSolarSettings
+
+
+class DeviceStateStore:
+    """
+    Last accepted value and timestamp per device and field, used by the stream filters.
+    Lookups and updates are dict operations, changed entries are written to a SQLite file in
+    one transaction per cycle, so the filters continue where they left off after a restart.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger):
+        self.conf = conf
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.states: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self.dirty = set()
+        # Resolved once, relative to the working directory at startup
+        self.state_file_path = os.path.abspath(conf.device_state_file) if conf.device_state_file else ""
+        # Replays start from an empty state, so their output does not depend on earlier live runs
+        self.persistent = bool(self.state_file_path) and conf.capture_mode != "replay"
+        if self.persistent:
+            self.load()
+        self.logger.debug("DeviceStateStore class instantiated")
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.state_file_path, timeout=10)
+
+    def load(self) -> None:
+        state_dir = os.path.dirname(self.state_file_path)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        try:
+            with self.connect() as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS device_state (device_key TEXT NOT NULL, field TEXT NOT NULL, value REAL NOT NULL, timestamp REAL NOT NULL, PRIMARY KEY (device_key, field))")
+                for device_key, field, value, timestamp in connection.execute("SELECT device_key, field, value, timestamp FROM device_state"):
+                    self.states[(device_key, field)] = (value, timestamp)
+            self.logger.info(f"Loaded state of {len(self.states)} device field(s) from {self.state_file_path}")
+        except Exception as e:
+            self.logger.exception(f"Error loading device state from {self.state_file_path}, starting with an empty state: {e}")
+
+    def get(self, device_key: str, field: str) -> Optional[Tuple[float, float]]:
+        """
+        Returns the last (value, timestamp) of the device field, or None if it was never set.
+        """
+        return self.states.get((device_key, field))
+
+    def set(self, device_key: str, field: str, value: float, timestamp: float) -> None:
+        with self.lock:
+            self.states[(device_key, field)] = (value, timestamp)
+            self.dirty.add((device_key, field))
+
+    def flush(self) -> None:
+        """
+        Write the changed entries to the state file. Called at the end of each cycle and on shutdown.
+        """
+        with self.lock:
+            if not self.persistent or not self.dirty:
+                return
+            rows = [(device_key, field, *self.states[(device_key, field)]) for device_key, field in self.dirty]
+            self.dirty = set()
+        try:
+            with self.connect() as connection:
+                connection.executemany(
+                    "INSERT INTO device_state (device_key, field, value, timestamp) VALUES (?, ?, ?, ?) ON CONFLICT(device_key, field) DO UPDATE SET value = excluded.value, timestamp = excluded.timestamp", rows
+                )
+        except Exception as e:
+            # Written again on the next flush, entries changed meanwhile are still marked dirty
+            with self.lock:
+                self.dirty.update((device_key, field) for device_key, field, _, _ in rows)
+            self.logger.exception(f"Error writing device state to {self.state_file_path}: {e}")
+
+
+device_state_store_lock = threading.Lock()
+device_state_store = None
+
+
+def get_device_state_store(conf: PyFusionSolarSettings, logger: logging.Logger) -> DeviceStateStore:
+    """
+    Process wide store shared by all relays, so a process loads and writes the state file once.
+    """
+    global device_state_store
+    with device_state_store_lock:
+        if device_state_store is None:
+            device_state_store = DeviceStateStore(conf, logger)
+        return device_state_store
+
+
+def flush_device_state_store() -> None:
+    """
+    Write the pending state of the process wide store, if one was created. Called on shutdown.
+    """
+    with device_state_store_lock:
+        if device_state_store is not None:
+            device_state_store.flush()
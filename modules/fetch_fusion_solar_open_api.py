@@ -1,26 +1,98 @@
 import json
 import os
 import logging
+import re
 import time
-from typing import Any, Dict, Optional
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import zip_longest
+from typing import Any, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
 import requests
-from modules.decorators import rate_limit
-from modules.conf_models import PyFusionSolarSettings, FusionSolarOpenApiInverterSettings
+from modules.http_transport import make_http_transport
+from modules.metrics import metrics
+from modules.request_planner import spread_requests
+from modules.scheduling import cron_interval_seconds
+from modules.sharding import get_shard_coordinator
+from modules.stream_filters import StreamFilters
+from modules.conf_models import PyFusionSolarSettings, FusionSolarOpenApiAccountSettings, FusionSolarOpenApiInverterSettings
 from modules.models import *
 
 DEVICE_CACHE_FILE_PATH = "cache/fusion_solar_openapi_devices.json"
 STATION_CACHE_FILE_PATH = "cache/fusion_solar_openapi_stations.json"
 CACHE_EXPIRATION_SECONDS = 24 * 3600  # 24 hours in seconds
+# Name of the account built from the single fusionsolar_open_api_user_name/system_code settings
+DEFAULT_ACCOUNT_NAME = "default"
+# getDevRealKpi limit, devices per request
+REALKPI_MAX_DEVICES_PER_CALL = 100
+# getDevHistoryKpi limits, devices per request and time range per request
+HISTORY_MAX_DEVICES_PER_CALL = 10
+HISTORY_MAX_WINDOW_SECONDS = 3 * 24 * 3600
+
+
+@dataclass(frozen=True)
+class OpenApiDeviceType:
+    """
+    A device type polled over getDevRealKpi, add an entry to OPEN_API_DEVICE_TYPES and a parse method to poll another type.
+    """
+
+    dev_type_id: int
+    measurement_type: str
+    parse_method: str
+
+
+OPEN_API_DEVICE_TYPES = (
+    OpenApiDeviceType(dev_type_id=1, measurement_type="inverter", parse_method="_parse_inverter_device_kpis"),
+    OpenApiDeviceType(dev_type_id=17, measurement_type="grid_meter", parse_method="_parse_grid_meter_device_kpis"),
+)
+OPEN_API_DEVICE_TYPES_BY_ID = {device_type.dev_type_id: device_type for device_type in OPEN_API_DEVICE_TYPES}
+
+
+@dataclass(frozen=True)
+class PlannedRequest:
+    offset_s: float
+    device_type: OpenApiDeviceType
+    device_ids: List[str]
+    # Set on the last request of the device type in the cycle
+    last_of_type: bool
 
 
 class FetchFusionSolarOpenApi:
-    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger):
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, account: Optional[FusionSolarOpenApiAccountSettings] = None):
         self.conf = conf
         self.logger = logger
+        self.account = account if account is not None else make_default_open_api_account(conf)
+        self.account_name = self.account.descriptive_name
+        self.api_url = self.account.api_url or self.conf.fusionsolar_open_api_url
         self.jwt_token = ""
         self.station_list = []
         self.device_list = []
-        self.logger.debug("FetchFusionSolarOpenApi class instantiated")
+        self.stations_by_code = {}
+        self.devices_by_id = {}
+        # Time of the last getDevRealKpi request per devTypeId
+        self.last_request_times: Dict[int, float] = {}
+        self.update_device_settings()
+        self.shards = get_shard_coordinator(conf, logger, "fusionsolar_open_api")
+        self.filters = StreamFilters(conf, logger, "fusionsolar_open_api")
+
+        # The default account keeps the original cache file names and capture source
+        if self.account_name == DEFAULT_ACCOUNT_NAME:
+            self.station_cache_file_path = STATION_CACHE_FILE_PATH
+            self.device_cache_file_path = DEVICE_CACHE_FILE_PATH
+            self.transport = make_http_transport(conf, logger, "fusionsolar_open_api")
+        else:
+            file_safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", self.account_name)
+            self.station_cache_file_path = f"cache/fusion_solar_openapi_{file_safe_name}_stations.json"
+            self.device_cache_file_path = f"cache/fusion_solar_openapi_{file_safe_name}_devices.json"
+            self.transport = make_http_transport(conf, logger, f"fusionsolar_open_api_{file_safe_name}")
+        self.logger.debug(f"FetchFusionSolarOpenApi class instantiated for account {self.account_name}")
+
+    def update_device_settings(self) -> None:
+        """
+        Index the configured inverters and meters by dev_id, called at init and on config reload.
+        """
+        self.inverter_conf_by_dev_id = {inverter.dev_id: inverter for inverter in self.conf.fusionsolar_open_api_inverters}
+        self.meter_conf_by_dev_id = {meter.dev_id: meter for meter in self.conf.fusionsolar_open_api_meters}
 
     def update_station_list(self, force_api_update: bool = False) -> None:
         """
@@ -32,12 +104,16 @@ class FetchFusionSolarOpenApi:
         :param force_api_update: If True, always ignore the cache and call the FusionSolar OpenAPI.
         """
         # According to your requirement, /thirdData/getStationList does NOT need a request body.
-        response = self._fetch_and_cache_fusionsolar_data(force_api_update=force_api_update, endpoint="/thirdData/getStationList", request_data=None, cache_file_path=STATION_CACHE_FILE_PATH)
+        response = self._fetch_and_cache_fusionsolar_data(force_api_update=force_api_update, endpoint="/thirdData/getStationList", request_data=None, cache_file_path=self.station_cache_file_path)
         self.station_list = response.get("data", [])
+        self.stations_by_code = {station.get("stationCode"): station for station in self.station_list}
 
-        self.logger.info("Current FusionSolar OpenAPI stations:")
+        self.logger.info(f"Loaded {len(self.station_list)} FusionSolar OpenAPI station(s) for account {self.account_name}, listed with debug_mode")
+        # Listed at debug level, one line per station costs more than the relaying itself on large fleets
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
         for station in self.station_list:
-            self.logger.info(
+            self.logger.debug(
                 f"stationName: {station.get('stationName','')}, stationCode: {station.get('stationCode','')}, capacity: {station.get('capacity','')}MW, stationAddr: {station.get('stationAddr','')}, stationLinkman: {station.get('stationLinkman','')}"
             )
 
@@ -57,38 +133,179 @@ class FetchFusionSolarOpenApi:
         stations_str = ",".join(item["stationCode"] for item in self.station_list if "stationCode" in item)
         data = {"stationCodes": stations_str}
 
-        response = self._fetch_and_cache_fusionsolar_data(force_api_update=force_api_update, endpoint="/thirdData/getDevList", request_data=data, cache_file_path=DEVICE_CACHE_FILE_PATH)
+        response = self._fetch_and_cache_fusionsolar_data(force_api_update=force_api_update, endpoint="/thirdData/getDevList", request_data=data, cache_file_path=self.device_cache_file_path)
         self.device_list = response.get("data", [])
+        self.devices_by_id = {device.get("id"): device for device in self.device_list}
 
-        self.logger.info("Current FusionSolar OpenAPI devices:")
+        self.logger.info(f"Loaded {len(self.device_list)} FusionSolar OpenAPI device(s) for account {self.account_name}, listed with debug_mode")
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
         for device in self.device_list:
-            self.logger.info(
+            self.logger.debug(
                 f"devDn: {device.get('devDn','')}, devName: {device.get('devName','')}, id: {device.get('id','')}, stationCode: {device.get('stationCode','')}, devTypeId: {device.get('devTypeId','')}, model: {device.get('model','')}"
             )
 
-    @rate_limit(max_calls=1, period=60)
-    def fetch_fusionsolar_inverter_device_kpis(self) -> List[FusionSolarInverterMeasurement]:
+    def polled_device_ids(self, dev_type_id: int) -> List[str]:
+        """
+        Ids of the devices of the given type polled by this instance.
+        With sharding, only devices of stations owned by this instance are polled. Ownership is evaluated every cycle, so stations rebalance when instances join or leave.
+        """
+        return [str(item["id"]) for item in self.device_list if "id" in item and item.get("devTypeId") == dev_type_id and self.shards.owns(item.get("stationCode"))]
+
+    def history_watermark_key(self, dev_type_id: int) -> Tuple[str, str]:
+        return f"openapi_account/{self.account_name}", f"history_watermark_{dev_type_id}"
+
+    def history_cursor_key(self, dev_type_id: int) -> Tuple[str, str]:
+        # Stored as (next device batch index, window start), the progress within a window which takes more than one cycle
+        return f"openapi_account/{self.account_name}", f"history_cursor_{dev_type_id}"
+
+    def history_gap_seconds(self) -> float:
+        # Defaults to two cron intervals, so one late cycle is not a gap
+        return self.conf.fusionsolar_open_api_backfill_gap_seconds or 2 * (cron_interval_seconds(self.conf.fusionsolar_open_api_cron_hour, self.conf.fusionsolar_open_api_cron_minute) or 300)
+
+    def advance_history_watermark(self, dev_type_id: int, timestamp: float) -> None:
         """
-        Retrieve real-time KPIs from the FusionSolar OpenAPI.
-        Uses rate limiting to avoid frequent calls.
+        Record a successful realtime poll. The watermark is the time up to which measurements are complete, after a gap it
+        stays behind until the history backfill caught up.
+        """
+        device_key, field = self.history_watermark_key(dev_type_id)
+        watermark = self.filters.store.get(device_key, field)
+        if watermark is None or not self.conf.fusionsolar_open_api_backfill_enabled or timestamp - watermark[0] <= self.history_gap_seconds():
+            self.filters.store.set(device_key, field, timestamp, timestamp)
 
-        :return: A list of FusionSolarInverterKpi objects containing inverter metrics.
+    def plan_history_calls(self, dev_type_id: int, now: float) -> List[Tuple[float, float, int, List[str]]]:
         """
-        self.logger.info(f"Requesting inverter realtimeKpi's from FusionSolarOpenAPI.")
+        Plan the getDevHistoryKpi calls which fill the gap between the watermark and now, oldest window first.
+        The minimum number of calls within the API limits: windows of at most 3 days, times batches of at most 10 devices.
+        A window left unfinished by the previous cycle is resumed at the next device batch of the cursor.
+
+        :return: A list of (window_start, window_end, batch_idx, device_ids) tuples.
+        """
+        device_key, field = self.history_watermark_key(dev_type_id)
+        watermark = self.filters.store.get(device_key, field)
+        if watermark is None:
+            return []
+        device_ids = self.polled_device_ids(dev_type_id)
+        device_batches = [device_ids[idx : idx + HISTORY_MAX_DEVICES_PER_CALL] for idx in range(0, len(device_ids), HISTORY_MAX_DEVICES_PER_CALL)]
+
+        cursor = self.filters.store.get(*self.history_cursor_key(dev_type_id))
+        if cursor is not None and 0 < cursor[0] < len(device_batches) and watermark[0] <= cursor[1] < now:
+            # Resumed as planned before, also when the window start is older than backfill_max_days by now
+            start_time, first_batch_idx = cursor[1], int(cursor[0])
+        else:
+            start_time, first_batch_idx = max(watermark[0], now - self.conf.fusionsolar_open_api_backfill_max_days * 24 * 3600), 0
+            if now - start_time <= self.history_gap_seconds():
+                return []
+
+        planned_calls = []
+        window_start = start_time
+        while window_start < now:
+            window_end = min(window_start + HISTORY_MAX_WINDOW_SECONDS, now)
+            planned_calls.extend((window_start, window_end, batch_idx, device_batches[batch_idx]) for batch_idx in range(first_batch_idx, len(device_batches)))
+            window_start, first_batch_idx = window_end, 0
+        return planned_calls
+
+    def fetch_device_history_kpis(self, dev_type_id: int) -> List[Union[FusionSolarInverterMeasurement, FusionSolarMeterMeasurement]]:
+        """
+        Recover the measurements of missed cycles from the 5 minute device history, starting at the watermark.
+        At most fusionsolar_open_api_backfill_max_calls_per_cycle calls are made per cycle, the watermark advances
+        after each completed window and the cursor after each device batch, so a long gap is filled over multiple cycles.
+
+        :param dev_type_id: One of the registered OPEN_API_DEVICE_TYPES.
+        :return: Measurements with their original timestamps, oldest first.
+        """
+        if not self.conf.fusionsolar_open_api_backfill_enabled:
+            return []
+        if not self.device_list:
+            self.update_device_list()
+
+        planned_calls = self.plan_history_calls(dev_type_id, self.transport.now())
+        if not planned_calls:
+            return []
+        max_calls = self.conf.fusionsolar_open_api_backfill_max_calls_per_cycle
+        self.logger.info(
+            f"Backfilling devTypeId {dev_type_id} history for account {self.account_name} from {datetime.fromtimestamp(planned_calls[0][0])}, "
+            f"{len(planned_calls)} history call(s) planned, up to {max_calls} this cycle"
+        )
+
+        url = f"{self.api_url}/thirdData/getDevHistoryKpi"
+        device_key, field = self.history_watermark_key(dev_type_id)
+        cursor_device_key, cursor_field = self.history_cursor_key(dev_type_id)
+        history_measurements = []
+        for call_idx, (window_start, window_end, batch_idx, device_batch) in enumerate(planned_calls):
+            if call_idx >= max_calls:
+                self.logger.info(f"Backfill call budget used, {len(planned_calls) - call_idx} history call(s) of account {self.account_name} left for the next cycles")
+                break
+            data = {"devTypeId": dev_type_id, "devIds": ",".join(device_batch), "startTime": int(window_start * 1000), "endTime": int(window_end * 1000)}
+            response_json = self._fetch_fusionsolar_data_request(url, data)
+            api_measurement_list = response_json.get("data") or []
+            with metrics.timer("parse_seconds", stage="parse", source="fusionsolar_open_api"):
+                history_measurements.extend(getattr(self, OPEN_API_DEVICE_TYPES_BY_ID[dev_type_id].parse_method)(api_measurement_list, data_source="openapi_history"))
+
+            # All device batches of this window are done
+            if call_idx + 1 == len(planned_calls) or planned_calls[call_idx + 1][0] != window_start:
+                self.filters.store.set(device_key, field, window_end, window_end)
+                self.filters.store.set(cursor_device_key, cursor_field, 0, window_end)
+            else:
+                self.filters.store.set(cursor_device_key, cursor_field, batch_idx + 1, window_start)
 
+        return history_measurements
+
+    def plan_realtime_requests(self, window_s: float, min_interval_s: float) -> List[PlannedRequest]:
+        """
+        Plan the getDevRealKpi requests of a cycle for all registered device types, in batches of at most 100 devices.
+        Device types are interleaved and the requests spread over the window, with at least min_interval_s between
+        requests of the same device type, also across cycles.
+        """
         # Ensure the device list is populated
         if not self.device_list:
             self.update_device_list()
 
-        url = f"{self.conf.fusionsolar_open_api_url}/thirdData/getDevRealKpi"
-        devices_str = ",".join(str(item["id"]) for item in self.device_list if "id" in item and "devTypeId" in item and item["devTypeId"] == 1)
-        data = {"devTypeId": 1, "devIds": devices_str}
+        batches_by_type = []
+        for device_type in OPEN_API_DEVICE_TYPES:
+            device_ids = self.polled_device_ids(device_type.dev_type_id)
+            if not device_ids:
+                self.logger.info(f"No devices with devTypeId {device_type.dev_type_id} to poll for account {self.account_name}")
+                continue
+            batches_by_type.append([(device_type, device_ids[idx : idx + REALKPI_MAX_DEVICES_PER_CALL]) for idx in range(0, len(device_ids), REALKPI_MAX_DEVICES_PER_CALL)])
+
+        # Round robin over the device types, so batches of one type are separated by batches of the others
+        planned_batches = [batch for batch_round in zip_longest(*batches_by_type) for batch in batch_round if batch is not None]
+        # Request times are on the transport clock, the capture time when replaying
+        now = self.transport.now()
+        earliest_offsets = {dev_type_id: last_request_time + min_interval_s - now for dev_type_id, last_request_time in self.last_request_times.items()}
+        offsets = spread_requests([device_type.dev_type_id for device_type, _ in planned_batches], window_s, min_interval_s, earliest_offsets)
+
+        last_request_idx_by_type = {device_type.dev_type_id: request_idx for request_idx, (device_type, _) in enumerate(planned_batches)}
+        return [
+            PlannedRequest(offset_s=offset, device_type=device_type, device_ids=device_ids, last_of_type=last_request_idx_by_type[device_type.dev_type_id] == request_idx)
+            for request_idx, (offset, (device_type, device_ids)) in enumerate(zip(offsets, planned_batches))
+        ]
+
+    def fetch_device_kpis(self, device_type: OpenApiDeviceType, device_ids: List[str]) -> List[Union[FusionSolarInverterMeasurement, FusionSolarMeterMeasurement]]:
+        """
+        Retrieve real-time KPIs of a batch of devices of one type from the FusionSolar OpenAPI.
+        Requests are paced by plan_realtime_requests to stay within the flow control quota.
+
+        :return: A list of measurements of the device type's model.
+        """
+        self.logger.info(f"Requesting {device_type.measurement_type} realtimeKpi's of {len(device_ids)} device(s) from FusionSolarOpenAPI for account {self.account_name}.")
+        self.last_request_times[device_type.dev_type_id] = self.transport.now()
 
+        url = f"{self.api_url}/thirdData/getDevRealKpi"
+        data = {"devTypeId": device_type.dev_type_id, "devIds": ",".join(device_ids)}
         response_json = self._fetch_fusionsolar_data_request(url, data)
         api_measurement_list = response_json.get("data", [])
 
+        with metrics.timer("parse_seconds", stage="parse", source="fusionsolar_open_api"):
+            return getattr(self, device_type.parse_method)(api_measurement_list)
+
+    def _parse_inverter_device_kpis(self, api_measurement_list: List[Dict[str, Any]], data_source: str = "openapi_realkpi") -> List[FusionSolarInverterMeasurement]:
+        realtime_timestamp = self.transport.now()
         inverter_measurements = []
         for api_measurement in api_measurement_list:
+            # History records carry their collect time in milliseconds
+            measurement_timestamp = api_measurement["collectTime"] / 1000 if "collectTime" in api_measurement else realtime_timestamp
             try:
                 real_time_power_w = float(api_measurement["dataItemMap"]["active_power"]) * 1000
                 lifetime_energy_wh = float(api_measurement["dataItemMap"]["total_cap"]) * 1000
@@ -103,11 +320,14 @@ class FetchFusionSolarOpenApi:
                 self.logger.warning(f"Failed to parse FusionSolarOpenAPI grid meter measurements, value None? This happens if a device is inactive or disabled. Skipping this device. {typ_err}")
                 continue
 
+            if data_source == "openapi_realkpi":
+                # History records are older than the counter state, they are not filtered
+                lifetime_energy_wh = self.filters.counter(f"openapi/{api_measurement['devId']}", "lifetime_energy_wh", lifetime_energy_wh, measurement_timestamp)
             self.logger.debug(f"Metrics after transformations: realTimePowerW={real_time_power_w}, lifetimeEnergyWh={lifetime_energy_wh}, dailyEnergyWh={daily_energy_wh}")
 
-            matching_device = next((dev for dev in self.device_list if dev.get("id") == api_measurement["devId"]), None)
-            matching_station = next((stat for stat in self.station_list if stat.get("stationCode") == matching_device["stationCode"]), None)
-            matching_conf = next((inv for inv in self.conf.fusionsolar_open_api_inverters if inv.dev_id == str(api_measurement["devId"])), None)
+            matching_device = self.devices_by_id.get(api_measurement["devId"])
+            matching_station = self.stations_by_code.get(matching_device["stationCode"])
+            matching_conf = self.inverter_conf_by_dev_id.get(str(api_measurement["devId"]))
 
             station_dn = matching_device.get("stationCode", "")
             station_name = matching_station.get("stationName", "")
@@ -121,7 +341,7 @@ class FetchFusionSolarOpenApi:
             api_measurement = FusionSolarInverterMeasurement(
                 settings=matching_conf,
                 measurement_type="inverter",
-                data_source="openapi_realkpi",
+                data_source=data_source,
                 station_name=station_name,
                 station_dn=station_dn,
                 device_dn=device_dn,
@@ -131,42 +351,24 @@ class FetchFusionSolarOpenApi:
                 real_time_power_w=real_time_power_w,
                 lifetime_energy_wh=lifetime_energy_wh,
                 day_energy_wh=daily_energy_wh,
+                timestamp=measurement_timestamp,
             )
 
             inverter_measurements.append(api_measurement)
 
         return inverter_measurements
 
-    @rate_limit(max_calls=1, period=60)
-    def fetch_fusionsolar_grid_meter_device_kpis(self) -> List[FusionSolarMeterMeasurement]:
-        """
-        Retrieve real-time KPIs from the FusionSolar OpenAPI.
-        Uses rate limiting to avoid frequent calls.
-
-        :return: A list of FusionSolarMeterKpi objects containing inverter metrics.
-        """
-        self.logger.info(f"Requesting inverter realtimeKpi's from FusionSolarOpenAPI.")
-
-        # Ensure the device list is populated
-        if not self.device_list:
-            self.update_device_list()
-
-        url = f"{self.conf.fusionsolar_open_api_url}/thirdData/getDevRealKpi"
-        devices_str = ",".join(str(item["id"]) for item in self.device_list if "id" in item and "devTypeId" in item and item["devTypeId"] == 17)
-        data = {"devTypeId": 17, "devIds": devices_str}
-
-        response_json = self._fetch_fusionsolar_data_request(url, data)
-        api_measurement_list = response_json.get("data", [])
-
+    def _parse_grid_meter_device_kpis(self, api_measurement_list: List[Dict[str, Any]], data_source: str = "openapi_realkpi") -> List[FusionSolarMeterMeasurement]:
+        realtime_timestamp = self.transport.now()
         inverter_measurements = []
         for api_measurement in api_measurement_list:
+            measurement_timestamp = api_measurement["collectTime"] / 1000 if "collectTime" in api_measurement else realtime_timestamp
             try:
                 # Do not multiply by 1000, fusionsolar returns W instead of kW despite docs saying kW
                 active_power_w = float(api_measurement["dataItemMap"]["active_power"])
 
                 # Fix for fusionsolar meter device quirk, set to 0 of power drawn is greater than 16bits maxout (66.55MW) plus 10MW pv capacity
-                quirk_threshold_w = float(-66553500 + 10000000)
-                active_power_w = 0 if active_power_w < quirk_threshold_w else active_power_w
+                active_power_w = self.filters.quirk_threshold(f"openapi/{api_measurement['devId']}", "active_power_w", active_power_w, self.conf.stream_filter_grid_meter_quirk_threshold_w)
 
             except KeyError as missing_key:
                 self.logger.error(f"Key '{missing_key}' is missing from FusionSolarOpenAPI grid meter measurement. Skipping this device.")
@@ -180,9 +382,9 @@ class FetchFusionSolarOpenApi:
 
             self.logger.debug(f"Metrics after transformations: realTimePowerW={active_power_w}")
 
-            matching_device = next((dev for dev in self.device_list if dev.get("id") == api_measurement["devId"]), None)
-            matching_station = next((stat for stat in self.station_list if stat.get("stationCode") == matching_device["stationCode"]), None)
-            matching_conf = next((inv for inv in self.conf.fusionsolar_open_api_meters if inv.dev_id == str(api_measurement["devId"])), None)
+            matching_device = self.devices_by_id.get(api_measurement["devId"])
+            matching_station = self.stations_by_code.get(matching_device["stationCode"])
+            matching_conf = self.meter_conf_by_dev_id.get(str(api_measurement["devId"]))
 
             station_dn = matching_device.get("stationCode", "")
             station_name = matching_station.get("stationName", "")
@@ -196,7 +398,7 @@ class FetchFusionSolarOpenApi:
             api_measurement = FusionSolarMeterMeasurement(
                 settings=matching_conf,
                 measurement_type="grid_meter",
-                data_source="openapi_realkpi",
+                data_source=data_source,
                 station_name=station_name,
                 station_dn=station_dn,
                 device_dn=device_dn,
@@ -204,6 +406,7 @@ class FetchFusionSolarOpenApi:
                 device_model=device_model,
                 device_id=device_id,
                 active_power_w=active_power_w,
+                timestamp=measurement_timestamp,
             )
 
             inverter_measurements.append(api_measurement)
@@ -223,7 +426,7 @@ class FetchFusionSolarOpenApi:
         self.logger.info(f"Updating data from FusionSolar API with endpoint: {endpoint}, cache path: {cache_file_path}")
 
         # 1. Check for an existing cache file if we're not forcing an update.
-        if not force_api_update and os.path.isfile(cache_file_path):
+        if not force_api_update and self.transport.live and os.path.isfile(cache_file_path):
             try:
                 with open(cache_file_path, "r", encoding="utf-8") as cache_file:
                     cache_content = json.load(cache_file)
@@ -248,7 +451,7 @@ class FetchFusionSolarOpenApi:
 
         # 2. If cache is invalid, expired, or force_api_update is True, call the API.
         self.logger.info("Fetching data from FusionSolar OpenAPI...")
-        url = f"{self.conf.fusionsolar_open_api_url}{endpoint}"
+        url = f"{self.api_url}{endpoint}"
 
         try:
             response_json = self._fetch_fusionsolar_data_request(url, request_data)
@@ -256,6 +459,9 @@ class FetchFusionSolarOpenApi:
             raise Exception(f"Error fetching data from FusionSolar OpenAPI. Info: {exc}")
 
         # 3. Write the updated response to the cache file with a timestamp.
+        if not self.transport.live:
+            return response_json
+
         try:
             cache_content = {"timestamp": time.time(), "api_response": response_json}
             with open(cache_file_path, "w", encoding="utf-8") as cache_file:
@@ -277,8 +483,9 @@ class FetchFusionSolarOpenApi:
         :return: A dictionary representing the JSON response.
         """
         try:
-            response = self._request_with_token_retry(url, method="POST", json=data)
-            response.raise_for_status()
+            with metrics.timer("fetch_seconds", stage="fetch", source="fusionsolar_open_api", endpoint=urlparse(url).path):
+                response = self._request_with_token_retry(url, method="POST", json=data)
+                response.raise_for_status()
         except Exception as exc:
             raise Exception(f"Error in FusionSolarOpenAPI HTTP request. Error info: {exc}")
 
@@ -300,13 +507,14 @@ class FetchFusionSolarOpenApi:
         Obtain or refresh the JWT token from the FusionSolar OpenAPI and store it
         for subsequent requests.
         """
-        token_url = f"{self.conf.fusionsolar_open_api_url}/thirdData/login"
+        token_url = f"{self.api_url}/thirdData/login"
         headers = {"Content-Type": "application/json"}
-        data = {"userName": self.conf.fusionsolar_open_api_user_name, "systemCode": self.conf.fusionsolar_open_api_system_code}
+        data = {"userName": self.account.user_name, "systemCode": self.account.system_code}
 
         try:
-            self.logger.info(f"Requesting JWT authentication token from {token_url}")
-            response = requests.post(token_url, json=data, headers=headers, verify=False)
+            self.logger.info(f"Requesting JWT authentication token from {token_url} for account {self.account_name}")
+            metrics.inc("api_requests_total", api="fusionsolar_open_api", endpoint=urlparse(token_url).path, account=self.account_name)
+            response = self.transport.post(token_url, json=data, headers=headers, verify=False)
             response.raise_for_status()
 
             # Attempt to parse the top-level JSON.
@@ -346,10 +554,12 @@ class FetchFusionSolarOpenApi:
         headers = kwargs.pop("headers", {})
         headers["XSRF-TOKEN"] = self.jwt_token
         headers.setdefault("Content-Type", "application/json")
+        endpoint = urlparse(url).path
 
         for attempt in range(2):
             self.logger.debug(f"Fetching URL: {url} (attempt {attempt + 1})")
-            response = requests.request(method.upper(), url, headers=headers, verify=False, **kwargs)
+            metrics.inc("api_requests_total", api="fusionsolar_open_api", endpoint=endpoint, account=self.account_name)
+            response = self.transport.request(method.upper(), url, headers=headers, verify=False, **kwargs)
             response.raise_for_status()
 
             # Check JSON content for success status
@@ -365,6 +575,8 @@ class FetchFusionSolarOpenApi:
 
             # If there's a failCode and it's 305 -> token needs refresh
             if "failCode" in response_json:
+                if not response_json.get("success"):
+                    metrics.inc("api_fail_codes_total", api="fusionsolar_open_api", endpoint=endpoint, account=self.account_name, fail_code=response_json["failCode"])
                 if (not response_json.get("success")) and response_json["failCode"] == 305:
                     self.logger.debug("FusionSolar: JWT token expired or invalid. Refreshing token...")
                     self.update_open_api_token()
@@ -383,3 +595,18 @@ class FetchFusionSolarOpenApi:
                 break
 
         return response
+
+
+def make_default_open_api_account(conf: PyFusionSolarSettings) -> FusionSolarOpenApiAccountSettings:
+    return FusionSolarOpenApiAccountSettings(
+        descriptive_name=DEFAULT_ACCOUNT_NAME, api_url=conf.fusionsolar_open_api_url, user_name=conf.fusionsolar_open_api_user_name, system_code=conf.fusionsolar_open_api_system_code
+    )
+
+
+def get_open_api_accounts(conf: PyFusionSolarSettings) -> List[FusionSolarOpenApiAccountSettings]:
+    """
+    Configured OpenAPI accounts, or the single account from fusionsolar_open_api_user_name/system_code if none are configured.
+    """
+    if conf.fusionsolar_open_api_accounts:
+        return conf.fusionsolar_open_api_accounts
+    return [make_default_open_api_account(conf)]
@@ -1,6 +1,9 @@
 import requests
 import json
 import html
+from modules.http_transport import make_http_transport
+from modules.metrics import metrics
+from modules.stream_filters import StreamFilters
 from modules.conf_models import PyFusionSolarSettings, FusionSolarKioskSettings
 from modules.models import *
 
@@ -9,22 +12,30 @@ class FetchFusionSolarKiosk:
     def __init__(self, conf: PyFusionSolarSettings, logger):
         self.conf = conf
         self.logger = logger
-        self.last_lifetime_energy_wh = 0
+        self.filters = StreamFilters(conf, logger, "fusionsolar_kiosk")
+        self.transport = make_http_transport(conf, logger, "fusionsolar_kiosk")
         self.logger.debug("FetchFusionSolarKiosk class instantiated")
 
     def fetch_fusionsolar_status(self, kiosk_settings: FusionSolarKioskSettings) -> FusionSolarInverterMeasurement:
-        self.logger.info(f"Requesting data for {kiosk_settings.descriptive_name} kkid={kiosk_settings.api_kkid} from FetchFusionSolarKiosk API...")
+        self.logger.debug(f"Requesting data for {kiosk_settings.descriptive_name} kkid={kiosk_settings.api_kkid} from FetchFusionSolarKiosk API...")
 
         # Fetch the data.
         try:
-            response = requests.get(
-                f"{kiosk_settings.api_url}{kiosk_settings.api_kkid}",
-                verify=False,
-            )
-            response.raise_for_status()
+            metrics.inc("api_requests_total", api="fusionsolar_kiosk", endpoint="station-kiosk-file")
+            with metrics.timer("fetch_seconds", stage="fetch", source="fusionsolar_kiosk", endpoint="station-kiosk-file"):
+                response = self.transport.get(
+                    f"{kiosk_settings.api_url}{kiosk_settings.api_kkid}",
+                    verify=False,
+                )
+                response.raise_for_status()
         except Exception as e:
             raise Exception(f"Error in FetchFusionSolarKiosk API HTTP request. Error info: {e}")
 
+        with metrics.timer("parse_seconds", stage="parse", source="fusionsolar_kiosk"):
+            return self._parse_fusionsolar_status(kiosk_settings, response)
+
+    def _parse_fusionsolar_status(self, kiosk_settings: FusionSolarKioskSettings, response: requests.Response) -> FusionSolarInverterMeasurement:
+
         # Attempt to parse the top-level JSON.
         try:
             response_json = response.json()
@@ -59,11 +70,9 @@ class FetchFusionSolarKiosk:
         except TypeError as typ_err:
             raise Exception(f"Failed to convert FusionSolarOpenAPI data values to float, value None? {typ_err}")
 
-        # Set this to fix fusionsolar quirk where cumulativeEnergy will decrease with the days amount of solar production
-        if self.last_lifetime_energy_wh != 0 and lifetime_energy_wh < self.last_lifetime_energy_wh:
-            lifetime_energy_wh = self.last_lifetime_energy_wh
-        else:
-            self.last_lifetime_energy_wh = lifetime_energy_wh
+        # Per kiosk, fixes the fusionsolar quirk where cumulativeEnergy will decrease with the days amount of solar production
+        measurement_timestamp = self.transport.now()
+        lifetime_energy_wh = self.filters.counter(f"kiosk/{kiosk_settings.api_kkid}", "lifetime_energy_wh", lifetime_energy_wh, measurement_timestamp)
 
         # Extract station information.
         try:
@@ -86,6 +95,7 @@ class FetchFusionSolarKiosk:
             real_time_power_w=real_time_power_w,
             lifetime_energy_wh=lifetime_energy_wh,
             day_energy_wh=daily_energy_wh,
+            timestamp=measurement_timestamp,
         )
 
         return inverter_kpi
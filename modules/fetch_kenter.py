@@ -1,9 +1,13 @@
 import logging
+import re
 import requests
 from datetime import datetime, timedelta
 import json
+from urllib.parse import urlparse
 from modules.conf_models import PyFusionSolarSettings
-from modules.models import KenterTransformerMeasurements, KenterTransformerMeasurement
+from modules.http_transport import make_http_transport
+from modules.metrics import metrics
+from modules.models import KenterTransformerMeasurements
 
 
 class FetchKenter:
@@ -13,6 +17,7 @@ class FetchKenter:
         self.logger.debug("Kenter class instantiated")
         # Token is fetched on demand via _request_with_token_retry rather than at instantiation.
         self.jwt_token = ""
+        self.transport = make_http_transport(conf, logger, "kenter")
 
     def update_kenter_token(self):
         token_url = self.conf.kenter_token_url
@@ -21,7 +26,8 @@ class FetchKenter:
 
         try:
             self.logger.info(f"Requesting JWT authentication token from {token_url}")
-            response = requests.post(token_url, data=form_data, headers=headers, verify=False)
+            metrics.inc("api_requests_total", api="kenter", endpoint=urlparse(token_url).path)
+            response = self.transport.post(token_url, data=form_data, headers=headers, verify=False)
             response.raise_for_status()
             token_response = response.json()
             access_token = token_response.get("access_token")
@@ -38,11 +44,16 @@ class FetchKenter:
         headers = kwargs.pop("headers", {})
         headers["Authorization"] = f"Bearer {self.jwt_token}"
         headers.setdefault("Accept", "application/json")
+        # Replace ids and dates in the path, to keep the number of metric series bounded
+        endpoint = re.sub(r"/\d+", "/{n}", urlparse(url).path)
 
         # Attempt the request up to two times (in case we need to refresh token).
         for attempt in range(2):
             self.logger.debug(f"Fetching URL: {url} (attempt {attempt + 1})")
-            response = requests.request(method.upper(), url, headers=headers, verify=False, **kwargs)
+            metrics.inc("api_requests_total", api="kenter", endpoint=endpoint)
+            response = self.transport.request(method.upper(), url, headers=headers, verify=False, **kwargs)
+            if response.status_code != 200:
+                metrics.inc("api_status_codes_total", api="kenter", endpoint=endpoint, status_code=response.status_code)
             # If not 401 or second attempt, break
             if response.status_code != 401 or attempt == 1:
                 # If there's another error status, it will be caught below
@@ -69,30 +80,35 @@ class FetchKenter:
 
         # Parse and log the connections data
         connections_data = response.json()
-        self.logger.info("Current Kenter connection list:")
+        self.logger.info(f"Loaded {len(connections_data)} Kenter connection(s), listed with debug_mode")
         for connection in connections_data:
             for meteringpoint in connection.get("meteringPoints", []):
-                self.logger.info(
+                self.logger.debug(
                     "connectionId: {}, meteringPointId: {}, productType: {}, "
                     "meteringPointType: {}, meterNumber: {}".format(connection.get("connectionId"), meteringpoint.get("meteringPointId"), meteringpoint.get("productType"), meteringpoint.get("meteringPointType"), meteringpoint.get("meterNumber"))
                 )
 
     def fetch_gridkenter_data(self, descriptive_name, connection_id, metering_point_id, channel_id, days_back) -> KenterTransformerMeasurements:
         # Prepare date
-        req_time = datetime.now() - timedelta(days=days_back)
+        req_time = datetime.fromtimestamp(self.transport.request_time()) - timedelta(days=days_back)
         req_year = req_time.strftime("%Y")
         req_month = req_time.strftime("%m")
         req_day = req_time.strftime("%d")
 
-        self.logger.info(f"Requesting Kenter API meter data for {req_year}/{req_month}/{req_day} [{descriptive_name}], connectionId: [{connection_id}] meteringPointId: [{metering_point_id}]...")
+        self.logger.debug(f"Requesting Kenter API meter data for {req_year}/{req_month}/{req_day} [{descriptive_name}], connectionId: [{connection_id}] meteringPointId: [{metering_point_id}]...")
 
         url = f"{self.conf.kenter_api_url}/meetdata/v2/measurements/connections/" f"{connection_id}/metering-points/{metering_point_id}/days/" f"{req_year}/{req_month}/{req_day}"
 
         try:
-            response = self._request_with_token_retry(url, method="GET")
+            with metrics.timer("fetch_seconds", stage="fetch", source="kenter", endpoint="/meetdata/v2/measurements"):
+                response = self._request_with_token_retry(url, method="GET")
         except Exception as e:
             raise Exception(f"Error in Kenter meter measurement data API HTTP request. Error info: {e}")
 
+        with metrics.timer("parse_seconds", stage="parse", source="kenter"):
+            return self._parse_gridkenter_data(response, descriptive_name, connection_id, metering_point_id, channel_id)
+
+    def _parse_gridkenter_data(self, response: requests.Response, descriptive_name, connection_id, metering_point_id, channel_id) -> KenterTransformerMeasurements:
         # Parse JSON
         try:
             response_json = response.json()
@@ -104,7 +120,7 @@ class FetchKenter:
         if not channel:
             raise FetchKenterMissingChannelId(f"Kenter API response for {descriptive_name}, connectionId {connection_id} and meteringPointId {metering_point_id} does not contain channelId '{channel_id}'.")
 
-        return_obj = KenterTransformerMeasurements(descriptive_name=descriptive_name, connection_id=connection_id, metering_point_id=metering_point_id, channel_id=channel_id, measurements=[])
+        return_obj = KenterTransformerMeasurements(descriptive_name=descriptive_name, connection_id=connection_id, metering_point_id=metering_point_id, channel_id=channel_id)
 
         prev_ts = None
         for measure in channel.get("Measurements", []):
@@ -122,12 +138,10 @@ class FetchKenter:
                 # Calculate power load [kW] from energy [kWh], then convert to W
                 calculated_power = round(measure["value"] * 3600 / seconds_from_prev_ts, 3) * 1000
 
-                return_obj.measurements.append(
-                    KenterTransformerMeasurement(
-                        timestamp=measure["timestamp"],
-                        interval_energy_wh=measure["value"] * 1000,  # in Wh
-                        interval_power_avg_w=calculated_power,  # in W
-                    )
+                return_obj.append(
+                    timestamp=measure["timestamp"],
+                    interval_energy_wh=measure["value"] * 1000,  # in Wh
+                    interval_power_avg_w=calculated_power,  # in W
                 )
 
         return return_obj
@@ -0,0 +1,231 @@
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator
+from urllib.parse import urlparse
+import requests
+from requests.structures import CaseInsensitiveDict
+from modules.conf_models import PyFusionSolarSettings
+
+CAPTURE_MODES = ("off", "record", "replay")
+# Request body keys which are never written to capture files
+REDACTED_REQUEST_KEYS = ("systemCode", "client_secret", "password")
+REPLAY_LOOKAHEAD_ENTRIES = 1000
+
+
+class HttpTransport:
+    """
+    Performs the upstream HTTP requests for a fetcher class. Subclasses record or replay the traffic.
+    """
+
+    # Requests reach the upstream API, so fetchers may use on-disk metadata caches and API pacing
+    live = True
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, source: str):
+        self.conf = conf
+        self.logger = logger
+        self.source = source
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        # Every upstream request has a deadline, a hung API host must not block the relay
+        kwargs.setdefault("timeout", (self.conf.http_connect_timeout_seconds, self.conf.http_read_timeout_seconds))
+        return requests.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def now(self) -> float:
+        """
+        Time at which the last response was received, the capture time when replaying.
+        Used to timestamp measurements parsed from that response.
+        """
+        return time.time()
+
+    def request_time(self) -> float:
+        """
+        Time at which the next request is made, the capture time of the next captured entry when replaying.
+        Used when the request itself depends on the current date.
+        """
+        return time.time()
+
+
+class RecordingHttpTransport(HttpTransport):
+    """
+    Performs live requests and appends each raw response to an hourly gzip compressed NDJSON capture file.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, source: str):
+        super().__init__(conf, logger, source)
+        self.lock = threading.Lock()
+        os.makedirs(self.conf.capture_dir, exist_ok=True)
+        self.logger.info(f"Recording {source} API traffic to capture files in {self.conf.capture_dir}")
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        response = super().request(method, url, **kwargs)
+        try:
+            self.write_capture_entry(method, url, kwargs, response)
+        except Exception as e:
+            # Recording is a diagnostic aid, it should never break relaying
+            self.logger.exception(f"Error writing {self.source} API capture entry: {e}")
+        return response
+
+    def write_capture_entry(self, method: str, url: str, request_kwargs: Dict[str, Any], response: requests.Response) -> None:
+        captured_at = time.time()
+        entry = {
+            "ts": captured_at,
+            "source": self.source,
+            "method": method.upper(),
+            "url": url,
+            "request_body": redact_request_body(request_kwargs.get("json", request_kwargs.get("data"))),
+            "status": response.status_code,
+            "headers": {key: value for key, value in response.headers.items() if key.lower() != "set-cookie"},
+            "cookies": response.cookies.get_dict(),
+            "body": response.content.decode("utf-8", errors="replace"),
+        }
+        capture_file_path = os.path.join(self.conf.capture_dir, f"{self.source}-{datetime.fromtimestamp(captured_at, tz=timezone.utc).strftime('%Y%m%d-%H')}.ndjson.gz")
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+        # Every entry is appended as a separate gzip member, so a killed process never leaves a corrupt file
+        with self.lock:
+            with open(capture_file_path, "ab") as capture_file:
+                capture_file.write(gzip.compress(line))
+
+
+class ReplayExhausted(Exception):
+    pass
+
+
+class ReplayHttpTransport(HttpTransport):
+    """
+    Answers requests from capture files instead of the upstream API. Each request is matched to the next
+    captured entry with the same method, path and query. Captured entries that were not requested are skipped.
+    """
+
+    live = False
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, source: str):
+        super().__init__(conf, logger, source)
+        self.lock = threading.Lock()
+        self.capture_file_paths = sorted(glob.glob(os.path.join(self.conf.capture_dir, f"{source}-*.ndjson.gz")))
+        self.entries = self.iter_capture_entries()
+        self.lookahead = deque()
+        # Without capture files there is nothing to replay, the relay stops right away
+        self.exhausted = not self.capture_file_paths
+        self.replay_clock = None
+        self.first_capture_ts = None
+        self.replay_started = None
+        self.replayed_count = 0
+        # All requests, also the ones without a matching captured entry
+        self.request_count = 0
+        self.logger.info(f"Replaying {source} API traffic from {len(self.capture_file_paths)} capture file(s) in {self.conf.capture_dir}, speed: {self.conf.capture_replay_speed or 'unthrottled'}")
+
+    def iter_capture_entries(self) -> Iterator[Dict[str, Any]]:
+        for capture_file_path in self.capture_file_paths:
+            with gzip.open(capture_file_path, "rt", encoding="utf-8") as capture_file:
+                for line in capture_file:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def fill_lookahead(self) -> None:
+        while len(self.lookahead) < REPLAY_LOOKAHEAD_ENTRIES:
+            entry = next(self.entries, None)
+            if entry is None:
+                break
+            self.lookahead.append(entry)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        with self.lock:
+            self.request_count += 1
+            self.fill_lookahead()
+            if not self.lookahead:
+                self.exhausted = True
+                raise ReplayExhausted(f"All captured {self.source} API traffic has been replayed ({self.replayed_count} responses)")
+
+            request_key = (method.upper(), request_path(url))
+            match_idx = next((idx for idx, entry in enumerate(self.lookahead) if (entry["method"], request_path(entry["url"])) == request_key), None)
+            if match_idx is None:
+                # Skip the oldest captured entry, so a replay loop always makes progress
+                self.lookahead.popleft()
+                raise Exception(f"No captured {self.source} API response for {method.upper()} {request_path(url)} within the next {len(self.lookahead)} capture entries")
+
+            # Entries before the match were not requested during this replay, drop them
+            for _ in range(match_idx):
+                self.lookahead.popleft()
+            entry = self.lookahead.popleft()
+            self.fill_lookahead()
+            if not self.lookahead:
+                self.exhausted = True
+
+            self.wait_for_original_timing(entry["ts"])
+            self.replay_clock = entry["ts"]
+            self.replayed_count += 1
+
+        return make_replay_response(entry, url)
+
+    def wait_for_original_timing(self, capture_ts: float) -> None:
+        if self.first_capture_ts is None:
+            self.first_capture_ts = capture_ts
+            self.replay_started = time.monotonic()
+            return
+        if self.conf.capture_replay_speed <= 0:
+            return
+        due = self.replay_started + (capture_ts - self.first_capture_ts) / self.conf.capture_replay_speed
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def now(self) -> float:
+        with self.lock:
+            if self.replay_clock is not None:
+                return self.replay_clock
+        return self.request_time()
+
+    def request_time(self) -> float:
+        with self.lock:
+            self.fill_lookahead()
+            if self.lookahead:
+                return self.lookahead[0]["ts"]
+            return self.replay_clock if self.replay_clock is not None else time.time()
+
+
+def request_path(url: str) -> str:
+    parsed_url = urlparse(url)
+    return f"{parsed_url.path}?{parsed_url.query}" if parsed_url.query else parsed_url.path
+
+
+def redact_request_body(body: Any) -> Any:
+    if isinstance(body, dict):
+        return {key: ("REDACTED" if key in REDACTED_REQUEST_KEYS else value) for key, value in body.items()}
+    return body
+
+
+def make_replay_response(entry: Dict[str, Any], url: str) -> requests.Response:
+    response = requests.Response()
+    response.status_code = entry["status"]
+    response.reason = "Replayed"
+    response.url = url
+    response.encoding = "utf-8"
+    response.headers = CaseInsensitiveDict(entry.get("headers", {}))
+    response._content = entry["body"].encode("utf-8")
+    for name, value in entry.get("cookies", {}).items():
+        response.cookies.set(name, value)
+    return response
+
+
+def make_http_transport(conf: PyFusionSolarSettings, logger: logging.Logger, source: str) -> HttpTransport:
+    if conf.capture_mode == "record":
+        return RecordingHttpTransport(conf, logger, source)
+    elif conf.capture_mode == "replay":
+        return ReplayHttpTransport(conf, logger, source)
+    elif conf.capture_mode == "off":
+        return HttpTransport(conf, logger, source)
+    raise Exception(f"Invalid capture_mode '{conf.capture_mode}', should be one of: {', '.join(CAPTURE_MODES)}")
@@ -0,0 +1,123 @@
+import json
+import logging
+import math
+import time
+from typing import Dict, List
+from modules.conf_models import PyFusionSolarSettings
+from modules.influxdb_http_writer import InfluxDbHttpWriter, escape_key, make_line
+from modules.metrics import metrics
+
+# influxdb writes line protocol to the configured write endpoint, victoriametrics uses the native /api/v1/import endpoint
+INFLUXDB_TARGETS = ("influxdb", "victoriametrics")
+
+
+class InfluxDbBulkImport:
+    """
+    Collects the points of many writes, e.g. all meter-days of a Kenter backfill, and sends them in gzip compressed
+    batches of up to influxdb_bulk_max_batch_bytes, instead of one request per write. finish() sends the last batch
+    and logs the throughput.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, writer: InfluxDbHttpWriter):
+        if conf.influxdb_target not in INFLUXDB_TARGETS:
+            raise Exception(f"Invalid influxdb_target '{conf.influxdb_target}', should be one of: {', '.join(INFLUXDB_TARGETS)}")
+        self.conf = conf
+        self.logger = logger
+        self.writer = writer
+        self.batch: List[str] = []
+        self.batch_bytes = 0
+        self.batch_points = 0
+        self.points = 0
+        self.requests = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.write_seconds = 0.0
+        self.logger.debug(f"InfluxDbBulkImport class instantiated for target {conf.influxdb_target}")
+
+    def add_columns(self, measurement: str, tags: Dict[str, str], timestamps, fields: Dict[str, list]) -> None:
+        """
+        Add a series of points sharing the measurement and tags, with the timestamps in seconds and one value column per field.
+        """
+        if self.conf.influxdb_target == "victoriametrics":
+            self.add_victoriametrics_columns(measurement, tags, timestamps, fields)
+        else:
+            self.add_line_protocol_columns(measurement, tags, timestamps, fields)
+
+    def add_records(self, influxdb_records: list[dict]) -> None:
+        """
+        Add records as passed to the client libraries, e.g. metadata records.
+        """
+        if self.conf.influxdb_target == "victoriametrics":
+            # The import endpoint takes numeric samples only, like line protocol writes to VictoriaMetrics drop string fields
+            return
+        for record in influxdb_records:
+            line = make_line(record)
+            if line:
+                self.add_chunk(line + "\n", 1)
+
+    def add_line_protocol_columns(self, measurement: str, tags: Dict[str, str], timestamps, fields: Dict[str, list]) -> None:
+        # The measurement and tags are escaped once per series instead of once per point
+        prefix = escape_key(measurement) + "".join(f",{escape_key(key)}={escape_key(str(value))}" for key, value in sorted(tags.items()) if value != "")
+        field_keys = [escape_key(key) for key in fields]
+        for point_idx, timestamp in enumerate(timestamps):
+            field_set = ",".join(f"{field_key}={value!r}" for field_key, value in zip(field_keys, (column[point_idx] for column in fields.values())) if math.isfinite(value))
+            if field_set:
+                self.add_chunk(f"{prefix} {field_set} {int(timestamp)}\n", 1)
+
+    def add_victoriametrics_columns(self, measurement: str, tags: Dict[str, str], timestamps, fields: Dict[str, list]) -> None:
+        # Same series as VictoriaMetrics creates for line protocol writes: {measurement}_{field}, with the database as db label
+        labels = {key: str(value) for key, value in tags.items() if value != ""}
+        labels["db"] = self.conf.influxdb_v2_bucket if self.conf.influxdb_is_v2 else self.conf.influxdb_v1_db_name
+        timestamps_ms = [int(timestamp) * 1000 for timestamp in timestamps]
+        for field, column in fields.items():
+            finite_points = [(timestamp_ms, value) for timestamp_ms, value in zip(timestamps_ms, column) if math.isfinite(value)]
+            if not finite_points:
+                continue
+            series = {
+                "metric": {"__name__": f"{measurement}_{field}", **labels},
+                "values": [value for _, value in finite_points],
+                "timestamps": [timestamp_ms for timestamp_ms, _ in finite_points],
+            }
+            self.add_chunk(json.dumps(series, separators=(",", ":")) + "\n", len(finite_points))
+
+    def add_chunk(self, chunk: str, point_count: int) -> None:
+        self.batch.append(chunk)
+        self.batch_bytes += len(chunk)
+        self.batch_points += point_count
+        if self.batch_bytes >= self.conf.influxdb_bulk_max_batch_bytes:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.batch:
+            return
+        body = "".join(self.batch).encode("utf-8")
+        batch_points = self.batch_points
+        self.batch, self.batch_bytes, self.batch_points = [], 0, 0
+
+        started = time.perf_counter()
+        if self.conf.influxdb_target == "victoriametrics":
+            sent_bytes = self.writer.post(self.writer.base_url + "/api/v1/import", {}, body)
+        else:
+            sent_bytes = self.writer.post(self.writer.url, self.writer.params, body)
+        self.write_seconds += time.perf_counter() - started
+
+        self.points += batch_points
+        self.requests += 1
+        self.raw_bytes += len(body)
+        self.sent_bytes += sent_bytes
+        metrics.inc("bulk_import_points_total", batch_points, target=self.conf.influxdb_target)
+        metrics.inc("bulk_import_bytes_total", sent_bytes, target=self.conf.influxdb_target)
+
+    def finish(self) -> None:
+        """
+        Send the last batch and log the throughput of the import.
+        """
+        try:
+            self.flush()
+        finally:
+            if self.requests:
+                self.logger.info(
+                    f"Bulk imported {self.points} points in {self.requests} request(s) to {self.conf.influxdb_target}, "
+                    f"{self.raw_bytes / 1e6:.2f} MB sent as {self.sent_bytes / 1e6:.2f} MB in {self.write_seconds:.1f}s, "
+                    f"{self.points / max(self.write_seconds, 1e-6):.0f} points/s"
+                )
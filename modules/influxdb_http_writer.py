@@ -0,0 +1,79 @@
+import gzip
+import logging
+import math
+import requests
+from modules.conf_models import PyFusionSolarSettings
+
+
+def escape_key(value: str) -> str:
+    # Measurement names, tag keys and tag values, see the line protocol reference
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def format_field_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def make_line(record: dict) -> str:
+    """
+    Line protocol for a record as passed to the client libraries, with the time in seconds. Empty if the record has no valid fields.
+    """
+    # NaN and infinity can not be written, like the client libraries these fields are left out
+    fields = ",".join(f"{escape_key(key)}={format_field_value(value)}" for key, value in record["fields"].items() if not (isinstance(value, float) and not math.isfinite(value)))
+    if not fields:
+        return ""
+    tags = "".join(f",{escape_key(key)}={escape_key(str(value))}" for key, value in sorted(record["tags"].items()) if value != "")
+    return f"{escape_key(record['measurement'])}{tags} {fields} {record['time']}"
+
+
+class InfluxDbHttpWriter:
+    """
+    Writes line protocol to the InfluxDB v1 /write or v2 /api/v2/write endpoint, which VictoriaMetrics also accepts.
+    Requests go over one pooled session, in batches of influxdb_batch_size lines with gzip compressed bodies.
+    Unlike the client libraries there is no bucket or organization lookup at startup, a missing bucket fails the first write.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger):
+        self.conf = conf
+        self.logger = logger
+        self.session = requests.Session()
+        if conf.influxdb_is_v2:
+            self.base_url = f"{conf.influxdb_v2_protocol}://{conf.influxdb_host}:{conf.influxdb_port}"
+            self.url = f"{self.base_url}/api/v2/write"
+            self.params = {"org": conf.influxdb_v2_org, "bucket": conf.influxdb_v2_bucket, "precision": "s"}
+            self.session.headers["Authorization"] = f"Token {conf.influxdb_v2_token}"
+        else:
+            self.base_url = f"http://{conf.influxdb_host}:{conf.influxdb_port}"
+            self.url = f"{self.base_url}/write"
+            self.params = {"db": conf.influxdb_v1_db_name, "precision": "s"}
+            self.session.auth = (conf.influxdb_v1_username, conf.influxdb_v1_password)
+        self.logger.debug(f"InfluxDbHttpWriter class instantiated for {self.url}")
+
+    def write_records(self, influxdb_records: list[dict]) -> None:
+        lines = [line for line in map(make_line, influxdb_records) if line]
+        batch_size = max(1, self.conf.influxdb_batch_size)
+        for batch_start in range(0, len(lines), batch_size):
+            self.post(self.url, self.params, "\n".join(lines[batch_start : batch_start + batch_size]).encode("utf-8"))
+
+    def post(self, url: str, params: dict, body: bytes) -> int:
+        """
+        Send a request body, gzip compressed if enabled. Returns the number of bytes sent.
+        """
+        headers = {"Content-Type": "text/plain; charset=utf-8"}
+        if self.conf.influxdb_gzip_enabled:
+            # Level 1 compresses line protocol well at a fraction of the CPU time of the default level
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        response = self.session.post(url, params=params, data=body, headers=headers, timeout=(self.conf.http_connect_timeout_seconds, self.conf.influxdb_timeout_seconds))
+        if response.status_code >= 300:
+            raise Exception(f"InfluxDB write to {url} failed with HTTP status {response.status_code}: {response.text[:500]}")
+        return len(body)
+
+    def close(self) -> None:
+        self.session.close()
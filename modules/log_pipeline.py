@@ -0,0 +1,150 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Tuple
+from modules.metrics import metrics
+
+LOG_FORMATS = ("text", "json")
+TEXT_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Records logged while the queue is full are dropped and counted, logging never blocks a relay
+LOG_QUEUE_SIZE = 10000
+# Rate limited messages kept before the ones past their window are pruned
+REPEATED_LOG_MAX_MESSAGES = 1000
+
+
+class JsonLogFormatter(logging.Formatter):
+    """
+    One JSON object per line, for log shippers.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        log_entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name, "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_text:
+            log_entry["exception"] = record.exc_text
+        return json.dumps(log_entry, ensure_ascii=False)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The message and traceback are rendered on the calling thread, the listener thread only formats and writes
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_records_dropped_total")
+
+
+class RepeatedLogFilter(logging.Filter):
+    """
+    Rate limits identical warnings and errors logged repeatedly from the same call site, e.g. one failing device in
+    every cycle. The number of suppressed records is appended to the next such record after the window.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.window_s = 0.0
+        self.max_records = 0
+        self.lock = threading.Lock()
+        # [window_start, logged_count, suppressed_count] per (pathname, lineno, message)
+        self.messages: Dict[Tuple[str, int, str], List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.window_s <= 0:
+            return True
+        # Messages of other devices or errors logged from the same line are counted separately
+        message_key = (record.pathname, record.lineno, record.getMessage())
+        with self.lock:
+            state = self.messages.get(message_key)
+            if state is None or record.created - state[0] >= self.window_s:
+                if state is not None and state[2]:
+                    record.msg = f"{record.getMessage()} ({state[2]} identical message(s) suppressed in the last {record.created - state[0]:.0f}s)"
+                    record.args = None
+                if state is None and len(self.messages) >= REPEATED_LOG_MAX_MESSAGES:
+                    self.messages = {key: value for key, value in self.messages.items() if record.created - value[0] < self.window_s}
+                self.messages[message_key] = [record.created, 1, 0]
+                return True
+            if state[1] < self.max_records:
+                state[1] += 1
+                return True
+            state[2] += 1
+        metrics.inc("log_records_suppressed_total", level=record.levelname)
+        return False
+
+
+class LogPipeline:
+    """
+    Root logger setup. Records are put on a bounded queue and written to stdout by a listener thread, so relay and
+    sink threads do not wait for stdout. Repeated identical warnings and errors are rate limited.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listener = None
+        self.stream_handler = None
+        self.repeat_filter = RepeatedLogFilter()
+        self.atexit_registered = False
+
+    def start(self) -> logging.Logger:
+        """
+        Replace the root logger handlers with the queue handler and start the listener thread. Also called in relay
+        processes, a forked process does not inherit the listener thread.
+        """
+        logger = logging.getLogger()
+        with self.lock:
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            self.stream_handler = logging.StreamHandler(sys.stdout)
+            self.stream_handler.setFormatter(logging.Formatter(TEXT_LOG_FORMAT))
+            log_queue = queue.Queue(LOG_QUEUE_SIZE)
+            queue_handler = NonBlockingQueueHandler(log_queue)
+            queue_handler.addFilter(self.repeat_filter)
+            logger.addHandler(queue_handler)
+            self.listener = QueueListener(log_queue, self.stream_handler)
+            self.listener.start()
+            if not self.atexit_registered:
+                atexit.register(self.stop)
+                self.atexit_registered = True
+        return logger
+
+    def apply_settings(self, conf) -> None:
+        """
+        Apply the log level, format and repeat limits, called at startup and on config reload.
+        """
+        if conf.log_format not in LOG_FORMATS:
+            raise Exception(f"Invalid log_format '{conf.log_format}', should be one of: {', '.join(LOG_FORMATS)}")
+        logging.getLogger().setLevel(logging.DEBUG if conf.debug_mode else logging.INFO)
+        with self.lock:
+            if self.stream_handler is not None:
+                self.stream_handler.setFormatter(JsonLogFormatter() if conf.log_format == "json" else logging.Formatter(TEXT_LOG_FORMAT))
+        with self.repeat_filter.lock:
+            self.repeat_filter.window_s = conf.log_repeat_window_seconds
+            self.repeat_filter.max_records = conf.log_repeat_max_records
+
+    def stop(self) -> None:
+        """
+        Write the queued records and log directly to stdout from here on. Called at exit.
+        """
+        logger = logging.getLogger()
+        with self.lock:
+            if self.listener is None:
+                return
+            self.listener.stop()
+            self.listener = None
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            logger.addHandler(self.stream_handler)
+
+
+# Process wide log pipeline
+log_pipeline = LogPipeline()
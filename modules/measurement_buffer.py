@@ -0,0 +1,210 @@
+import json
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+from modules.conf_models import PyFusionSolarSettings
+from modules.models import KenterTransformerMeasurements
+
+# Measurement fields kept in the buffer, other fields are not useful for dashboards
+BUFFERED_FIELDS = ("real_time_power_w", "day_energy_wh", "lifetime_energy_wh", "active_power_w")
+AGGREGATIONS = ("last", "min", "max", "sum", "mean", "series")
+
+
+class SeriesRingBuffer:
+    """
+    Ring of (timestamp, value) points of one device field, in two arrays which grow up to the capacity. After that the
+    oldest point is overwritten. Timestamps increase, so windows are found by bisection.
+    """
+
+    __slots__ = ("capacity", "timestamps", "values", "next_idx")
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.timestamps = array("d")
+        self.values = array("d")
+        self.next_idx = 0
+
+    @property
+    def count(self) -> int:
+        return len(self.timestamps)
+
+    def last_timestamp(self) -> Optional[float]:
+        if not self.timestamps:
+            return None
+        return self.timestamps[self.next_idx - 1]
+
+    def append(self, timestamp: float, value: float) -> bool:
+        """
+        Returns False for a point which is not newer than the last point, e.g. an unchanged measurement polled again.
+        """
+        if self.timestamps and timestamp <= self.timestamps[self.next_idx - 1]:
+            return False
+        if len(self.timestamps) < self.capacity:
+            self.timestamps.append(timestamp)
+            self.values.append(value)
+        else:
+            self.timestamps[self.next_idx] = timestamp
+            self.values[self.next_idx] = value
+        self.next_idx = (self.next_idx + 1) % self.capacity
+        return True
+
+    def window(self, start: float) -> Tuple[List[float], List[float]]:
+        """
+        Timestamps and values of the points at or after start, oldest first.
+        """
+        # Oldest first: once the ring is full the part from next_idx is older than the part before it
+        segments = [(self.next_idx, self.capacity), (0, self.next_idx)] if len(self.timestamps) == self.capacity else [(0, len(self.timestamps))]
+        timestamps, values = [], []
+        for segment_start, segment_end in segments:
+            first_idx = bisect_left(self.timestamps, start, segment_start, segment_end)
+            timestamps.extend(self.timestamps[first_idx:segment_end])
+            values.extend(self.values[first_idx:segment_end])
+        return timestamps, values
+
+
+class MeasurementBuffer:
+    """
+    The last measurement_buffer_hours of every device field the relays have seen, queried over the HTTP server so
+    dashboards can be refreshed from relay memory instead of querying the database. Memory is bounded by
+    measurement_buffer_max_points per device field.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger):
+        self.conf = conf
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.series: Dict[Tuple[str, str], SeriesRingBuffer] = {}
+        self.device_names: Dict[str, str] = {}
+        # Set in relay processes, points are forwarded to the buffer of the supervisor which serves the queries
+        self.forward_points = False
+        self.pending_points: List[Tuple[str, str, str, float, float]] = []
+        self.logger.debug("MeasurementBuffer class instantiated")
+
+    def add(self, device_key: str, device_name: str, field: str, timestamp: float, value: float) -> None:
+        with self.lock:
+            series = self.series.get((device_key, field))
+            if series is None:
+                series = self.series[(device_key, field)] = SeriesRingBuffer(self.conf.measurement_buffer_max_points)
+            self.device_names[device_key] = device_name
+            if series.append(timestamp, value) and self.forward_points:
+                self.pending_points.append((device_key, device_name, field, timestamp, value))
+
+    def add_points(self, points: List[Tuple[str, str, str, float, float]]) -> None:
+        for point in points:
+            self.add(*point)
+
+    def take_pending_points(self) -> List[Tuple[str, str, str, float, float]]:
+        with self.lock:
+            pending_points, self.pending_points = self.pending_points, []
+        return pending_points
+
+    def add_measurement(self, device_key: str, device_name: str, measurement) -> None:
+        """
+        Add the buffered fields of an inverter, station or grid meter measurement.
+        """
+        # Measurements without a timestamp (0) were taken now
+        timestamp = measurement.timestamp or time.time()
+        for field in BUFFERED_FIELDS:
+            if hasattr(measurement, field):
+                self.add(device_key, device_name, field, timestamp, getattr(measurement, field))
+
+    def add_kenter_measurements(self, device_key: str, transformer_measurements: KenterTransformerMeasurements) -> None:
+        for timestamp, interval_energy_wh, interval_power_avg_w in zip(transformer_measurements.timestamps, transformer_measurements.interval_energy_wh, transformer_measurements.interval_power_avg_w):
+            self.add(device_key, transformer_measurements.descriptive_name, "interval_energy_wh", timestamp, interval_energy_wh)
+            self.add(device_key, transformer_measurements.descriptive_name, "interval_power_avg_w", timestamp, interval_power_avg_w)
+
+    def list_series(self) -> List[dict]:
+        with self.lock:
+            return [
+                {"device": device_key, "name": self.device_names.get(device_key, ""), "field": field, "points": series.count, "last_timestamp": series.last_timestamp()}
+                for (device_key, field), series in sorted(self.series.items())
+            ]
+
+    def query(self, device_key: str, field: str, window_s: float, aggregation: str, step_s: float = 0, now: Optional[float] = None) -> Optional[dict]:
+        """
+        Aggregate the points of a device field within the window. The series aggregation returns the points, averaged
+        per step if a step is given. Returns None for an unknown device field.
+        """
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Invalid aggregation '{aggregation}', should be one of: {', '.join(AGGREGATIONS)}")
+        window_s = min(window_s, self.conf.measurement_buffer_hours * 3600)
+        now = time.time() if now is None else now
+        with self.lock:
+            series = self.series.get((device_key, field))
+            if series is None:
+                return None
+            timestamps, values = series.window(now - window_s)
+
+        result = {"device": device_key, "field": field, "window": window_s, "aggregation": aggregation, "count": len(values)}
+        if aggregation == "series":
+            result["points"] = downsample(timestamps, values, step_s) if step_s > 0 else [[timestamp, value] for timestamp, value in zip(timestamps, values)]
+        elif not values:
+            result["value"] = None
+        elif aggregation == "last":
+            result["value"] = values[-1]
+            result["timestamp"] = timestamps[-1]
+        elif aggregation == "min":
+            result["value"] = min(values)
+        elif aggregation == "max":
+            result["value"] = max(values)
+        elif aggregation == "sum":
+            result["value"] = sum(values)
+        else:
+            result["value"] = sum(values) / len(values)
+        return result
+
+    def handle_series(self, query: Dict[str, list]) -> Tuple[int, str, bytes]:
+        return 200, "application/json", json.dumps(self.list_series()).encode("utf-8")
+
+    def handle_query(self, query: Dict[str, list]) -> Tuple[int, str, bytes]:
+        """
+        GET /series/query?device=openapi/1000000012345&field=real_time_power_w&window=3600&agg=series&step=300
+        """
+        try:
+            device_key = query["device"][0]
+            field = query["field"][0]
+            window_s = float(query.get("window", [self.conf.measurement_buffer_hours * 3600])[0])
+            step_s = float(query.get("step", [0])[0])
+            result = self.query(device_key, field, window_s, query.get("agg", ["last"])[0], step_s)
+        except (KeyError, ValueError) as e:
+            return 400, "text/plain", f"Invalid query: {e}. Required parameters: device, field. Optional: window (seconds), agg ({', '.join(AGGREGATIONS)}), step (seconds)\n".encode("utf-8")
+        if result is None:
+            return 404, "text/plain", f"No buffered series for device {device_key} field {field}, see /series\n".encode("utf-8")
+        return 200, "application/json", json.dumps(result).encode("utf-8")
+
+
+def downsample(timestamps: List[float], values: List[float], step_s: float) -> List[List[float]]:
+    """
+    Mean value per step, as [step start, mean] pairs. Steps are aligned to the unix epoch, steps without points are left out.
+    """
+    points = []
+    step_start, step_sum, step_count = None, 0.0, 0
+    for timestamp, value in zip(timestamps, values):
+        timestamp_step = timestamp - timestamp % step_s
+        if timestamp_step != step_start:
+            if step_count:
+                points.append([step_start, step_sum / step_count])
+            step_start, step_sum, step_count = timestamp_step, 0.0, 0
+        step_sum += value
+        step_count += 1
+    if step_count:
+        points.append([step_start, step_sum / step_count])
+    return points
+
+
+measurement_buffer_lock = threading.Lock()
+measurement_buffer = None
+
+
+def get_measurement_buffer(conf: PyFusionSolarSettings, logger: logging.Logger) -> MeasurementBuffer:
+    """
+    Process wide buffer shared by all relays and the HTTP server.
+    """
+    global measurement_buffer
+    with measurement_buffer_lock:
+        if measurement_buffer is None:
+            measurement_buffer = MeasurementBuffer(conf, logger)
+        return measurement_buffer
@@ -0,0 +1,225 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+METRIC_PREFIX = "pyfusionsolar"
+DEFAULT_LATENCY_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS_S):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        # Counts are stored per bucket and made cumulative when rendering
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            self.bucket_counts[idx] += 1
+        self.count += 1
+        self.sum += value
+
+
+class CycleStats:
+    """
+    Per-cycle aggregation of stage timings and counters, used for the cycle summary log line.
+    """
+
+    def __init__(self, relay: str, interval_s: Optional[float]):
+        self.relay = relay
+        self.interval_s = interval_s
+        self.started = time.perf_counter()
+        self.duration_s = 0.0
+        self.stage_seconds: Dict[str, float] = {}
+        self.stage_calls: Dict[str, int] = {}
+        self.counters: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+
+    def add_counter(self, name: str, amount: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary_line(self) -> str:
+        with self.lock:
+            if self.interval_s:
+                duration_str = f"{self.duration_s:.3f}s of {self.interval_s:.0f}s interval ({self.duration_s / self.interval_s:.1%})"
+            else:
+                duration_str = f"{self.duration_s:.3f}s"
+            stages_str = ", ".join(f"{stage} {seconds:.3f}s/{self.stage_calls[stage]}" for stage, seconds in sorted(self.stage_seconds.items()))
+            counters_str = ", ".join(f"{name} {value:g}" for name, value in sorted(self.counters.items()))
+        return f"Cycle summary [{self.relay}]: duration {duration_str}; stages: {stages_str or 'none'}; counters: {counters_str or 'none'}"
+
+
+class MetricsRegistry:
+    """
+    Thread safe in-process registry for counters, gauges and latency histograms.
+    Timers and counters are also attributed to the cycle that is active on the calling thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        # Latest snapshot of each relay process, when running under the supervisor
+        self.child_snapshots: Dict[str, dict] = {}
+        self.local = threading.local()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        cycle = self.current_cycle()
+        if cycle is not None:
+            cycle.add_counter(name, amount)
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, stage: Optional[str] = None, **labels):
+        """
+        Observe the duration of the wrapped block in histogram `name`. If `stage` is given,
+        the duration is also added to the active cycle summary under that stage name.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(name, elapsed, **labels)
+            cycle = self.current_cycle()
+            if cycle is not None and stage:
+                cycle.add_stage(stage, elapsed)
+
+    def current_cycle(self) -> Optional[CycleStats]:
+        return getattr(self.local, "cycle", None)
+
+    def bind_cycle(self, cycle: Optional[CycleStats]) -> None:
+        """
+        Attribute metrics recorded on the calling thread to `cycle`, used by worker threads.
+        """
+        self.local.cycle = cycle
+
+    @contextmanager
+    def cycle(self, relay: str, interval_s: Optional[float] = None, logger=None):
+        """
+        Track one relay processing cycle, record its duration versus the cron interval
+        and log a one line summary when the cycle completes.
+        """
+        cycle = CycleStats(relay, interval_s)
+        previous_cycle = self.current_cycle()
+        self.bind_cycle(cycle)
+        try:
+            yield cycle
+        finally:
+            self.bind_cycle(previous_cycle)
+            cycle.duration_s = time.perf_counter() - cycle.started
+            self.observe("cycle_duration_seconds", cycle.duration_s, relay=relay)
+            self.inc("cycles_total", relay=relay)
+            self.set_gauge("cycle_last_duration_seconds", cycle.duration_s, relay=relay)
+            if interval_s:
+                self.set_gauge("cycle_interval_seconds", interval_s, relay=relay)
+                self.set_gauge("cycle_interval_utilization_ratio", cycle.duration_s / interval_s, relay=relay)
+                if cycle.duration_s > interval_s:
+                    self.inc("cycle_overruns_total", relay=relay)
+            if logger is not None:
+                logger.info(cycle.summary_line())
+
+    def set_child_snapshot(self, process: str, snapshot: dict) -> None:
+        """
+        Store the latest snapshot of a relay process, its series are included with a `process` label.
+        """
+        with self.lock:
+            self.child_snapshots[process] = snapshot
+
+    def snapshot(self) -> dict:
+        """
+        Return a JSON serializable copy of all metrics, including those of relay processes.
+        """
+        with self.lock:
+            snapshot = {
+                "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.counters.items()],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self.gauges.items()],
+                "histograms": [
+                    {"name": name, "labels": dict(labels), "buckets": list(hist.buckets), "bucket_counts": list(hist.bucket_counts), "count": hist.count, "sum": hist.sum}
+                    for (name, labels), hist in self.histograms.items()
+                ],
+            }
+            for process, child_snapshot in sorted(self.child_snapshots.items()):
+                for kind in ("counters", "gauges", "histograms"):
+                    snapshot[kind].extend({**series, "labels": {**series["labels"], "process": process}} for series in child_snapshot.get(kind, []))
+            return snapshot
+
+    def render_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+
+        def fmt_labels(labels, extra=None):
+            items = list(labels) + (extra or [])
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in items) + "}"
+
+        def sort_key(series):
+            return series["name"], sorted(series["labels"].items())
+
+        snapshot = self.snapshot()
+        lines = []
+        for kind, type_name in (("counters", "counter"), ("gauges", "gauge")):
+            typed = set()
+            for series in sorted(snapshot[kind], key=sort_key):
+                full_name = f"{METRIC_PREFIX}_{series['name']}"
+                if full_name not in typed:
+                    lines.append(f"# TYPE {full_name} {type_name}")
+                    typed.add(full_name)
+                lines.append(f"{full_name}{fmt_labels(sorted(series['labels'].items()))} {series['value']:g}")
+
+        typed = set()
+        for series in sorted(snapshot["histograms"], key=sort_key):
+            full_name = f"{METRIC_PREFIX}_{series['name']}"
+            labels = sorted(series["labels"].items())
+            if full_name not in typed:
+                lines.append(f"# TYPE {full_name} histogram")
+                typed.add(full_name)
+            cumulative = 0
+            for upper_bound, bucket_count in zip(series["buckets"], series["bucket_counts"]):
+                cumulative += bucket_count
+                lines.append(f"{full_name}_bucket{fmt_labels(labels, [('le', f'{upper_bound:g}')])} {cumulative}")
+            lines.append(f"{full_name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {series['count']}")
+            lines.append(f"{full_name}_sum{fmt_labels(labels)} {series['sum']:g}")
+            lines.append(f"{full_name}_count{fmt_labels(labels)} {series['count']}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Process wide registry, shared by all relays, fetchers and writers
+metrics = MetricsRegistry()
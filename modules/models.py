@@ -1,80 +1,73 @@
-from typing import List
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional, Union
 
-from modules.conf_models import FusionSolarOpenApiInverterSettings, FusionSolarOpenApiMeterSettings
+from modules.conf_models import FusionSolarKioskSettings, FusionSolarOpenApiInverterSettings, FusionSolarOpenApiMeterSettings
 
+# Measurement models are slotted and frozen: no per-instance __dict__, and a measurement is never altered after parsing
 
-class KenterTransformerMeasurement:
-    def __init__(
-        self,
-        timestamp: int = 0,
-        interval_energy_wh: float = 0.0,
-        interval_power_avg_w: float = 0.0,
-    ):
-        self.timestamp = timestamp
-        self.interval_energy_wh = interval_energy_wh
-        self.interval_power_avg_w = interval_power_avg_w
 
-    timestamp: int
-    interval_energy_wh: float
-    interval_power_avg_w: float
+@dataclass(slots=True, frozen=True)
+class KenterTransformerMeasurement:
+    timestamp: int = 0
+    interval_energy_wh: float = 0.0
+    interval_power_avg_w: float = 0.0
 
 
+@dataclass(slots=True)
 class KenterTransformerMeasurements:
-    def __init__(self, descriptive_name: str = "", connection_id: str = "", metering_point_id: str = "", channel_id: str = "", measurements: List[KenterTransformerMeasurement] = []):
-        self.descriptive_name = descriptive_name
-        self.connection_id = connection_id
-        self.metering_point_id = metering_point_id
-        self.channel_id = channel_id
-        self.measurements = measurements
+    """
+    Series of Kenter transformer measurements for a single metering point and channel.
+    Values are stored in typed array columns instead of one object per interval, backfills hold many days of data.
+    """
+
+    descriptive_name: str = ""
+    connection_id: str = ""
+    metering_point_id: str = ""
+    channel_id: str = ""
+    timestamps: array = field(default_factory=lambda: array("q"))
+    interval_energy_wh: array = field(default_factory=lambda: array("d"))
+    interval_power_avg_w: array = field(default_factory=lambda: array("d"))
+
+    def append(self, timestamp: int, interval_energy_wh: float, interval_power_avg_w: float) -> None:
+        self.timestamps.append(timestamp)
+        self.interval_energy_wh.append(interval_energy_wh)
+        self.interval_power_avg_w.append(interval_power_avg_w)
+
+    def extend(self, measurements: Iterable[KenterTransformerMeasurement]) -> None:
+        for measurement in measurements:
+            self.append(measurement.timestamp, measurement.interval_energy_wh, measurement.interval_power_avg_w)
 
-    descriptive_name: str
-    connection_id: str
-    metering_point_id: str
-    channel_id: str
-    measurements: List[KenterTransformerMeasurement]
+    def __len__(self) -> int:
+        return len(self.timestamps)
 
+    def __iter__(self) -> Iterator[KenterTransformerMeasurement]:
+        for timestamp, interval_energy_wh, interval_power_avg_w in zip(self.timestamps, self.interval_energy_wh, self.interval_power_avg_w):
+            yield KenterTransformerMeasurement(timestamp, interval_energy_wh, interval_power_avg_w)
 
+    @property
+    def measurements(self) -> list[KenterTransformerMeasurement]:
+        """
+        Measurements as a list of objects, prefer iterating or the array columns for large series.
+        """
+        return list(self)
+
+
+@dataclass(slots=True, frozen=True)
 class FusionSolarInverterMeasurement:
-    def __init__(
-        self,
-        settings: FusionSolarOpenApiInverterSettings = None,
-        measurement_type: str = "",
-        data_source: str = "",
-        station_name: str = "",
-        station_dn: str = "",
-        device_dn: str = "",
-        device_name: str = "",
-        device_model: str = "",
-        device_id: str = "",
-        real_time_power_w: float = 0.0,
-        lifetime_energy_wh: float = 0.0,
-        day_energy_wh: float = 0.0,
-    ):
-        self.settings = settings
-        self.measurement_type = measurement_type
-        self.station_name = station_name
-        self.station_dn = station_dn
-        self.device_dn = device_dn
-        self.device_name = device_name
-        self.device_model = device_model
-        self.device_id = device_id
-        self.data_source = data_source
-        self.real_time_power_w = real_time_power_w
-        self.lifetime_energy_wh = lifetime_energy_wh
-        self.day_energy_wh = day_energy_wh
-
-    settings: FusionSolarOpenApiInverterSettings
-    measurement_type: str
-    station_name: str
-    station_dn: str
-    device_dn: str
-    device_name: str
-    device_model: str
-    device_id: str
-    data_source: str
-    real_time_power_w: float
-    lifetime_energy_wh: float
-    day_energy_wh: float
+    settings: Optional[Union[FusionSolarOpenApiInverterSettings, FusionSolarKioskSettings]] = None
+    measurement_type: str = ""
+    data_source: str = ""
+    station_name: str = ""
+    station_dn: str = ""
+    device_dn: str = ""
+    device_name: str = ""
+    device_model: str = ""
+    device_id: str = ""
+    real_time_power_w: float = 0.0
+    lifetime_energy_wh: float = 0.0
+    day_energy_wh: float = 0.0
+    timestamp: float = 0.0
 
     @property
     def settings_descriptive_name(self) -> str:
@@ -87,42 +80,21 @@ class FusionSolarInverterMeasurement:
         if self.settings is not None:
             return self.settings.dev_id
         return ""
-    
+
+
+@dataclass(slots=True, frozen=True)
 class FusionSolarMeterMeasurement:
-    def __init__(
-        self,
-        settings: FusionSolarOpenApiMeterSettings = None,
-        measurement_type: str = "",
-        data_source: str = "",
-        station_name: str = "",
-        station_dn: str = "",
-        device_dn: str = "",
-        device_name: str = "",
-        device_model: str = "",
-        device_id: str = "",
-        active_power_w: float = 0.0,
-    ):
-        self.settings = settings
-        self.measurement_type = measurement_type
-        self.station_name = station_name
-        self.station_dn = station_dn
-        self.device_dn = device_dn
-        self.device_name = device_name
-        self.device_model = device_model
-        self.device_id = device_id
-        self.data_source = data_source
-        self.active_power_w = active_power_w
-
-    settings: FusionSolarOpenApiInverterSettings
-    measurement_type: str
-    station_name: str
-    station_dn: str
-    device_dn: str
-    device_name: str
-    device_model: str
-    device_id: str
-    data_source: str
-    active_power_w: float
+    settings: Optional[FusionSolarOpenApiMeterSettings] = None
+    measurement_type: str = ""
+    data_source: str = ""
+    station_name: str = ""
+    station_dn: str = ""
+    device_dn: str = ""
+    device_name: str = ""
+    device_model: str = ""
+    device_id: str = ""
+    active_power_w: float = 0.0
+    timestamp: float = 0.0
 
     @property
     def settings_descriptive_name(self) -> str:
@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from modules.conf_models import PyFusionSolarSettings
+from modules.metrics import metrics
+
+
+class MqttDeadband:
+    """
+    Change filter for MQTT state messages. A message is only published when a field moved beyond its deadband since
+    the last published message of the topic, a text field changed, or the topic has been silent for
+    mqtt_deadband_max_silence_seconds. Changes are compared with the last published values, so slow drift is
+    published once it adds up to the deadband.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger):
+        self.conf = conf
+        self.logger = logger
+        self.lock = threading.Lock()
+        # Per state topic: last published data points and the monotonic time they were published
+        self.published: Dict[str, Tuple[dict, float]] = {}
+        self.logger.debug("MqttDeadband class instantiated")
+
+    def should_publish(self, topic: str, data_points: dict, data_source: str, now: Optional[float] = None) -> bool:
+        if not self.conf.mqtt_deadband_enabled:
+            return True
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            last = self.published.get(topic)
+        if last is None:
+            return True
+        last_data_points, last_published = last
+        if now - last_published >= self.conf.mqtt_deadband_max_silence_seconds:
+            return True
+        if any(self.changed(field_name, value, last_data_points.get(field_name)) for field_name, value in data_points.items()):
+            return True
+
+        metrics.inc("mqtt_messages_suppressed_total", data_source=data_source)
+        self.logger.debug(f"Skipping MQTT publish to {topic}, no field changed beyond the deadband")
+        return False
+
+    def changed(self, field_name: str, value, last_value) -> bool:
+        if not isinstance(value, (int, float)) or not isinstance(last_value, (int, float)):
+            return value != last_value
+        if field_name.endswith("_wh"):
+            # Energy counters only use the absolute deadband, relative to a lifetime counter even 1% would hide days of production
+            return abs(value - last_value) > self.conf.mqtt_deadband_energy_wh
+        absolute_deadband = self.conf.mqtt_deadband_power_w if field_name.endswith("_w") else 0
+        # A change must exceed both deadbands, the relative deadband keeps large values from publishing on every small fluctuation
+        return abs(value - last_value) > max(absolute_deadband, self.conf.mqtt_deadband_relative * abs(last_value))
+
+    def mark_published(self, topic: str, data_points: dict, now: Optional[float] = None) -> None:
+        if not self.conf.mqtt_deadband_enabled:
+            return
+        with self.lock:
+            self.published[topic] = (dict(data_points), time.monotonic() if now is None else now)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.published = {}
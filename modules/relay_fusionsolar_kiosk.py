@@ -1,12 +1,24 @@
 import logging
-import time
+import threading
 from apscheduler.schedulers.blocking import BlockingScheduler
+from modules.adaptive_polling import AdaptivePolling
+from modules.config_reload import config_reload
+from modules.cycle_profiler import CycleProfiler
+from modules.shutdown import shutdown
+from modules.measurement_buffer import get_measurement_buffer
+from modules.metrics import metrics
+from modules.cycle_budget import CycleBudget
+from modules.scheduling import add_cron_job, cron_interval_seconds
 from modules.conf_models import PyFusionSolarSettings, FusionSolarKioskSettings
 from modules.write_influxdb import WriteInfluxDb
+from modules.write_archive import WriteArchive
+from modules.write_sqlite import WriteSqlite
 from modules.write_pvoutput import WritePvOutput
 from modules.fetch_fusionsolar_kiosk import FetchFusionSolarKiosk
 from modules.write_mqtt import WriteMqtt
 from modules.models import *
+from modules.sharding import get_shard_coordinator
+from modules.device_state import get_device_state_store
 
 
 class RelayFusionSolarKiosk:
@@ -19,10 +31,34 @@ class RelayFusionSolarKiosk:
         self.pvoutput = WritePvOutput(conf, logger)
         self.mqtt = WriteMqtt(conf, logger)
         self.influxdb = WriteInfluxDb(self.conf, self.logger)
+        self.sqlite = WriteSqlite(self.conf, self.logger)
+        self.archive = WriteArchive(self.conf, self.logger)
+        self.profiler = CycleProfiler(conf, logger, "fusionsolar_kiosk")
+        self.sched = None
+        # Held while a cycle runs, so shutdown can wait for the in-progress cycle
+        self.cycle_lock = threading.Lock()
+        self.budget = CycleBudget(conf, logger, "fusionsolar_kiosk", None)
+        self.shards = get_shard_coordinator(conf, logger, "fusionsolar_kiosk")
+        self.device_state = get_device_state_store(conf, logger)
+        self.measurement_buffer = get_measurement_buffer(conf, logger) if conf.measurement_buffer_enabled else None
+        self.polling = AdaptivePolling(conf, logger, "fusionsolar_kiosk")
+
+        self.cycle_interval_s = cron_interval_seconds(self.conf.fusionsolar_kiosk_fetch_cron_hour, self.conf.fusionsolar_kiosk_fetch_cron_minute)
+
+    def start(self):
+        """
+        Blocking, runs the initial fetch if configured and then the cron scheduler.
+        """
+        shutdown.register("RelayFusionSolarKiosk", self.stop)
+        config_reload.register("RelayFusionSolarKiosk", self.reload_config)
+        if self.conf.capture_mode == "replay":
+            self.run_replay()
+            return
 
         self.logger.info("Starting RelayFusionSolarKiosk on separate thread...")
         self.logger.debug("RelayFusionSolarKiosk waiting 5sec to initialize docker-compose containers")
-        time.sleep(5)
+        if shutdown.wait(5):
+            return
 
         if self.conf.fetch_on_startup:
             self.logger.info("Starting process_fusionsolar_kiosks() at init, before waiting for cron, because fetch_on_startup is set")
@@ -31,30 +67,104 @@ class RelayFusionSolarKiosk:
         self.logger.info(
             f"Setting cron trigger to run fusionsolar kiosk processing at hour: [{self.conf.fusionsolar_kiosk_fetch_cron_hour}], minute: [{self.conf.fusionsolar_kiosk_fetch_cron_minute}]"
         )
+        if shutdown.is_requested():
+            return
         self.sched = BlockingScheduler(standalone=True)
-        self.sched.add_job(self.process_fusionsolar_kiosks, trigger="cron", hour=self.conf.fusionsolar_kiosk_fetch_cron_hour, minute=self.conf.fusionsolar_kiosk_fetch_cron_minute)
+        add_cron_job(self.sched, self.run_scheduled_cycle, "fusionsolar_kiosk", "fusionsolar_kiosk", self.conf.fusionsolar_kiosk_fetch_cron_hour, self.conf.fusionsolar_kiosk_fetch_cron_minute, self.conf, self.logger)
         self.sched.start()
 
+    def stop(self):
+        """
+        Stop the scheduler, wait for the in-progress cycle to finish and close the sinks. Called on shutdown.
+        """
+        self.logger.info("Stopping RelayFusionSolarKiosk...")
+        if self.sched is not None and self.sched.running:
+            self.sched.shutdown(wait=False)
+        with self.cycle_lock:
+            self.influxdb.close()
+            self.sqlite.close()
+            self.archive.close()
+        self.logger.info("RelayFusionSolarKiosk stopped")
+
+    def reload_config(self, changed_fields):
+        """
+        Apply reloaded settings, kiosks are read from the settings every cycle. Only a changed cron is rescheduled. Called on config reload.
+        """
+        self.influxdb.reload_config(changed_fields)
+        self.sqlite.reload_config(changed_fields)
+        self.archive.reload_config(changed_fields)
+        self.mqtt.reload_config(changed_fields)
+        if {"fusionsolar_kiosk_fetch_cron_hour", "fusionsolar_kiosk_fetch_cron_minute"} & changed_fields:
+            self.cycle_interval_s = cron_interval_seconds(self.conf.fusionsolar_kiosk_fetch_cron_hour, self.conf.fusionsolar_kiosk_fetch_cron_minute)
+            if self.sched is not None and self.sched.running:
+                self.sched.reschedule_job("fusionsolar_kiosk", trigger="cron", hour=self.conf.fusionsolar_kiosk_fetch_cron_hour, minute=self.conf.fusionsolar_kiosk_fetch_cron_minute)
+                self.logger.info(
+                    f"Rescheduled fusionsolar kiosk processing at hour: [{self.conf.fusionsolar_kiosk_fetch_cron_hour}], minute: [{self.conf.fusionsolar_kiosk_fetch_cron_minute}]"
+                )
+
+    def run_replay(self):
+        """
+        Run cycles back to back on captured API traffic until all captures are replayed, instead of starting the cron scheduler.
+        """
+        self.logger.info("Starting RelayFusionSolarKiosk in replay mode...")
+        while not self.fs_kiosk.transport.exhausted and not shutdown.is_requested():
+            request_count = self.fs_kiosk.transport.request_count
+            self.process_fusionsolar_kiosks()
+            if self.fs_kiosk.transport.request_count == request_count:
+                # No kiosk made a request, e.g. all disabled or owned by another shard, the captures would never be consumed
+                self.logger.warning("RelayFusionSolarKiosk replay cycle made no API requests, stopping the replay")
+                break
+        self.logger.info(f"RelayFusionSolarKiosk finished replaying {self.fs_kiosk.transport.replayed_count} captured API responses")
+
+    def run_scheduled_cycle(self):
+        if self.polling.should_poll(self.cycle_interval_s):
+            self.process_fusionsolar_kiosks()
+
     def process_fusionsolar_kiosks(self):
-        for kiosk_settings in self.conf.fusionsolar_kiosks:
-            if kiosk_settings.enabled:
-                try:
-                    self.logger.info(f"Processing fusionsolar kiosk {kiosk_settings.descriptive_name}, with kkid {kiosk_settings.api_kkid}...")
-                    kiosk_measurement = self.fs_kiosk.fetch_fusionsolar_status(kiosk_settings)
-                    self.write_pvdata_to_influxdb(kiosk_measurement, kiosk_settings)
-                    self.write_pvdata_to_pvoutput(kiosk_measurement, kiosk_settings)
-                    self.publish_pvdata_to_mqtt(kiosk_measurement, kiosk_settings)
-                except Exception as e:
-                    self.logger.exception(f"Exception while processing fusionsolar kiosk [{kiosk_settings.descriptive_name}] with kkid [{kiosk_settings.api_kkid}]:\n{e}")
-            else:
-                self.logger.info(f"Skipping disabled fusionsolar kiosk {kiosk_settings.descriptive_name}, with kkid {kiosk_settings.api_kkid}...")
+        with self.cycle_lock, self.profiler.profile(), metrics.cycle("fusionsolar_kiosk", self.cycle_interval_s, self.logger if self.conf.metrics_cycle_summary_enabled else None):
+            # Replays run cycles back to back, they are never cut short
+            self.budget = CycleBudget(self.conf, self.logger, "fusionsolar_kiosk", None if self.conf.capture_mode == "replay" else self.cycle_interval_s)
+            for kiosk_idx, kiosk_settings in enumerate(self.conf.fusionsolar_kiosks):
+                if shutdown.is_requested():
+                    # Every kiosk is written right after fetching, so the cycle can stop between kiosks
+                    self.logger.warning(f"Shutdown requested, skipping the remaining {len(self.conf.fusionsolar_kiosks) - kiosk_idx} fusionsolar kiosk(s) of this cycle")
+                    break
+                if not self.shards.owns(kiosk_settings.api_kkid):
+                    self.logger.debug(f"Skipping fusionsolar kiosk {kiosk_settings.descriptive_name}, with kkid {kiosk_settings.api_kkid}, owned by another shard...")
+                elif kiosk_settings.enabled and self.budget.device_allowed():
+                    try:
+                        self.logger.debug(f"Processing fusionsolar kiosk {kiosk_settings.descriptive_name}, with kkid {kiosk_settings.api_kkid}...")
+                        kiosk_measurement = self.fs_kiosk.fetch_fusionsolar_status(kiosk_settings)
+                        metrics.inc("measurements_total", relay="fusionsolar_kiosk", measurement_type=kiosk_measurement.measurement_type)
+                        self.polling.observe([kiosk_measurement])
+                        if self.measurement_buffer is not None:
+                            self.measurement_buffer.add_measurement(f"kiosk/{kiosk_settings.api_kkid}", kiosk_settings.descriptive_name, kiosk_measurement)
+                        self.write_pvdata_to_influxdb(kiosk_measurement, kiosk_settings)
+                        self.write_pvdata_to_sqlite(kiosk_measurement, kiosk_settings)
+                        self.write_pvdata_to_archive(kiosk_measurement, kiosk_settings)
+                        self.write_pvdata_to_pvoutput(kiosk_measurement, kiosk_settings)
+                        self.publish_pvdata_to_mqtt(kiosk_measurement, kiosk_settings)
+                    except Exception as e:
+                        metrics.inc("device_errors_total", relay="fusionsolar_kiosk")
+                        self.logger.exception(f"Exception while processing fusionsolar kiosk [{kiosk_settings.descriptive_name}] with kkid [{kiosk_settings.api_kkid}]:\n{e}")
+                elif not kiosk_settings.enabled:
+                    self.logger.debug(f"Skipping disabled fusionsolar kiosk {kiosk_settings.descriptive_name}, with kkid {kiosk_settings.api_kkid}...")
+
+            self.publish_station_payloads_to_mqtt()
+
+            # Persist the stream filter state, the SQLite rows and the archive rows once per cycle
+            self.device_state.flush()
+            self.sqlite.flush()
+            self.archive.flush()
+            self.polling.cycle_finished(self.cycle_interval_s)
 
         self.logger.info("Waiting for next FusionSolar Kiosk interval...")
 
     def write_pvdata_to_pvoutput(self, kiosk_measurement: FusionSolarInverterMeasurement, kiosk_settings: FusionSolarKioskSettings):
-        if self.conf.pvoutput_module_enabled and kiosk_settings.output_pvoutput:
+        if self.conf.pvoutput_module_enabled and kiosk_settings.output_pvoutput and self.budget.sink_allowed("pvoutput"):
             try:
-                self.pvoutput.write_pvdata_to_pvoutput(kiosk_measurement, kiosk_settings.api_kkid, kiosk_settings.output_pvoutput_system_id)
+                with metrics.timer("sink_write_seconds", stage="write_pvoutput", sink="pvoutput"):
+                    self.pvoutput.write_pvdata_to_pvoutput(kiosk_measurement, kiosk_settings.api_kkid, kiosk_settings.output_pvoutput_system_id)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(f"Error writing PV data to PVOutput.org for fusionsolar kiosk [{kiosk_settings.descriptive_name}] with kkid [{kiosk_settings.api_kkid}]: {e}")
@@ -62,9 +172,10 @@ class RelayFusionSolarKiosk:
             self.logger.debug(f"Skipping publishing to PvOutput, module disabled, or PVOutput disabled in fusionsolar kiosk config.")
 
     def publish_pvdata_to_mqtt(self, kiosk_measurement: FusionSolarInverterMeasurement, kiosk_settings: FusionSolarKioskSettings):
-        if self.conf.mqtt_module_enabled and kiosk_settings.output_mqtt:
+        if self.conf.mqtt_module_enabled and kiosk_settings.output_mqtt and self.budget.sink_allowed("mqtt"):
             try:
-                self.mqtt.publish_pvdata_to_mqtt(kiosk_measurement)
+                with metrics.timer("sink_write_seconds", stage="write_mqtt", sink="mqtt"):
+                    self.mqtt.publish_pvdata_to_mqtt(kiosk_measurement)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(f"Error publishing PV data to MQTT for fusionsolar kiosk [{kiosk_settings.descriptive_name}] with kkid [{kiosk_settings.api_kkid}]: {e}")
@@ -72,11 +183,43 @@ class RelayFusionSolarKiosk:
             self.logger.debug(f"Skipping publishing to MQTT, module disabled, or MQTT output disabled in fusionsolar kiosk config.")
 
     def write_pvdata_to_influxdb(self, kiosk_measurement: FusionSolarInverterMeasurement, kiosk_settings: FusionSolarKioskSettings):
-        if self.conf.influxdb_module_enabled and kiosk_settings.output_influxdb:
+        if self.conf.influxdb_module_enabled and kiosk_settings.output_influxdb and self.budget.sink_allowed("influxdb"):
             try:
-                self.influxdb.write_pvdata_to_influxdb(kiosk_measurement)
+                with metrics.timer("sink_write_seconds", stage="write_influxdb", sink="influxdb"):
+                    self.influxdb.write_pvdata_to_influxdb(kiosk_measurement)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(f"Error publishing PV data to InfluxDB for fusionsolar kiosk [{kiosk_settings.descriptive_name}] with kkid [{kiosk_settings.api_kkid}]: {e}")
         else:
             self.logger.debug(f"Skipping publishing to InfluxDB, module disabled, or InfluxDB output disabled in fusionsolar kiosk config.")
+
+    def write_pvdata_to_sqlite(self, kiosk_measurement: FusionSolarInverterMeasurement, kiosk_settings: FusionSolarKioskSettings):
+        if self.conf.sqlite_module_enabled and kiosk_settings.output_sqlite and self.budget.sink_allowed("sqlite"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_sqlite", sink="sqlite"):
+                    self.sqlite.write_pvdata_to_sqlite(kiosk_measurement)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(f"Error writing PV data to SQLite for fusionsolar kiosk [{kiosk_settings.descriptive_name}] with kkid [{kiosk_settings.api_kkid}]: {e}")
+        else:
+            self.logger.debug(f"Skipping writing to SQLite, module disabled, or SQLite output disabled in fusionsolar kiosk config.")
+
+    def write_pvdata_to_archive(self, kiosk_measurement: FusionSolarInverterMeasurement, kiosk_settings: FusionSolarKioskSettings):
+        if self.conf.archive_module_enabled and kiosk_settings.output_archive and self.budget.sink_allowed("archive"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_archive", sink="archive"):
+                    self.archive.write_pvdata_to_archive(kiosk_measurement)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(f"Error writing PV data to the archive for fusionsolar kiosk [{kiosk_settings.descriptive_name}] with kkid [{kiosk_settings.api_kkid}]: {e}")
+        else:
+            self.logger.debug(f"Skipping writing to the archive, module disabled, or archive output disabled in fusionsolar kiosk config.")
+
+    def publish_station_payloads_to_mqtt(self):
+        # Station payloads collect the devices published during the cycle, see mqtt_payload_mode
+        try:
+            with metrics.timer("sink_write_seconds", stage="write_mqtt", sink="mqtt"):
+                self.mqtt.publish_station_payloads()
+        except Exception as e:
+            # Log but do not raise, the cycle should finish.
+            self.logger.exception(f"Error publishing station payloads to MQTT: {e}")
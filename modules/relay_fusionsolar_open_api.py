@@ -1,11 +1,25 @@
 import logging
+import threading
 import time
+from typing import Union
+from concurrent.futures import ThreadPoolExecutor
 from apscheduler.schedulers.blocking import BlockingScheduler
+from modules.adaptive_polling import AdaptivePolling
+from modules.config_reload import config_reload
+from modules.cycle_profiler import CycleProfiler
+from modules.shutdown import shutdown
+from modules.measurement_buffer import get_measurement_buffer
+from modules.metrics import metrics
+from modules.cycle_budget import CycleBudget
+from modules.scheduling import add_cron_job, cron_interval_seconds
 from modules.conf_models import PyFusionSolarSettings, FusionSolarOpenApiInverterSettings
 from modules.write_influxdb import WriteInfluxDb
+from modules.write_archive import WriteArchive
+from modules.write_sqlite import WriteSqlite
 from modules.write_pvoutput import WritePvOutput
-from modules.fetch_fusion_solar_open_api import FetchFusionSolarOpenApi
+from modules.fetch_fusion_solar_open_api import FetchFusionSolarOpenApi, OPEN_API_DEVICE_TYPES, PlannedRequest, get_open_api_accounts
 from modules.write_mqtt import WriteMqtt
+from modules.device_state import get_device_state_store
 from modules.models import *
 
 
@@ -15,64 +29,267 @@ class RelayFusionSolarOpenApi:
         self.logger = logger
         self.logger.debug("RelayFusionSolarOpenApiOpenApi class instantiated")
 
-        self.fs_open_api = FetchFusionSolarOpenApi(conf, logger)
+        self.fs_open_apis = []
+        self.update_accounts()
         self.pvoutput = WritePvOutput(conf, logger)
         self.mqtt = WriteMqtt(conf, logger)
         self.influxdb = WriteInfluxDb(self.conf, self.logger)
+        self.sqlite = WriteSqlite(self.conf, self.logger)
+        self.archive = WriteArchive(self.conf, self.logger)
+        self.profiler = CycleProfiler(conf, logger, "fusionsolar_open_api")
+        self.sched = None
+        # Held while a cycle runs, so shutdown can wait for the in-progress cycle
+        self.cycle_lock = threading.Lock()
+        self.budget = CycleBudget(conf, logger, "fusionsolar_open_api", None)
+        self.device_state = get_device_state_store(conf, logger)
+        self.measurement_buffer = get_measurement_buffer(conf, logger) if conf.measurement_buffer_enabled else None
+        self.polling = AdaptivePolling(conf, logger, "fusionsolar_open_api")
+
+        self.cycle_interval_s = cron_interval_seconds(self.conf.fusionsolar_open_api_cron_hour, self.conf.fusionsolar_open_api_cron_minute)
+
+    def start(self):
+        """
+        Blocking, runs the initial fetch if configured and then the cron scheduler.
+        """
+        shutdown.register("RelayFusionSolarOpenApi", self.stop)
+        config_reload.register("RelayFusionSolarOpenApi", self.reload_config)
+        if self.conf.capture_mode == "replay":
+            self.run_replay()
+            return
 
         self.logger.info("Starting RelayFusionSolarOpenApi on separate thread...")
         self.logger.debug("RelayFusionSolarOpenApi waiting 5sec to initialize docker-compose containers")
-        time.sleep(5)
+        if shutdown.wait(5):
+            return
 
         if self.conf.fetch_on_startup:
             self.logger.info("Starting process_fusionsolar_open_apis() at init, before waiting for cron, because fetch_on_startup is set")
             self.process_fusionsolar_open_apis()
 
         self.logger.info(f"Setting cron trigger to run fusionsolar open_api processing at hour: [{self.conf.fusionsolar_open_api_cron_hour}], minute: [{self.conf.fusionsolar_open_api_cron_minute}]")
+        if shutdown.is_requested():
+            return
         self.sched = BlockingScheduler(standalone=True)
-        self.sched.add_job(self.process_fusionsolar_open_apis, trigger="cron", hour=self.conf.fusionsolar_open_api_cron_hour, minute=self.conf.fusionsolar_open_api_cron_minute)
+        add_cron_job(self.sched, self.run_scheduled_cycle, "fusionsolar_open_api", "fusionsolar_open_api", self.conf.fusionsolar_open_api_cron_hour, self.conf.fusionsolar_open_api_cron_minute, self.conf, self.logger)
         self.sched.start()
 
+    def stop(self):
+        """
+        Stop the scheduler, wait for the in-progress cycle to finish and close the sinks. Called on shutdown.
+        """
+        self.logger.info("Stopping RelayFusionSolarOpenApi...")
+        if self.sched is not None and self.sched.running:
+            self.sched.shutdown(wait=False)
+        with self.cycle_lock:
+            self.influxdb.close()
+            self.sqlite.close()
+            self.archive.close()
+        self.logger.info("RelayFusionSolarOpenApi stopped")
+
+    def update_accounts(self):
+        """
+        Create a fetcher for each enabled account. Fetchers of unchanged accounts are kept with their token and metadata cache.
+        """
+        accounts = [account for account in get_open_api_accounts(self.conf) if account.enabled]
+        account_names = [account.descriptive_name for account in accounts]
+        if len(set(account_names)) != len(account_names):
+            raise Exception(f"FusionSolar OpenAPI account descriptive_name values must be unique, found: {', '.join(account_names)}")
+
+        current_fs_open_apis = {fs_open_api.account_name: fs_open_api for fs_open_api in self.fs_open_apis}
+        fs_open_apis = []
+        for account in accounts:
+            fs_open_api = current_fs_open_apis.get(account.descriptive_name)
+            if fs_open_api is None or fs_open_api.account != account or fs_open_api.api_url != (account.api_url or self.conf.fusionsolar_open_api_url):
+                fs_open_api = FetchFusionSolarOpenApi(self.conf, self.logger, account)
+            fs_open_apis.append(fs_open_api)
+        # Swapped at once, a running cycle keeps polling the accounts it started with
+        self.fs_open_apis = fs_open_apis
+
+    def reload_config(self, changed_fields):
+        """
+        Apply reloaded settings to the accounts and device indexes. Only a changed cron is rescheduled. Called on config reload.
+        """
+        self.influxdb.reload_config(changed_fields)
+        self.sqlite.reload_config(changed_fields)
+        self.archive.reload_config(changed_fields)
+        self.mqtt.reload_config(changed_fields)
+        if {"fusionsolar_open_api_accounts", "fusionsolar_open_api_url", "fusionsolar_open_api_user_name", "fusionsolar_open_api_system_code"} & changed_fields:
+            self.update_accounts()
+            self.logger.info(f"FusionSolar OpenAPI accounts: {', '.join(fs_open_api.account_name for fs_open_api in self.fs_open_apis)}")
+        if {"fusionsolar_open_api_inverters", "fusionsolar_open_api_meters"} & changed_fields:
+            for fs_open_api in self.fs_open_apis:
+                fs_open_api.update_device_settings()
+        if {"fusionsolar_open_api_cron_hour", "fusionsolar_open_api_cron_minute"} & changed_fields:
+            self.cycle_interval_s = cron_interval_seconds(self.conf.fusionsolar_open_api_cron_hour, self.conf.fusionsolar_open_api_cron_minute)
+            if self.sched is not None and self.sched.running:
+                self.sched.reschedule_job("fusionsolar_open_api", trigger="cron", hour=self.conf.fusionsolar_open_api_cron_hour, minute=self.conf.fusionsolar_open_api_cron_minute)
+                self.logger.info(f"Rescheduled fusionsolar open_api processing at hour: [{self.conf.fusionsolar_open_api_cron_hour}], minute: [{self.conf.fusionsolar_open_api_cron_minute}]")
+
+    def run_replay(self):
+        """
+        Run cycles back to back on captured API traffic until all captures are replayed, instead of starting the cron scheduler.
+        """
+        self.logger.info("Starting RelayFusionSolarOpenApi in replay mode...")
+        while not all(fs_open_api.transport.exhausted for fs_open_api in self.fs_open_apis) and not shutdown.is_requested():
+            # Captured cycles are replayed back to back, not limited to one request per device type per minute
+            for fs_open_api in self.fs_open_apis:
+                fs_open_api.last_request_times.clear()
+            request_count = sum(fs_open_api.transport.request_count for fs_open_api in self.fs_open_apis)
+            self.process_fusionsolar_open_apis()
+            if sum(fs_open_api.transport.request_count for fs_open_api in self.fs_open_apis) == request_count:
+                self.logger.warning("RelayFusionSolarOpenApi replay cycle made no API requests, stopping the replay")
+                break
+        replayed_count = sum(fs_open_api.transport.replayed_count for fs_open_api in self.fs_open_apis)
+        self.logger.info(f"RelayFusionSolarOpenApi finished replaying {replayed_count} captured API responses")
+
+    def run_scheduled_cycle(self):
+        if self.polling.should_poll(self.cycle_interval_s):
+            self.process_fusionsolar_open_apis()
+
     def process_fusionsolar_open_apis(self):
-        self.process_fusionsolar_openapi_inverters()
-        self.process_fusionsolar_openapi_grid_meters()
+        with self.cycle_lock, self.profiler.profile(), metrics.cycle("fusionsolar_open_api", self.cycle_interval_s, self.logger if self.conf.metrics_cycle_summary_enabled else None) as cycle:
+            # Replays run cycles back to back, they are never cut short
+            self.budget = CycleBudget(self.conf, self.logger, "fusionsolar_open_api", None if self.conf.capture_mode == "replay" else self.cycle_interval_s)
+            if len(self.fs_open_apis) == 1:
+                self.process_fusionsolar_open_api_account(self.fs_open_apis[0])
+            else:
+                # API quotas are per account, so accounts are polled concurrently
+                def process_account(fs_open_api: FetchFusionSolarOpenApi):
+                    metrics.bind_cycle(cycle)
+                    try:
+                        with self.profiler.profile_thread():
+                            self.process_fusionsolar_open_api_account(fs_open_api)
+                    finally:
+                        metrics.bind_cycle(None)
+
+                with ThreadPoolExecutor(max_workers=max(1, min(len(self.fs_open_apis), self.conf.fusionsolar_open_api_max_parallel_accounts)), thread_name_prefix="OpenApiAccount") as executor:
+                    # Exceptions are handled per account, list() waits for all accounts to finish
+                    list(executor.map(process_account, self.fs_open_apis))
+
+            self.publish_station_payloads_to_mqtt()
+
+            # Persist the stream filter state, the SQLite rows and the archive rows once per cycle
+            self.device_state.flush()
+            self.sqlite.flush()
+            self.archive.flush()
+            self.polling.cycle_finished(self.cycle_interval_s)
 
         self.logger.info("Waiting for next FusionSolar interval...")
 
-    def process_fusionsolar_openapi_inverters(self):
+    def process_fusionsolar_open_api_account(self, fs_open_api: FetchFusionSolarOpenApi):
+        try:
+            # Captured traffic is replayed back to back
+            window_s = 0 if self.conf.capture_mode == "replay" else (self.cycle_interval_s or 0) * self.conf.fusionsolar_open_api_request_spread_fraction
+            planned_requests = fs_open_api.plan_realtime_requests(window_s, self.conf.fusionsolar_open_api_min_request_interval_seconds)
+        except Exception as e:
+            metrics.inc("device_errors_total", relay="fusionsolar_open_api")
+            self.logger.exception(f"Exception while planning fusionsolar open_api requests for account {fs_open_api.account_name}:\n{e}")
+            return
+        if planned_requests and self.cycle_interval_s and planned_requests[-1].offset_s > self.cycle_interval_s:
+            self.logger.warning(
+                f"The {len(planned_requests)} realtime requests of account {fs_open_api.account_name} take {planned_requests[-1].offset_s:.0f}s within the request quota, "
+                f"longer than the {self.cycle_interval_s:.0f}s cron interval. Lower the polling rate or split the devices over more accounts"
+            )
+
+        cycle_started = time.time()
+        failed_dev_type_ids = set()
+        for request_idx, planned_request in enumerate(planned_requests):
+            # Waiting for the planned offset keeps the account within its request quota
+            with metrics.timer("rate_limit_wait_seconds", stage="rate_limit_wait", api="fusionsolar_open_api", account=fs_open_api.account_name):
+                shutdown_requested = shutdown.wait(max(0, cycle_started + planned_request.offset_s - time.time()))
+            if shutdown_requested:
+                self.logger.warning(f"Shutdown requested, skipping the remaining {len(planned_requests) - request_idx} realtime request(s) of account {fs_open_api.account_name}")
+                return
+            if not self.budget.device_allowed(len(planned_request.device_ids)):
+                # Skipped devices are polled in the next cycle, the history watermark of their type is not advanced
+                failed_dev_type_ids.add(planned_request.device_type.dev_type_id)
+                continue
+            if not self.process_fusionsolar_openapi_devices(fs_open_api, planned_request):
+                failed_dev_type_ids.add(planned_request.device_type.dev_type_id)
+            elif planned_request.last_of_type and planned_request.device_type.dev_type_id not in failed_dev_type_ids:
+                # All devices of the type are polled, so measurements are complete up to now
+                fs_open_api.advance_history_watermark(planned_request.device_type.dev_type_id, fs_open_api.transport.now())
+
+        for device_type in OPEN_API_DEVICE_TYPES:
+            self.process_fusionsolar_openapi_history(fs_open_api, device_type.dev_type_id)
+
+    def process_fusionsolar_openapi_devices(self, fs_open_api: FetchFusionSolarOpenApi, planned_request: PlannedRequest) -> bool:
+        """
+        Fetch one planned batch of devices and write the measurements, returns False if the request failed.
+        """
+        measurement_type = planned_request.device_type.measurement_type
         try:
-            self.logger.info(f"Processing fusionsolar OpenAPI inverters...")
-            inverter_measurements = self.fs_open_api.fetch_fusionsolar_inverter_device_kpis()
-            
-            for inverter_measurement in inverter_measurements:
-                if not (inverter_measurement.settings is not None and inverter_measurement.settings.enabled == False):
-                    self.write_pvdata_to_influxdb(inverter_measurement)
-                    self.publish_pvdata_to_mqtt(inverter_measurement)
-                    self.write_pvdata_to_pvoutput(inverter_measurement)
+            self.logger.info(f"Processing fusionsolar OpenAPI {measurement_type} batch of {len(planned_request.device_ids)} device(s) for account {fs_open_api.account_name}...")
+            measurements = fs_open_api.fetch_device_kpis(planned_request.device_type, planned_request.device_ids)
+            metrics.inc("measurements_total", len(measurements), relay="fusionsolar_open_api", measurement_type=measurement_type)
+            self.polling.observe(measurements)
+
+            for measurement in measurements:
+                if not (measurement.settings is not None and measurement.settings.enabled == False):
+                    if self.measurement_buffer is not None:
+                        self.measurement_buffer.add_measurement(f"openapi/{measurement.device_id}", measurement.settings_descriptive_name or measurement.device_name, measurement)
+                    if measurement_type == "grid_meter":
+                        self.write_grid_data_to_influxdb(measurement)
+                        self.write_grid_data_to_sqlite(measurement)
+                        self.write_grid_data_to_archive(measurement)
+                        self.publish_grid_data_to_mqtt(measurement)
+                    else:
+                        self.write_pvdata_to_influxdb(measurement)
+                        self.write_pvdata_to_sqlite(measurement)
+                        self.write_pvdata_to_archive(measurement)
+                        self.publish_pvdata_to_mqtt(measurement)
+                        self.write_pvdata_to_pvoutput(measurement)
                 else:
-                    self.logger.info(f"Skipping disabled fusionsolar open_api {inverter_measurement.settings_descriptive_name}, with dev_id {inverter_measurement.settings_device_id}...")
+                    self.logger.debug(f"Skipping disabled fusionsolar open_api {measurement.settings_descriptive_name}, with dev_id {measurement.settings_device_id}...")
+            return True
 
         except Exception as e:
-            self.logger.exception(f"Exception while processing fusionsolar open_api inverters:\n{e}")
+            metrics.inc("device_errors_total", relay="fusionsolar_open_api")
+            self.logger.exception(f"Exception while processing fusionsolar open_api {measurement_type} batch for account {fs_open_api.account_name}:\n{e}")
+            return False
 
-    def process_fusionsolar_openapi_grid_meters(self):
+    def process_fusionsolar_openapi_history(self, fs_open_api: FetchFusionSolarOpenApi, dev_type_id: int):
+        # Backfilled history goes to the InfluxDB, SQLite and archive sinks, MQTT and PVOutput carry the current state
+        if not (self.conf.influxdb_module_enabled or self.conf.sqlite_module_enabled or self.conf.archive_module_enabled) or not self.budget.sink_allowed("backfill"):
+            return
         try:
-            self.logger.info(f"Processing fusionsolar OpenAPI grid meters...")
-            grid_meter_measurements = self.fs_open_api.fetch_fusionsolar_grid_meter_device_kpis()
-            for grid_meter_measurement in grid_meter_measurements:
-                if not (grid_meter_measurement.settings is not None and grid_meter_measurement.settings.enabled == False):
-                    self.write_grid_data_to_influxdb(grid_meter_measurement)
-                    self.publish_grid_data_to_mqtt(grid_meter_measurement)
+            history_measurements = [measurement for measurement in fs_open_api.fetch_device_history_kpis(dev_type_id) if measurement.settings is None or measurement.settings.enabled]
+            if not history_measurements:
+                return
+            metrics.inc("backfilled_measurements_total", len(history_measurements), relay="fusionsolar_open_api", measurement_type=history_measurements[0].measurement_type)
+            self.write_history_to_influxdb(history_measurements)
+            for measurement in history_measurements:
+                if isinstance(measurement, FusionSolarMeterMeasurement):
+                    self.write_grid_data_to_sqlite(measurement)
+                    self.write_grid_data_to_archive(measurement)
                 else:
-                    self.logger.info(f"Skipping disabled fusionsolar open_api {grid_meter_measurement.settings_descriptive_name}, with dev_id {grid_meter_measurement.settings_device_id}...")
-
+                    self.write_pvdata_to_sqlite(measurement)
+                    self.write_pvdata_to_archive(measurement)
         except Exception as e:
-            self.logger.exception(f"Exception while processing fusionsolar open_api grid meters:\n{e}")
+            metrics.inc("device_errors_total", relay="fusionsolar_open_api")
+            self.logger.exception(f"Exception while backfilling fusionsolar open_api devTypeId {dev_type_id} history for account {fs_open_api.account_name}:\n{e}")
+
+    def write_history_to_influxdb(self, history_measurements: list[Union[FusionSolarInverterMeasurement, FusionSolarMeterMeasurement]]):
+        history_measurements = [
+            measurement
+            for measurement in history_measurements
+            if (measurement.settings is not None and measurement.settings.output_influxdb) or (measurement.settings is None and self.conf.fusionsolar_open_api_influxdb_for_discovered_dev)
+        ]
+        if self.conf.influxdb_module_enabled and history_measurements and self.budget.sink_allowed("influxdb"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_influxdb", sink="influxdb"):
+                    self.influxdb.write_history_to_influxdb(history_measurements)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(f"Error writing {len(history_measurements)} backfilled measurements to InfluxDB for fusionsolar open_api: {e}")
+        else:
+            self.logger.debug(f"Skipping writing backfilled measurements to InfluxDB, module disabled, or InfluxDB output disabled in fusionsolar open_api config.")
 
     def write_pvdata_to_pvoutput(self, inverter_measurement: FusionSolarInverterMeasurement):
-        if self.conf.pvoutput_module_enabled and (inverter_measurement.settings is not None and inverter_measurement.settings.output_pvoutput):
+        if self.conf.pvoutput_module_enabled and (inverter_measurement.settings is not None and inverter_measurement.settings.output_pvoutput) and self.budget.sink_allowed("pvoutput"):
             try:
-                self.pvoutput.write_pvdata_to_pvoutput(inverter_measurement, inverter_measurement.settings.dev_id, inverter_measurement.settings.output_pvoutput_system_id)
+                with metrics.timer("sink_write_seconds", stage="write_pvoutput", sink="pvoutput"):
+                    self.pvoutput.write_pvdata_to_pvoutput(inverter_measurement, inverter_measurement.settings.dev_id, inverter_measurement.settings.output_pvoutput_system_id)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(
@@ -82,9 +299,10 @@ class RelayFusionSolarOpenApi:
             self.logger.debug(f"Skipping publishing to PvOutpu, module disabled, or PVOutput disabled in fusionsolar open_api config.")
 
     def publish_pvdata_to_mqtt(self, inverter_measurement: FusionSolarInverterMeasurement):
-        if self.conf.mqtt_module_enabled and ((inverter_measurement.settings is not None and inverter_measurement.settings.output_mqtt) or self.conf.fusionsolar_open_api_mqtt_for_discovered_dev):
+        if self.conf.mqtt_module_enabled and ((inverter_measurement.settings is not None and inverter_measurement.settings.output_mqtt) or self.conf.fusionsolar_open_api_mqtt_for_discovered_dev) and self.budget.sink_allowed("mqtt"):
             try:
-                self.mqtt.publish_pvdata_to_mqtt(inverter_measurement)
+                with metrics.timer("sink_write_seconds", stage="write_mqtt", sink="mqtt"):
+                    self.mqtt.publish_pvdata_to_mqtt(inverter_measurement)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(
@@ -96,9 +314,10 @@ class RelayFusionSolarOpenApi:
     def write_pvdata_to_influxdb(self, inverter_measurement: FusionSolarInverterMeasurement):
         if self.conf.influxdb_module_enabled and (
             (inverter_measurement.settings is not None and inverter_measurement.settings.output_influxdb) or self.conf.fusionsolar_open_api_influxdb_for_discovered_dev
-        ):
+        ) and self.budget.sink_allowed("influxdb"):
             try:
-                self.influxdb.write_pvdata_to_influxdb(inverter_measurement)
+                with metrics.timer("sink_write_seconds", stage="write_influxdb", sink="influxdb"):
+                    self.influxdb.write_pvdata_to_influxdb(inverter_measurement)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(
@@ -108,9 +327,10 @@ class RelayFusionSolarOpenApi:
             self.logger.debug(f"Skipping publishing to InfluxDB, module disabled, or InfluxDB output disabled in fusionsolar open_api config.")
 
     def publish_grid_data_to_mqtt(self, meter_measurement: FusionSolarMeterMeasurement):
-        if self.conf.mqtt_module_enabled and ((meter_measurement.settings is not None and meter_measurement.settings.output_mqtt) or self.conf.fusionsolar_open_api_mqtt_for_discovered_dev):
+        if self.conf.mqtt_module_enabled and ((meter_measurement.settings is not None and meter_measurement.settings.output_mqtt) or self.conf.fusionsolar_open_api_mqtt_for_discovered_dev) and self.budget.sink_allowed("mqtt"):
             try:
-                self.mqtt.publish_grid_data_to_mqtt(meter_measurement)
+                with metrics.timer("sink_write_seconds", stage="write_mqtt", sink="mqtt"):
+                    self.mqtt.publish_grid_data_to_mqtt(meter_measurement)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(
@@ -122,9 +342,10 @@ class RelayFusionSolarOpenApi:
     def write_grid_data_to_influxdb(self, meter_measurement: FusionSolarMeterMeasurement):
         if self.conf.influxdb_module_enabled and (
             (meter_measurement.settings is not None and meter_measurement.settings.output_influxdb) or self.conf.fusionsolar_open_api_influxdb_for_discovered_dev
-        ):
+        ) and self.budget.sink_allowed("influxdb"):
             try:
-                self.influxdb.write_grid_data_to_influxdb(meter_measurement)
+                with metrics.timer("sink_write_seconds", stage="write_influxdb", sink="influxdb"):
+                    self.influxdb.write_grid_data_to_influxdb(meter_measurement)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(
@@ -132,3 +353,72 @@ class RelayFusionSolarOpenApi:
                 )
         else:
             self.logger.debug(f"Skipping publishing to InfluxDB, module disabled, or InfluxDB output disabled in fusionsolar open_api config.")
+
+    def write_pvdata_to_sqlite(self, inverter_measurement: FusionSolarInverterMeasurement):
+        if self.conf.sqlite_module_enabled and (
+            inverter_measurement.settings.output_sqlite if inverter_measurement.settings is not None else self.conf.fusionsolar_open_api_sqlite_for_discovered_dev
+        ) and self.budget.sink_allowed("sqlite"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_sqlite", sink="sqlite"):
+                    self.sqlite.write_pvdata_to_sqlite(inverter_measurement)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(
+                    f"Error writing PV data to SQLite for fusionsolar open_api [{inverter_measurement.settings_descriptive_name}] with dev_id [{inverter_measurement.settings_device_id}]: {e}"
+                )
+        else:
+            self.logger.debug(f"Skipping writing to SQLite, module disabled, or SQLite output disabled in fusionsolar open_api config.")
+
+    def write_grid_data_to_sqlite(self, meter_measurement: FusionSolarMeterMeasurement):
+        if self.conf.sqlite_module_enabled and (
+            meter_measurement.settings.output_sqlite if meter_measurement.settings is not None else self.conf.fusionsolar_open_api_sqlite_for_discovered_dev
+        ) and self.budget.sink_allowed("sqlite"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_sqlite", sink="sqlite"):
+                    self.sqlite.write_grid_data_to_sqlite(meter_measurement)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(
+                    f"Error writing grid meter data to SQLite for fusionsolar open_api [{meter_measurement.settings_descriptive_name}] with dev_id [{meter_measurement.settings_device_id}]: {e}"
+                )
+        else:
+            self.logger.debug(f"Skipping writing to SQLite, module disabled, or SQLite output disabled in fusionsolar open_api config.")
+
+    def write_pvdata_to_archive(self, inverter_measurement: FusionSolarInverterMeasurement):
+        if self.conf.archive_module_enabled and (
+            inverter_measurement.settings.output_archive if inverter_measurement.settings is not None else self.conf.fusionsolar_open_api_archive_for_discovered_dev
+        ) and self.budget.sink_allowed("archive"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_archive", sink="archive"):
+                    self.archive.write_pvdata_to_archive(inverter_measurement)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(
+                    f"Error writing PV data to the archive for fusionsolar open_api [{inverter_measurement.settings_descriptive_name}] with dev_id [{inverter_measurement.settings_device_id}]: {e}"
+                )
+        else:
+            self.logger.debug(f"Skipping writing to the archive, module disabled, or archive output disabled in fusionsolar open_api config.")
+
+    def write_grid_data_to_archive(self, meter_measurement: FusionSolarMeterMeasurement):
+        if self.conf.archive_module_enabled and (
+            meter_measurement.settings.output_archive if meter_measurement.settings is not None else self.conf.fusionsolar_open_api_archive_for_discovered_dev
+        ) and self.budget.sink_allowed("archive"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_archive", sink="archive"):
+                    self.archive.write_grid_data_to_archive(meter_measurement)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(
+                    f"Error writing grid meter data to the archive for fusionsolar open_api [{meter_measurement.settings_descriptive_name}] with dev_id [{meter_measurement.settings_device_id}]: {e}"
+                )
+        else:
+            self.logger.debug(f"Skipping writing to the archive, module disabled, or archive output disabled in fusionsolar open_api config.")
+
+    def publish_station_payloads_to_mqtt(self):
+        # Station payloads collect the devices published during the cycle, see mqtt_payload_mode
+        try:
+            with metrics.timer("sink_write_seconds", stage="write_mqtt", sink="mqtt"):
+                self.mqtt.publish_station_payloads()
+        except Exception as e:
+            # Log but do not raise, the cycle should finish.
+            self.logger.exception(f"Error publishing station payloads to MQTT: {e}")
@@ -1,8 +1,18 @@
 import logging
-import time
+import threading
 from apscheduler.schedulers.blocking import BlockingScheduler
+from modules.config_reload import config_reload
+from modules.cycle_profiler import CycleProfiler
+from modules.shutdown import shutdown
+from modules.measurement_buffer import get_measurement_buffer
+from modules.metrics import metrics
+from modules.cycle_budget import CycleBudget
+from modules.scheduling import add_cron_job, cron_interval_seconds
 from modules.models import KenterTransformerMeasurements
+from modules.sharding import get_shard_coordinator
 from modules.write_influxdb import WriteInfluxDb
+from modules.write_archive import WriteArchive
+from modules.write_sqlite import WriteSqlite
 from modules.write_pvoutput import WritePvOutput
 from modules.conf_models import PyFusionSolarSettings, KenterMeterSettings
 from modules.fetch_kenter import FetchKenter, FetchKenterMissingChannelId
@@ -19,6 +29,28 @@ class RelayKenter:
         self.pvoutput = WritePvOutput(conf, logger)
         self.mqtt = WriteMqtt(conf, logger)
         self.influxdb = WriteInfluxDb(self.conf, self.logger)
+        self.sqlite = WriteSqlite(self.conf, self.logger)
+        self.archive = WriteArchive(self.conf, self.logger)
+        self.profiler = CycleProfiler(conf, logger, "kenter")
+        self.sched = None
+        # Held while a cycle runs, so shutdown can wait for the in-progress cycle
+        self.cycle_lock = threading.Lock()
+        self.bulk_import = None
+        self.budget = CycleBudget(conf, logger, "kenter", None)
+        self.shards = get_shard_coordinator(conf, logger, "kenter")
+        self.measurement_buffer = get_measurement_buffer(conf, logger) if conf.measurement_buffer_enabled else None
+
+        self.cycle_interval_s = cron_interval_seconds(self.conf.kenter_fetch_cron_hour, self.conf.kenter_fetch_cron_minute)
+
+    def start(self):
+        """
+        Blocking, runs the initial fetch if configured and then the cron scheduler.
+        """
+        shutdown.register("RelayKenter", self.stop)
+        config_reload.register("RelayKenter", self.reload_config)
+        if self.conf.capture_mode == "replay":
+            self.run_replay()
+            return
 
         self.logger.info("Starting RelayKenter on separate thread")
 
@@ -29,59 +61,180 @@ class RelayKenter:
             self.logger.exception(f"Could not fetch meterlist from Kenter API {e}")
 
         self.logger.debug("RelayKenter waiting 5sec to initialize docker-compose containers")
-        time.sleep(5)
+        if shutdown.wait(5):
+            return
 
         if self.conf.fetch_on_startup:
             self.logger.info("Starting process_kenter_meters() at init, before waiting for cron, because fetch_on_startup is set")
             self.process_kenter_meters()
 
         self.logger.info(f"Setting cron trigger to run kenter meter processing at hour: [{self.conf.kenter_fetch_cron_hour}], minute: [{self.conf.kenter_fetch_cron_minute}]")
+        if shutdown.is_requested():
+            return
         self.sched = BlockingScheduler(standalone=True)
-        self.sched.add_job(self.process_kenter_meters, trigger="cron", hour=self.conf.kenter_fetch_cron_hour, minute=self.conf.kenter_fetch_cron_minute)
+        add_cron_job(self.sched, self.process_kenter_meters, "kenter", "kenter", self.conf.kenter_fetch_cron_hour, self.conf.kenter_fetch_cron_minute, self.conf, self.logger)
         self.sched.start()
 
+    def stop(self):
+        """
+        Stop the scheduler, wait for the in-progress cycle to finish and close the sinks. Called on shutdown.
+        """
+        self.logger.info("Stopping RelayKenter...")
+        if self.sched is not None and self.sched.running:
+            self.sched.shutdown(wait=False)
+        with self.cycle_lock:
+            self.influxdb.close()
+            self.sqlite.close()
+            self.archive.close()
+        self.logger.info("RelayKenter stopped")
+
+    def reload_config(self, changed_fields):
+        """
+        Apply reloaded settings, metering points are read from the settings every cycle. Only a changed cron is rescheduled. Called on config reload.
+        """
+        self.influxdb.reload_config(changed_fields)
+        self.sqlite.reload_config(changed_fields)
+        self.archive.reload_config(changed_fields)
+        self.mqtt.reload_config(changed_fields)
+        if {"kenter_token_url", "kenter_clientid", "kenter_password"} & changed_fields:
+            # Request a token with the new credentials on the next API call
+            self.kenter_api.jwt_token = ""
+        if {"kenter_fetch_cron_hour", "kenter_fetch_cron_minute"} & changed_fields:
+            self.cycle_interval_s = cron_interval_seconds(self.conf.kenter_fetch_cron_hour, self.conf.kenter_fetch_cron_minute)
+            if self.sched is not None and self.sched.running:
+                self.sched.reschedule_job("kenter", trigger="cron", hour=self.conf.kenter_fetch_cron_hour, minute=self.conf.kenter_fetch_cron_minute)
+                self.logger.info(f"Rescheduled kenter meter processing at hour: [{self.conf.kenter_fetch_cron_hour}], minute: [{self.conf.kenter_fetch_cron_minute}]")
+
+    def run_replay(self):
+        """
+        Run cycles back to back on captured API traffic until all captures are replayed, instead of starting the cron scheduler.
+        """
+        self.logger.info("Starting RelayKenter in replay mode...")
+        while not self.kenter_api.transport.exhausted and not shutdown.is_requested():
+            request_count = self.kenter_api.transport.request_count
+            self.process_kenter_meters()
+            if self.kenter_api.transport.request_count == request_count:
+                # No meter made a request, e.g. none configured or all owned by another shard, the captures would never be consumed
+                self.logger.warning("RelayKenter replay cycle made no API requests, stopping the replay")
+                break
+        self.logger.info(f"RelayKenter finished replaying {self.kenter_api.transport.replayed_count} captured API responses")
+
     def process_kenter_meters(self):
-        # Run API fetch loop for each day to process for each metering point
-        daystobackfill = self.conf.kenter_days_backfill
-        for meter_settings in self.conf.kenter_metering_points:
-            if meter_settings.enabled:
-                for daysback in range(self.conf.kenter_days_back, self.conf.kenter_days_back + 1 + daystobackfill):
-                    try:
-                        transformer_measurements = self.kenter_api.fetch_gridkenter_data(
-                            meter_settings.descriptive_name, meter_settings.connection_id, meter_settings.metering_point_id, meter_settings.channel_id, daysback
-                        )
-                        self.write_gridkenter_to_influxdb(transformer_measurements, meter_settings)
-                    except FetchKenterMissingChannelId as e:
-                        self.logger.warning(
-                            f"Channel {meter_settings.channel_id} not available for date, or available at all for kenter meter [{meter_settings.descriptive_name}], connectionId: [{meter_settings.connection_id}] meteringPointId: [{meter_settings.metering_point_id}]."
+        with self.cycle_lock, self.profiler.profile(), metrics.cycle("kenter", self.cycle_interval_s, self.logger if self.conf.metrics_cycle_summary_enabled else None):
+            # Replays run cycles back to back, they are never cut short
+            self.budget = CycleBudget(self.conf, self.logger, "kenter", None if self.conf.capture_mode == "replay" else self.cycle_interval_s)
+            # Meter-days are collected into large compressed batches instead of one write request each
+            self.bulk_import = self.influxdb.start_bulk_import() if self.conf.influxdb_module_enabled and self.conf.kenter_bulk_import_enabled else None
+            try:
+                # Run API fetch loop for each day to process for each metering point
+                daystobackfill = self.conf.kenter_days_backfill
+                for meter_settings in self.conf.kenter_metering_points:
+                    if not self.shards.owns(f"{meter_settings.connection_id}/{meter_settings.metering_point_id}"):
+                        self.logger.debug(
+                            f"Skipping kenter meter [{meter_settings.descriptive_name}], connectionId: [{meter_settings.connection_id}] meteringPointId: [{meter_settings.metering_point_id}], owned by another shard..."
                         )
-                    except Exception as e:
-                        self.logger.exception(
-                            f"Exception while processing keter meter [{meter_settings.descriptive_name}], connectionId: [{meter_settings.connection_id}] meteringPointId: [{meter_settings.metering_point_id}]:\n{e}"
+                    elif meter_settings.enabled:
+                        for daysback in range(self.conf.kenter_days_back, self.conf.kenter_days_back + 1 + daystobackfill):
+                            if shutdown.is_requested():
+                                # Every day is written right after fetching, or sent with the pending bulk import batch, so the cycle can stop between days
+                                self.logger.warning(f"Shutdown requested, stopping kenter cycle before meter [{meter_settings.descriptive_name}] day {daysback} back")
+                                return
+                            if not self.budget.device_allowed():
+                                # The skipped days of this meter are fetched again in the next cycle
+                                break
+                            try:
+                                transformer_measurements = self.kenter_api.fetch_gridkenter_data(
+                                    meter_settings.descriptive_name, meter_settings.connection_id, meter_settings.metering_point_id, meter_settings.channel_id, daysback
+                                )
+                                metrics.inc("measurements_total", len(transformer_measurements), relay="kenter", measurement_type="grid_transformer")
+                                if self.measurement_buffer is not None:
+                                    self.measurement_buffer.add_kenter_measurements(f"kenter/{meter_settings.connection_id}/{meter_settings.metering_point_id}", transformer_measurements)
+                                self.write_gridkenter_to_influxdb(transformer_measurements, meter_settings)
+                                self.write_gridkenter_to_sqlite(transformer_measurements, meter_settings)
+                                self.write_gridkenter_to_archive(transformer_measurements, meter_settings)
+                            except FetchKenterMissingChannelId as e:
+                                self.logger.warning(
+                                    f"Channel {meter_settings.channel_id} not available for date, or available at all for kenter meter [{meter_settings.descriptive_name}], connectionId: [{meter_settings.connection_id}] meteringPointId: [{meter_settings.metering_point_id}]."
+                                )
+                            except Exception as e:
+                                metrics.inc("device_errors_total", relay="kenter")
+                                self.logger.exception(
+                                    f"Exception while processing keter meter [{meter_settings.descriptive_name}], connectionId: [{meter_settings.connection_id}] meteringPointId: [{meter_settings.metering_point_id}]:\n{e}"
+                                )
+
+                            # Go easy on the API to avoid HTTP status 429 (too many requests)
+                            if self.kenter_api.transport.live:
+                                with metrics.timer("api_pacing_seconds", stage="api_pacing", api="kenter"):
+                                    shutdown.wait(self.conf.kenter_request_interval_seconds)
+                    else:
+                        self.logger.debug(
+                            f"Skipping disabled kenter meter [{meter_settings.descriptive_name}], connectionId: [{meter_settings.connection_id}] meteringPointId: [{meter_settings.metering_point_id}]..."
                         )
 
-                    # Go easy on the API to avoid HTTP status 429 (too many requests)
-                    time.sleep(5)
-            else:
-                self.logger.info(
-                    f"Skipping disabled kenter meter [{meter_settings.descriptive_name}], connectionId: [{meter_settings.connection_id}] meteringPointId: [{meter_settings.metering_point_id}]..."
-                )
+                # Don't backfill after initial backfill
+                daystobackfill = 0
+            finally:
+                self.finish_bulk_import()
+                self.sqlite.flush()
+                self.archive.flush()
 
-        # Don't backfill after initial backfill
-        daystobackfill = 0
+            self.logger.debug("Waiting for next cron job...")
 
-        self.logger.debug("Waiting for next cron job...")
+    def finish_bulk_import(self):
+        if self.bulk_import is None:
+            return
+        try:
+            with metrics.timer("sink_write_seconds", stage="write_influxdb", sink="influxdb"):
+                self.bulk_import.finish()
+        except Exception as e:
+            self.influxdb.forget_written_metadata()
+            self.logger.exception(f"Error sending the last Kenter bulk import batch to InfluxDB: {e}")
+        self.bulk_import = None
 
     def write_gridkenter_to_influxdb(self, transformer_measurements: KenterTransformerMeasurements, transformer_settings: KenterMeterSettings):
-        if self.conf.influxdb_module_enabled and transformer_settings.output_influxdb:
+        if self.conf.influxdb_module_enabled and transformer_settings.output_influxdb and self.budget.sink_allowed("influxdb"):
             try:
-                self.influxdb.write_kenterdata_to_influxdb(transformer_measurements)
+                with metrics.timer("sink_write_seconds", stage="write_influxdb", sink="influxdb"):
+                    if self.bulk_import is not None:
+                        self.influxdb.add_kenterdata_to_bulk_import(self.bulk_import, transformer_measurements)
+                    else:
+                        self.influxdb.write_kenterdata_to_influxdb(transformer_measurements)
             except Exception as e:
                 # Log but do not raise, other outputs should proceed.
                 self.logger.exception(
                     f"Error publishing Kenter data to InfluxDB for meter [{transformer_measurements.descriptive_name}], connectionId: [{transformer_measurements.connection_id}] meteringPointId: [{transformer_measurements.metering_point_id}]: {e}"
                 )
         else:
-            self.logger.info(
+            self.logger.debug(
                 f"InfluxDB output disabled for Kenter meter [{transformer_measurements.descriptive_name}], connectionId: [{transformer_measurements.connection_id}] meteringPointId: [{transformer_measurements.metering_point_id}]..."
             )
+
+    def write_gridkenter_to_sqlite(self, transformer_measurements: KenterTransformerMeasurements, transformer_settings: KenterMeterSettings):
+        if self.conf.sqlite_module_enabled and transformer_settings.output_sqlite and self.budget.sink_allowed("sqlite"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_sqlite", sink="sqlite"):
+                    self.sqlite.write_kenterdata_to_sqlite(transformer_measurements)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(
+                    f"Error writing Kenter data to SQLite for meter [{transformer_measurements.descriptive_name}], connectionId: [{transformer_measurements.connection_id}] meteringPointId: [{transformer_measurements.metering_point_id}]: {e}"
+                )
+        else:
+            self.logger.debug(
+                f"SQLite output disabled for Kenter meter [{transformer_measurements.descriptive_name}], connectionId: [{transformer_measurements.connection_id}] meteringPointId: [{transformer_measurements.metering_point_id}]..."
+            )
+
+    def write_gridkenter_to_archive(self, transformer_measurements: KenterTransformerMeasurements, transformer_settings: KenterMeterSettings):
+        if self.conf.archive_module_enabled and transformer_settings.output_archive and self.budget.sink_allowed("archive"):
+            try:
+                with metrics.timer("sink_write_seconds", stage="write_archive", sink="archive"):
+                    self.archive.write_kenterdata_to_archive(transformer_measurements)
+            except Exception as e:
+                # Log but do not raise, other outputs should proceed.
+                self.logger.exception(
+                    f"Error writing Kenter data to the archive for meter [{transformer_measurements.descriptive_name}], connectionId: [{transformer_measurements.connection_id}] meteringPointId: [{transformer_measurements.metering_point_id}]: {e}"
+                )
+        else:
+            self.logger.debug(
+                f"Archive output disabled for Kenter meter [{transformer_measurements.descriptive_name}], connectionId: [{transformer_measurements.connection_id}] meteringPointId: [{transformer_measurements.metering_point_id}]..."
+            )
@@ -0,0 +1,23 @@
+from typing import Dict, Hashable, List
+
+
+def spread_requests(request_keys: List[Hashable], window_s: float, min_interval_s: float, earliest_offsets: Dict[Hashable, float]) -> List[float]:
+    """
+    Plan the start offsets of a cycle's requests, spread evenly over the window instead of all at the start of the cycle.
+    Requests with the same key share an endpoint quota, they are at least min_interval_s apart and not before the
+    earliest offset of their key, e.g. the quota remaining from the previous cycle.
+
+    :param request_keys: Quota key per request, in the order the requests are made.
+    :return: Offset in seconds from the start of the cycle per request, non-decreasing.
+    """
+    offsets = []
+    last_offsets: Dict[Hashable, float] = {}
+    previous_offset = 0.0
+    for request_idx, request_key in enumerate(request_keys):
+        offset = max(previous_offset, window_s * request_idx / len(request_keys), earliest_offsets.get(request_key, 0.0))
+        if request_key in last_offsets:
+            offset = max(offset, last_offsets[request_key] + min_interval_s)
+        offsets.append(offset)
+        last_offsets[request_key] = offset
+        previous_offset = offset
+    return offsets
@@ -0,0 +1,41 @@
+from datetime import datetime
+from typing import Optional
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.triggers.cron import CronTrigger
+from modules.metrics import metrics
+
+
+def cron_interval_seconds(hour: str, minute: str) -> Optional[float]:
+    """
+    Determine the number of seconds between the next two fire times of a cron trigger.
+    For irregular crons (e.g. minute="0,10") this is the upcoming interval, not the shortest.
+
+    :return: Interval in seconds, or None if the trigger does not fire twice.
+    """
+    trigger = CronTrigger(hour=hour, minute=minute)
+    now = datetime.now(trigger.timezone)
+    first_fire_time = trigger.get_next_fire_time(None, now)
+    if first_fire_time is None:
+        return None
+    second_fire_time = trigger.get_next_fire_time(first_fire_time, first_fire_time)
+    if second_fire_time is None:
+        return None
+    return (second_fire_time - first_fire_time).total_seconds()
+
+
+def add_cron_job(sched, func, job_id: str, relay: str, hour: str, minute: str, conf, logger) -> None:
+    """
+    Add a relay's cron job. A cycle never runs concurrently with itself, ticks missed while a cycle overran are
+    coalesced into one run if it can still start within the misfire grace time, and skipped ticks are logged and counted.
+    """
+    sched.add_job(func, trigger="cron", id=job_id, hour=hour, minute=minute, max_instances=1, coalesce=True, misfire_grace_time=conf.scheduler_misfire_grace_seconds)
+
+    def on_skipped(event):
+        reason = "overrun" if event.code == EVENT_JOB_MAX_INSTANCES else "misfire"
+        metrics.inc("cycles_skipped_total", relay=relay, reason=reason)
+        if reason == "overrun":
+            logger.warning(f"Skipped a {relay} cycle at {event.scheduled_run_times[0]}, the previous cycle is still running")
+        else:
+            logger.warning(f"Skipped a {relay} cycle scheduled at {event.scheduled_run_time}, it could not start within {conf.scheduler_misfire_grace_seconds}s")
+
+    sched.add_listener(on_skipped, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
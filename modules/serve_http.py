@@ -0,0 +1,80 @@
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Callable, Dict, Tuple
+from urllib.parse import parse_qs, urlparse
+from modules.conf_models import PyFusionSolarSettings
+from modules.measurement_buffer import get_measurement_buffer
+from modules.metrics import metrics
+
+# A route handler receives the parsed query string and returns (http status, content type, body)
+RouteHandler = Callable[[Dict[str, list]], Tuple[int, str, bytes]]
+
+
+class ServeHttp:
+    """
+    Small embedded HTTP server exposing relay internals such as the metrics surface and the measurement buffer.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger):
+        self.conf = conf
+        self.logger = logger
+        self.routes: Dict[str, RouteHandler] = {}
+        self.httpd = None
+        self.logger.debug("ServeHttp class instantiated")
+
+        self.register_route("/metrics", self.handle_metrics_prometheus)
+        self.register_route("/metrics.json", self.handle_metrics_json)
+        if conf.measurement_buffer_enabled:
+            measurement_buffer = get_measurement_buffer(conf, logger)
+            self.register_route("/series", measurement_buffer.handle_series)
+            self.register_route("/series/query", measurement_buffer.handle_query)
+
+    def register_route(self, path: str, handler: RouteHandler) -> None:
+        self.routes[path] = handler
+
+    def handle_metrics_prometheus(self, query: Dict[str, list]) -> Tuple[int, str, bytes]:
+        return 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render_prometheus().encode("utf-8")
+
+    def handle_metrics_json(self, query: Dict[str, list]) -> Tuple[int, str, bytes]:
+        return 200, "application/json", json.dumps(metrics.snapshot()).encode("utf-8")
+
+    def start(self) -> None:
+        routes = self.routes
+        logger = self.logger
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed_url = urlparse(self.path)
+                handler = routes.get(parsed_url.path)
+                if handler is None:
+                    status, content_type, body = 404, "text/plain", b"Not found\n"
+                else:
+                    try:
+                        status, content_type, body = handler(parse_qs(parsed_url.query))
+                    except Exception as e:
+                        logger.exception(f"Error while handling HTTP request for {self.path}: {e}")
+                        status, content_type, body = 500, "text/plain", b"Internal server error\n"
+
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(f"HTTP {self.address_string()} - {format % args}")
+
+        self.httpd = ThreadingHTTPServer((self.conf.http_server_host, self.conf.http_server_port), RequestHandler)
+        self.httpd.daemon_threads = True
+        http_thread = Thread(target=self.httpd.serve_forever, name="ServeHttp")
+        http_thread.daemon = True
+        http_thread.start()
+        self.logger.info(f"HTTP server listening on {self.conf.http_server_host}:{self.conf.http_server_port}, routes: {', '.join(sorted(self.routes))}")
+
+    def stop(self) -> None:
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
@@ -0,0 +1,219 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+from modules.conf_models import PyFusionSolarSettings
+from modules.metrics import metrics
+
+SHARDING_MODES = ("off", "static", "lease")
+
+
+class HashRing:
+    """
+    Consistent hash ring, a key is owned by the first member position clockwise from the key's hash.
+    When a member joins or leaves only the keys of that member move, the other assignments stay put.
+    """
+
+    def __init__(self, members: List[str], virtual_nodes: int = 64):
+        self.members = sorted(set(members))
+        self.positions = []
+        self.position_members = []
+        for position, member in sorted((ring_hash(f"{member}#{vnode}"), member) for member in self.members for vnode in range(virtual_nodes)):
+            self.positions.append(position)
+            self.position_members.append(member)
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self.positions:
+            return None
+        idx = bisect.bisect(self.positions, ring_hash(key)) % len(self.positions)
+        return self.position_members[idx]
+
+
+class ShardCoordinator:
+    """
+    Decides which stations, kiosks and metering points this relay instance polls, so multiple
+    instances can share one portfolio without duplicate polling and writes.
+
+    static: the shard members are 0..sharding_shard_count-1 and this instance is sharding_shard_index.
+    lease: members register a lease per relay they run in a shared SQLite file and keep them alive with
+    heartbeats, expired members are removed and their keys rebalance to the remaining members. Every relay
+    has its own ring, so keys are only assigned to members running that relay, e.g. with supervisor_mode,
+    where each relay runs in its own process.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger):
+        self.conf = conf
+        self.logger = logger
+        self.mode = conf.sharding_mode
+        self.lock = threading.Lock()
+        self.ring = None
+        # Lease mode: the relays running in this process and the ring of the live members of each relay
+        self.relays: List[str] = []
+        self.rings: Dict[str, HashRing] = {}
+        self.member_id = ""
+        self.heartbeat_stop = threading.Event()
+
+        if self.mode == "off":
+            pass
+        elif self.mode == "static":
+            if not 0 <= conf.sharding_shard_index < conf.sharding_shard_count:
+                raise Exception(f"Invalid sharding_shard_index {conf.sharding_shard_index}, should be between 0 and sharding_shard_count - 1 ({conf.sharding_shard_count - 1})")
+            self.member_id = str(conf.sharding_shard_index)
+            self.ring = HashRing([str(idx) for idx in range(conf.sharding_shard_count)], conf.sharding_virtual_nodes)
+            self.logger.info(f"Sharding enabled, static shard {self.member_id} of {conf.sharding_shard_count}")
+        elif self.mode == "lease":
+            self.member_id = conf.sharding_member_id or f"{socket.gethostname()}-{os.getpid()}"
+            self.init_lease_db()
+            heartbeat_thread = threading.Thread(target=self.heartbeat_loop, name="ShardHeartbeat")
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+        else:
+            raise Exception(f"Invalid sharding_mode '{self.mode}', should be one of: {', '.join(SHARDING_MODES)}")
+
+        self.logger.debug("ShardCoordinator class instantiated")
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def register_relay(self, relay: str) -> None:
+        """
+        Take part in the ring of the relay, in lease mode a lease is registered for it right away.
+        """
+        with self.lock:
+            if relay in self.relays:
+                return
+            self.relays.append(relay)
+        if self.mode == "lease":
+            self.refresh_lease()
+
+    def owns(self, relay: str, key) -> bool:
+        """
+        True if this instance should poll the item of the relay with the given key, always True when sharding is off.
+        """
+        if not self.enabled:
+            return True
+        with self.lock:
+            ring = self.ring if self.mode == "static" else self.rings.get(relay)
+        return ring is not None and ring.owner(str(key)) == self.member_id
+
+    def connect_lease_db(self) -> sqlite3.Connection:
+        # A connection per operation, the heartbeat thread and relay threads never share one
+        return sqlite3.connect(self.conf.sharding_lease_db, timeout=10)
+
+    def init_lease_db(self) -> None:
+        lease_db_dir = os.path.dirname(self.conf.sharding_lease_db)
+        if lease_db_dir:
+            os.makedirs(lease_db_dir, exist_ok=True)
+        connection = self.connect_lease_db()
+        try:
+            # Lease tables without the relay column are recreated, leases are renewed within a heartbeat anyway
+            connection.execute("BEGIN IMMEDIATE")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(shard_leases)")]
+            if columns and "relay" not in columns:
+                connection.execute("DROP TABLE shard_leases")
+            connection.execute("CREATE TABLE IF NOT EXISTS shard_leases (member_id TEXT NOT NULL, relay TEXT NOT NULL, heartbeat REAL NOT NULL, PRIMARY KEY (member_id, relay))")
+            connection.commit()
+        finally:
+            connection.close()
+
+    def refresh_lease(self) -> None:
+        """
+        Renew this member's leases, drop expired leases and rebuild the rings of the relays from their live members.
+        """
+        now = time.time()
+        with self.lock:
+            relays = list(self.relays)
+        members_by_relay = {relay: [] for relay in relays}
+        with self.connect_lease_db() as connection:
+            connection.executemany(
+                "INSERT INTO shard_leases (member_id, relay, heartbeat) VALUES (?, ?, ?) ON CONFLICT(member_id, relay) DO UPDATE SET heartbeat = excluded.heartbeat",
+                [(self.member_id, relay, now) for relay in relays],
+            )
+            connection.execute("DELETE FROM shard_leases WHERE heartbeat < ?", (now - self.conf.sharding_lease_ttl_seconds,))
+            for member_id, relay in connection.execute("SELECT member_id, relay FROM shard_leases"):
+                if relay in members_by_relay:
+                    members_by_relay[relay].append(member_id)
+
+        for relay, members in members_by_relay.items():
+            with self.lock:
+                previous_members = self.rings[relay].members if relay in self.rings else []
+                if sorted(members) != previous_members:
+                    self.rings[relay] = HashRing(members, self.conf.sharding_virtual_nodes)
+                    self.logger.info(f"Shard membership of {relay} changed, {len(members)} live member(s): {', '.join(sorted(members))}, this member: {self.member_id}")
+            metrics.set_gauge("shard_members", len(members), relay=relay)
+
+    def heartbeat_loop(self) -> None:
+        while not self.heartbeat_stop.wait(self.conf.sharding_heartbeat_seconds):
+            try:
+                self.refresh_lease()
+            except Exception as e:
+                self.logger.exception(f"Error renewing shard lease in {self.conf.sharding_lease_db}: {e}")
+
+    def release(self) -> None:
+        """
+        Give up the lease, so the other members take over this member's keys without waiting for the lease to expire.
+        """
+        if self.mode != "lease":
+            return
+        self.heartbeat_stop.set()
+        with self.lock:
+            relays = list(self.relays)
+        try:
+            # Only the leases of this process, with an explicit sharding_member_id other processes share the member id
+            with self.connect_lease_db() as connection:
+                connection.executemany("DELETE FROM shard_leases WHERE member_id = ? AND relay = ?", [(self.member_id, relay) for relay in relays])
+            self.logger.info(f"Released shard lease(s) of member {self.member_id} for {', '.join(relays)}")
+        except Exception as e:
+            self.logger.exception(f"Error releasing shard lease in {self.conf.sharding_lease_db}: {e}")
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+shard_coordinator_lock = threading.Lock()
+shard_coordinator = None
+
+
+class RelayShards:
+    """
+    Shard ownership of the items of one relay.
+    """
+
+    def __init__(self, coordinator: ShardCoordinator, relay: str):
+        self.coordinator = coordinator
+        self.relay = relay
+        coordinator.register_relay(relay)
+
+    @property
+    def enabled(self) -> bool:
+        return self.coordinator.enabled
+
+    def owns(self, key) -> bool:
+        return self.coordinator.owns(self.relay, key)
+
+
+def get_shard_coordinator(conf: PyFusionSolarSettings, logger: logging.Logger, relay: str) -> RelayShards:
+    """
+    Ownership for the relay from the process wide coordinator shared by all relays, so a process holds one lease per relay it runs.
+    """
+    global shard_coordinator
+    with shard_coordinator_lock:
+        if shard_coordinator is None:
+            shard_coordinator = ShardCoordinator(conf, logger)
+    return RelayShards(shard_coordinator, relay)
+
+
+def release_shard_coordinator() -> None:
+    """
+    Release the lease of the process wide coordinator, if one was created. Called on shutdown.
+    """
+    with shard_coordinator_lock:
+        if shard_coordinator is not None:
+            shard_coordinator.release()
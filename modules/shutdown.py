@@ -0,0 +1,91 @@
+import logging
+import signal
+import threading
+import time
+from typing import Callable, List, Tuple
+
+# Hook phases, hooks of a phase run concurrently and a phase starts when the previous one finished
+PHASE_STOP_RELAYS = 0
+PHASE_CLEANUP = 10
+
+
+class ShutdownCoordinator:
+    """
+    Coordinates a graceful shutdown on SIGTERM (docker stop) or SIGINT (Ctrl-C). Long running loops poll
+    `requested` or wait on it instead of sleeping, and components register hooks which stop schedulers,
+    finish the in-progress cycle and flush sinks. Hooks get a shared deadline, after which the process exits anyway.
+    """
+
+    def __init__(self):
+        self.requested = threading.Event()
+        self.lock = threading.Lock()
+        self.hooks: List[Tuple[int, str, Callable[[], None]]] = []
+
+    def is_requested(self) -> bool:
+        return self.requested.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Interruptible sleep, returns True if shutdown was requested.
+        """
+        return self.requested.wait(timeout)
+
+    def request(self) -> None:
+        self.requested.set()
+
+    def register(self, name: str, hook: Callable[[], None], phase: int = PHASE_STOP_RELAYS) -> None:
+        with self.lock:
+            self.hooks.append((phase, name, hook))
+
+    def install_signal_handlers(self, logger: logging.Logger) -> None:
+        """
+        Request shutdown on SIGTERM and SIGINT. Must be called from the main thread.
+        """
+
+        def handle_signal(signum, frame):
+            # Only set the event, the main thread runs the hooks
+            self.requested.set()
+
+        for signal_name in ("SIGTERM", "SIGINT"):
+            if hasattr(signal, signal_name):
+                signal.signal(getattr(signal, signal_name), handle_signal)
+        logger.debug("Installed SIGTERM and SIGINT handlers for graceful shutdown")
+
+    def run_hooks(self, logger: logging.Logger, timeout_s: float) -> bool:
+        """
+        Run all registered hooks phase by phase within timeout_s. Returns False if the deadline was hit.
+        """
+        self.requested.set()
+        deadline = time.monotonic() + timeout_s
+        with self.lock:
+            hooks = sorted(self.hooks, key=lambda hook: hook[0])
+
+        completed = True
+        for phase in sorted({phase for phase, _, _ in hooks}):
+            hook_threads = []
+            for _, name, hook in (hook for hook in hooks if hook[0] == phase):
+                hook_thread = threading.Thread(target=self.run_hook, args=[logger, name, hook], name=f"Shutdown-{name}")
+                hook_thread.daemon = True
+                hook_thread.start()
+                hook_threads.append(hook_thread)
+            for hook_thread in hook_threads:
+                hook_thread.join(max(0.0, deadline - time.monotonic()))
+                if hook_thread.is_alive():
+                    logger.warning(f"Shutdown deadline of {timeout_s:g}s reached while waiting for {hook_thread.name}")
+                    completed = False
+            if not completed:
+                break
+
+        return completed
+
+    @staticmethod
+    def run_hook(logger: logging.Logger, name: str, hook: Callable[[], None]) -> None:
+        try:
+            logger.debug(f"Running shutdown hook {name}")
+            hook()
+        except Exception as e:
+            logger.exception(f"Error in shutdown hook {name}: {e}")
+
+
+# Process wide coordinator, shared by all relays and the supervisor
+shutdown = ShutdownCoordinator()
@@ -0,0 +1,48 @@
+import math
+from typing import Optional, Tuple
+
+# Julian date of the unix epoch, and of the J2000 epoch used by the sunrise equation
+UNIX_EPOCH_JULIAN_DATE = 2440587.5
+J2000_JULIAN_DATE = 2451545.0
+
+
+def sun_times(latitude: float, longitude: float, timestamp: float) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Sunrise and sunset around the solar noon nearest to the timestamp, with the sunrise equation. Accurate to about a minute, no network needed.
+
+    :param latitude: Degrees, north positive.
+    :param longitude: Degrees, east positive.
+    :return: (sunrise, sunset) unix timestamps. (None, None) during polar night, (-inf, inf) during polar day.
+    """
+    julian_day = round(timestamp / 86400 + UNIX_EPOCH_JULIAN_DATE - J2000_JULIAN_DATE + longitude / 360)
+    mean_solar_time = julian_day - longitude / 360
+    mean_anomaly = math.radians((357.5291 + 0.98560028 * mean_solar_time) % 360)
+    equation_of_center = 1.9148 * math.sin(mean_anomaly) + 0.02 * math.sin(2 * mean_anomaly) + 0.0003 * math.sin(3 * mean_anomaly)
+    ecliptic_longitude = math.radians((math.degrees(mean_anomaly) + equation_of_center + 180 + 102.9372) % 360)
+    solar_transit = J2000_JULIAN_DATE + mean_solar_time + 0.0053 * math.sin(mean_anomaly) - 0.0069 * math.sin(2 * ecliptic_longitude)
+    declination = math.asin(math.sin(ecliptic_longitude) * math.sin(math.radians(23.4397)))
+
+    # -0.833 degrees corrects for refraction and the solar disc
+    latitude_rad = math.radians(latitude)
+    cos_hour_angle = (math.sin(math.radians(-0.833)) - math.sin(latitude_rad) * math.sin(declination)) / (math.cos(latitude_rad) * math.cos(declination))
+    if cos_hour_angle > 1:
+        return None, None
+    if cos_hour_angle < -1:
+        return -math.inf, math.inf
+
+    hour_angle_days = math.degrees(math.acos(cos_hour_angle)) / 360
+    sunrise = (solar_transit - hour_angle_days - UNIX_EPOCH_JULIAN_DATE) * 86400
+    sunset = (solar_transit + hour_angle_days - UNIX_EPOCH_JULIAN_DATE) * 86400
+    return sunrise, sunset
+
+
+def is_daylight(latitude: float, longitude: float, timestamp: float, twilight_seconds: float = 0) -> bool:
+    """
+    Whether the sun is up at the timestamp, with a margin before sunrise and after sunset.
+    """
+    # The days around the timestamp are checked as well, a margin can extend into them
+    for day_offset in (-1, 0, 1):
+        sunrise, sunset = sun_times(latitude, longitude, timestamp + day_offset * 86400)
+        if sunrise is not None and sunrise - twilight_seconds <= timestamp <= sunset + twilight_seconds:
+            return True
+    return False
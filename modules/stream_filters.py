@@ -0,0 +1,51 @@
+import logging
+from modules.conf_models import PyFusionSolarSettings
+from modules.device_state import get_device_state_store
+from modules.metrics import metrics
+
+
+class StreamFilters:
+    """
+    Filter stage for parsed measurements, with per-device state from the device state store.
+    Lifetime counters are kept monotonic and implausible jumps are rejected, in which case the last
+    accepted value is emitted again. Known device quirks are cut off at configurable thresholds.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger, source: str):
+        self.conf = conf
+        self.logger = logger
+        self.source = source
+        self.store = get_device_state_store(conf, logger)
+        self.logger.debug(f"StreamFilters class instantiated for {source}")
+
+    def counter(self, device_key: str, field: str, value: float, timestamp: float) -> float:
+        """
+        Filter a lifetime counter, returns the value to emit.
+        """
+        last = self.store.get(device_key, field)
+        if last is not None:
+            last_value, last_timestamp = last
+            if self.conf.stream_filter_monotonic_counters and value < last_value:
+                # FusionSolar quirk, cumulativeEnergy sometimes decreases with the day's production
+                self.reject("regression", device_key, field, value, last_value)
+                return last_value
+            elapsed_hours = (timestamp - last_timestamp) / 3600
+            if self.conf.stream_filter_max_counter_rate_w > 0 and elapsed_hours > 0 and (value - last_value) / elapsed_hours > self.conf.stream_filter_max_counter_rate_w:
+                self.reject("spike", device_key, field, value, last_value)
+                return last_value
+
+        self.store.set(device_key, field, value, timestamp)
+        return value
+
+    def quirk_threshold(self, device_key: str, field: str, value: float, threshold: float) -> float:
+        """
+        Returns 0 for values below the threshold of a known device quirk, the value otherwise.
+        """
+        if value < threshold:
+            self.reject("quirk_threshold", device_key, field, value, 0)
+            return 0
+        return value
+
+    def reject(self, filter_name: str, device_key: str, field: str, value: float, emitted_value: float) -> None:
+        metrics.inc("stream_filter_rejections_total", source=self.source, filter=filter_name, field=field)
+        self.logger.warning(f"Stream filter {filter_name} rejected {field}={value} of device {device_key}, emitting {emitted_value} instead")
@@ -0,0 +1,214 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Dict
+from modules.conf_models import PyFusionSolarSettings
+from modules.config_reload import config_reload
+from modules.cycle_profiler import CycleProfiler
+from modules.device_state import flush_device_state_store
+from modules.log_pipeline import log_pipeline
+from modules.measurement_buffer import get_measurement_buffer
+from modules.metrics import metrics
+from modules.sharding import release_shard_coordinator
+from modules.shutdown import shutdown, PHASE_CLEANUP
+
+# Enabled setting and import path of each relay, relays are imported in the child process only
+RELAYS = {
+    "fusionsolar_kiosk": ("fusionsolar_kiosk_module_enabled", "modules.relay_fusionsolar_kiosk", "RelayFusionSolarKiosk"),
+    "fusionsolar_open_api": ("fusionsolar_open_api_module_enabled", "modules.relay_fusionsolar_open_api", "RelayFusionSolarOpenApi"),
+    "kenter": ("kenter_module_enabled", "modules.relay_kenter", "RelayKenter"),
+}
+
+
+def run_relay_process(relay_name: str, conf: PyFusionSolarSettings, metrics_queue) -> None:
+    """
+    Entry point of a relay child process. Runs the relay and pushes metric snapshots to the supervisor.
+    """
+    logger = log_pipeline.start()
+    log_pipeline.apply_settings(conf)
+    logger.info(f"Relay process for {relay_name} started")
+
+    # The HTTP server runs in the supervisor, so buffered measurements are pushed along with the metrics
+    measurement_buffer = get_measurement_buffer(conf, logger) if conf.measurement_buffer_enabled else None
+    if measurement_buffer is not None:
+        measurement_buffer.forward_points = True
+
+    def push_metrics():
+        try:
+            metrics_queue.put((relay_name, metrics.snapshot(), measurement_buffer.take_pending_points() if measurement_buffer is not None else []))
+        except Exception as e:
+            logger.warning(f"Could not push {relay_name} metrics to the supervisor: {e}")
+
+    def push_metrics_loop():
+        while True:
+            time.sleep(conf.supervisor_metrics_interval_seconds)
+            push_metrics()
+
+    metrics_thread = threading.Thread(target=push_metrics_loop, name="SupervisorMetrics")
+    metrics_thread.daemon = True
+    metrics_thread.start()
+
+    relay_failed = threading.Event()
+
+    def run_relay():
+        try:
+            _, module_name, class_name = RELAYS[relay_name]
+            relay_module = __import__(module_name, fromlist=[class_name])
+            relay = getattr(relay_module, class_name)(conf, logger)
+            relay.start()
+        except Exception as e:
+            logger.exception(f"Relay process for {relay_name} failed: {e}")
+            relay_failed.set()
+
+    # The relay runs on a thread like in threaded mode, the main thread handles signals and the shutdown
+    shutdown.install_signal_handlers(logger)
+    CycleProfiler.install_signal_handler(conf, logger)
+    config_reload.install_signal_handler(logger)
+    config_reload.start(conf, logger)
+    shutdown.register("ShardLease", release_shard_coordinator, PHASE_CLEANUP)
+    shutdown.register("DeviceState", flush_device_state_store, PHASE_CLEANUP)
+    relay_thread = threading.Thread(target=run_relay, name=f"Relay-{relay_name}")
+    relay_thread.daemon = True
+    relay_thread.start()
+    while relay_thread.is_alive() and not shutdown.wait(1):
+        pass
+
+    # Only replay mode and failures return from start() without a shutdown request
+    shutdown.run_hooks(logger, conf.shutdown_timeout_seconds)
+    push_metrics()
+    # Child processes exit without running atexit handlers
+    log_pipeline.stop()
+    if relay_failed.is_set():
+        raise SystemExit(1)
+
+
+class RelayProcess:
+    def __init__(self, relay_name: str):
+        self.relay_name = relay_name
+        self.process = None
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+        self.finished = False
+
+
+class RelaySupervisor:
+    """
+    Runs each enabled relay in its own process so relays do not compete for the GIL, restarts
+    failed relay processes with exponential backoff, and merges the metrics of all relay processes
+    into the supervisor's metrics registry.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger: logging.Logger):
+        self.conf = conf
+        self.logger = logger
+        # Spawned children do not inherit locks held by threads of the supervisor, like the HTTP server thread
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.metrics_queue = self.mp_context.Queue()
+        self.relay_processes: Dict[str, RelayProcess] = {}
+        for relay_name, (enabled_setting, _, _) in RELAYS.items():
+            if getattr(conf, enabled_setting):
+                self.relay_processes[relay_name] = RelayProcess(relay_name)
+        self.logger.debug("RelaySupervisor class instantiated")
+
+    def start_relay_process(self, relay_process: RelayProcess) -> None:
+        relay_process.process = self.mp_context.Process(target=run_relay_process, args=(relay_process.relay_name, self.conf, self.metrics_queue), name=f"Relay-{relay_process.relay_name}", daemon=True)
+        relay_process.process.start()
+        relay_process.started_at = time.monotonic()
+        metrics.set_gauge("relay_process_up", 1, relay=relay_process.relay_name)
+        self.logger.info(f"Started {relay_process.relay_name} relay process with pid {relay_process.process.pid}")
+
+    def install_reload_signal_handler(self) -> None:
+        """
+        Forward SIGHUP to the relay processes, each relay process reloads its own settings. Must be called from the main thread.
+        """
+        if not hasattr(signal, "SIGHUP"):
+            return
+
+        def handle_signal(signum, frame):
+            for relay_process in self.relay_processes.values():
+                process = relay_process.process
+                if process is not None and process.pid is not None:
+                    try:
+                        os.kill(process.pid, signal.SIGHUP)
+                    except OSError:
+                        pass
+
+        signal.signal(signal.SIGHUP, handle_signal)
+
+    def run(self) -> None:
+        """
+        Blocking, starts all relay processes and supervises them. Returns when all relays finished replaying or shutdown is requested.
+        """
+        for relay_process in self.relay_processes.values():
+            self.start_relay_process(relay_process)
+
+        while not all(relay_process.finished for relay_process in self.relay_processes.values()) and not shutdown.is_requested():
+            self.collect_metrics(timeout=1)
+            for relay_process in self.relay_processes.values():
+                self.check_relay_process(relay_process)
+
+        self.collect_metrics(timeout=0)
+        if not shutdown.is_requested():
+            self.logger.info("All relay processes finished")
+
+    def check_relay_process(self, relay_process: RelayProcess) -> None:
+        now = time.monotonic()
+        if relay_process.finished:
+            return
+
+        if relay_process.process is None:
+            if now >= relay_process.restart_at:
+                metrics.inc("relay_process_restarts_total", relay=relay_process.relay_name)
+                self.start_relay_process(relay_process)
+            return
+
+        if relay_process.process.is_alive():
+            return
+
+        exitcode = relay_process.process.exitcode
+        relay_process.process = None
+        metrics.set_gauge("relay_process_up", 0, relay=relay_process.relay_name)
+
+        if exitcode == 0 and self.conf.capture_mode == "replay":
+            self.logger.info(f"Relay process {relay_process.relay_name} finished replaying")
+            relay_process.finished = True
+            return
+
+        # A process that ran long enough before failing starts over with the initial backoff
+        if now - relay_process.started_at >= self.conf.supervisor_stable_seconds:
+            relay_process.failures = 0
+        backoff_s = min(self.conf.supervisor_restart_backoff_seconds * 2**relay_process.failures, self.conf.supervisor_restart_backoff_max_seconds)
+        relay_process.failures += 1
+        relay_process.restart_at = now + backoff_s
+        metrics.inc("relay_process_failures_total", relay=relay_process.relay_name)
+        self.logger.error(f"Relay process {relay_process.relay_name} exited with code {exitcode}, restarting in {backoff_s:g}s (failure {relay_process.failures})")
+
+    def collect_metrics(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                relay_name, snapshot, measurement_points = self.metrics_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            metrics.set_child_snapshot(relay_name, snapshot)
+            if measurement_points:
+                get_measurement_buffer(self.conf, self.logger).add_points(measurement_points)
+
+    def stop(self) -> None:
+        """
+        Send SIGTERM to all relay processes and wait for their graceful shutdown. Called on shutdown.
+        """
+        for relay_process in self.relay_processes.values():
+            if relay_process.process is not None and relay_process.process.is_alive():
+                self.logger.info(f"Stopping relay process {relay_process.relay_name}")
+                relay_process.process.terminate()
+        for relay_process in self.relay_processes.values():
+            if relay_process.process is not None:
+                # The relay processes stop within their own shutdown_timeout_seconds, the shutdown deadline bounds this wait
+                relay_process.process.join()
+        self.collect_metrics(timeout=0)
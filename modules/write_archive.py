@@ -0,0 +1,205 @@
+import calendar
+import csv
+import gzip
+import os
+import time
+from threading import Lock
+from typing import Dict, List, Tuple, Union
+
+from modules.conf_models import PyFusionSolarSettings
+from modules.models import FusionSolarInverterMeasurement, FusionSolarMeterMeasurement, KenterTransformerMeasurements
+
+# csv keeps finished days as gzip compressed CSV, parquet compacts them to Parquet files, which requires pyarrow
+ARCHIVE_FORMATS = ("csv", "parquet")
+# Value columns per device type, every row starts with time, device_key and device_name
+ARCHIVE_COLUMNS = {
+    "inverter": ("real_time_power_w", "lifetime_energy_wh", "day_energy_wh"),
+    "grid_meter": ("active_power_w",),
+    "grid_transformer": ("interval_energy_wh", "interval_power_avg_w"),
+}
+KEY_COLUMNS = ("time", "device_key", "device_name")
+OPEN_SUFFIX = ".open.csv.gz"
+
+
+class WriteArchive:
+    """
+    Appends measurements to daily files, partitioned as <archive_dir>/site=<site>/device_type=<type>/source=<relay>/<day>.
+    Rows of the current day are appended as a gzip member per cycle to <day>.open.csv.gz. Once the day is over, the
+    file is compacted: rows are sorted by device and time, duplicates from refetched data are dropped, and the day is
+    written as one <day>.csv.gz or <day>.parquet file. Compacted days older than archive_retention_days are deleted.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger):
+        self.conf = conf
+        self.logger = logger
+        self.logger.debug("WriteArchive class instantiated")
+        self.lock = Lock()
+        # Rows per (device type, source, day) since the last flush
+        self.pending_rows: Dict[Tuple[str, str, str], List[tuple]] = {}
+        self.last_rotation_day = ""
+        self.pyarrow = None
+        self.pyarrow_parquet = None
+        if self.conf.archive_module_enabled:
+            self.import_format_classes()
+
+    def import_format_classes(self):
+        if self.conf.archive_format not in ARCHIVE_FORMATS:
+            raise Exception(f"Invalid archive_format '{self.conf.archive_format}', should be one of: {', '.join(ARCHIVE_FORMATS)}")
+        if self.conf.archive_format != "parquet":
+            return
+        try:
+            import pyarrow
+            import pyarrow.parquet
+
+            # Store imports in instance variables
+            self.pyarrow = pyarrow
+            self.pyarrow_parquet = pyarrow.parquet
+        except Exception as e:
+            raise Exception(f"Error importing pyarrow, required with archive_format parquet: '{e}'")
+
+    def write_pvdata_to_archive(self, measurement: FusionSolarInverterMeasurement):
+        source, device_key = self.make_source_and_device_key(measurement)
+        timestamp = int(measurement.timestamp or time.time())
+        self.add_rows("inverter", source, [(timestamp, device_key, measurement.settings_descriptive_name or measurement.device_name, measurement.real_time_power_w, measurement.lifetime_energy_wh, measurement.day_energy_wh)])
+
+    def write_grid_data_to_archive(self, measurement: FusionSolarMeterMeasurement):
+        source, device_key = self.make_source_and_device_key(measurement)
+        timestamp = int(measurement.timestamp or time.time())
+        self.add_rows("grid_meter", source, [(timestamp, device_key, measurement.settings_descriptive_name or measurement.device_name, measurement.active_power_w)])
+
+    def write_kenterdata_to_archive(self, measurement: KenterTransformerMeasurements):
+        device_key = f"kenter/{measurement.connection_id}/{measurement.metering_point_id}"
+        self.add_rows(
+            "grid_transformer",
+            "kenter",
+            [
+                (int(timestamp), device_key, measurement.descriptive_name, interval_energy_wh, interval_power_avg_w)
+                for timestamp, interval_energy_wh, interval_power_avg_w in zip(measurement.timestamps, measurement.interval_energy_wh, measurement.interval_power_avg_w)
+            ],
+        )
+
+    def make_source_and_device_key(self, measurement: Union[FusionSolarInverterMeasurement, FusionSolarMeterMeasurement]) -> Tuple[str, str]:
+        # Same device keys as the stream filters. Each relay writes its own source partition, so relay processes never append to the same file
+        if measurement.data_source.startswith("kiosk"):
+            return "kiosk", f"kiosk/{measurement.settings.api_kkid}"
+        return "openapi", f"openapi/{measurement.device_id}"
+
+    def add_rows(self, device_type: str, source: str, rows: List[tuple]) -> None:
+        with self.lock:
+            for row in rows:
+                # Days are UTC dates, so Kenter backfills land in the day they were measured
+                day = time.strftime("%Y-%m-%d", time.gmtime(row[0]))
+                self.pending_rows.setdefault((device_type, source, day), []).append(row)
+
+    def make_partition_dir(self, device_type: str, source: str) -> str:
+        return os.path.join(self.conf.archive_dir, f"site={self.conf.site_descriptive_name}", f"device_type={device_type}", f"source={source}")
+
+    def flush(self) -> None:
+        """
+        Append the pending rows to the open day files, then compact finished days and rotate old ones. Called at the end of each cycle.
+        """
+        with self.lock:
+            pending_rows, self.pending_rows = self.pending_rows, {}
+            for (device_type, source, day), rows in pending_rows.items():
+                try:
+                    self.append_rows(device_type, source, day, rows)
+                except Exception as e:
+                    self.logger.exception(f"Archive write error, {len(rows)} {device_type} rows of {day} dropped: '{e}'")
+
+            today = time.strftime("%Y-%m-%d", time.gmtime())
+            for device_type, source in {(device_type, source) for device_type, source, _ in pending_rows}:
+                self.compact_finished_days(device_type, source, today)
+            if self.conf.archive_retention_days > 0 and self.last_rotation_day != today:
+                self.last_rotation_day = today
+                self.rotate_days(today)
+
+    def append_rows(self, device_type: str, source: str, day: str, rows: List[tuple]) -> None:
+        partition_dir = self.make_partition_dir(device_type, source)
+        os.makedirs(partition_dir, exist_ok=True)
+        open_path = os.path.join(partition_dir, day + OPEN_SUFFIX)
+        write_header = not os.path.exists(open_path)
+        # Appending adds a gzip member, a file of concatenated members is read as one stream by gzip and CSV readers
+        with gzip.open(open_path, "at", newline="", compresslevel=6) as open_file:
+            writer = csv.writer(open_file)
+            if write_header:
+                writer.writerow(KEY_COLUMNS + ARCHIVE_COLUMNS[device_type])
+            writer.writerows(rows)
+        self.logger.debug(f"Appended {len(rows)} {device_type} rows to archive file {open_path}")
+
+    def compact_finished_days(self, device_type: str, source: str, today: str) -> None:
+        partition_dir = self.make_partition_dir(device_type, source)
+        if not os.path.isdir(partition_dir):
+            return
+        for file_name in sorted(os.listdir(partition_dir)):
+            if file_name.endswith(OPEN_SUFFIX) and file_name[: -len(OPEN_SUFFIX)] < today:
+                try:
+                    self.compact_day(device_type, partition_dir, file_name[: -len(OPEN_SUFFIX)])
+                except Exception as e:
+                    # The open file is kept, compaction is retried after the next write to this partition
+                    self.logger.exception(f"Archive compaction error for {os.path.join(partition_dir, file_name)}: '{e}'")
+
+    def compact_day(self, device_type: str, partition_dir: str, day: str) -> None:
+        started = time.perf_counter()
+        columns = KEY_COLUMNS + ARCHIVE_COLUMNS[device_type]
+        open_path = os.path.join(partition_dir, day + OPEN_SUFFIX)
+        compacted_path = os.path.join(partition_dir, day + (".parquet" if self.conf.archive_format == "parquet" else ".csv.gz"))
+
+        # Late rows, e.g. refetched Kenter days, are merged with the day compacted earlier. Later rows replace earlier rows of the same device and time
+        rows_by_key = {}
+        for path in (compacted_path, open_path):
+            if os.path.exists(path):
+                for row in self.read_rows(path, columns):
+                    rows_by_key[(row[1], row[0])] = row
+        rows = [rows_by_key[key] for key in sorted(rows_by_key)]
+
+        temp_path = compacted_path + ".tmp"
+        if self.conf.archive_format == "parquet":
+            table = self.pyarrow.table({column: [row[column_idx] for row in rows] for column_idx, column in enumerate(columns)})
+            self.pyarrow_parquet.write_table(table, temp_path, compression="zstd")
+        else:
+            with gzip.open(temp_path, "wt", newline="", compresslevel=9) as compacted_file:
+                writer = csv.writer(compacted_file)
+                writer.writerow(columns)
+                writer.writerows(rows)
+        os.replace(temp_path, compacted_path)
+        os.remove(open_path)
+        self.logger.info(f"Compacted {len(rows)} {device_type} rows of {day} to {compacted_path} in {time.perf_counter() - started:.1f}s")
+
+    def read_rows(self, path: str, columns: Tuple[str, ...]) -> List[tuple]:
+        if path.endswith(".parquet"):
+            table = self.pyarrow_parquet.read_table(path, columns=list(columns))
+            return list(zip(*(table.column(column).to_pylist() for column in columns)))
+        with gzip.open(path, "rt", newline="") as archive_file:
+            reader = csv.reader(archive_file)
+            header = next(reader, None)
+            if header is None:
+                return []
+            return [(int(row[0]), row[1], row[2], *map(float, row[3:])) for row in reader if row != header]
+
+    def rotate_days(self, today: str) -> None:
+        oldest_day = time.strftime("%Y-%m-%d", time.gmtime(calendar.timegm(time.strptime(today, "%Y-%m-%d")) - self.conf.archive_retention_days * 86400))
+        deleted_files = 0
+        for partition_dir, _, file_names in os.walk(self.conf.archive_dir):
+            for file_name in file_names:
+                # Day files only, open files of old days are compacted first
+                if (file_name.endswith(".csv.gz") and not file_name.endswith(OPEN_SUFFIX) or file_name.endswith(".parquet")) and file_name[:10] < oldest_day:
+                    try:
+                        os.remove(os.path.join(partition_dir, file_name))
+                        deleted_files += 1
+                    except OSError as e:
+                        self.logger.warning(f"Could not delete archive file {os.path.join(partition_dir, file_name)}: '{e}'")
+        if deleted_files:
+            self.logger.info(f"Deleted {deleted_files} archive day files older than {self.conf.archive_retention_days} days")
+
+    def close(self) -> None:
+        """
+        Append the pending rows, used on shutdown.
+        """
+        self.flush()
+
+    def reload_config(self, changed_fields):
+        """
+        Validate a changed format, called on config reload. Pending rows are written to the new directory or format on the next flush.
+        """
+        if {"archive_module_enabled", "archive_format"} & changed_fields and self.conf.archive_module_enabled:
+            self.import_format_classes()
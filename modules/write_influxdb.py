@@ -1,90 +1,161 @@
-from datetime import datetime, timezone
+import time
+from threading import Lock
+from typing import Optional, Union
 
 from modules.conf_models import PyFusionSolarSettings
+from modules.influxdb_bulk_import import InfluxDbBulkImport
+from modules.influxdb_http_writer import InfluxDbHttpWriter
 from modules.models import FusionSolarInverterMeasurement, FusionSolarMeterMeasurement, KenterTransformerMeasurements
 
+# native writes line protocol over HTTP itself, library uses the influxdb or influxdb-client package
+INFLUXDB_CLIENTS = ("native", "library")
+# minimal tags points with their identity only, the descriptive tags go to the metadata measurement
+INFLUXDB_TAG_MODES = ("full", "minimal")
+METADATA_MEASUREMENT = "device_metadata"
+# Identity tags of a device, these do not change when a device or station is renamed
+DEVICE_IDENTITY_TAGS = ("site_descriptive_name", "device_type", "device_id", "station_dn")
+TRANSFORMER_IDENTITY_TAGS = ("site_descriptive_name", "device_type", "connection_id", "metering_point_id", "channel_id")
+# Tags describing the write instead of the device, left out in minimal tag mode. Realtime and backfilled points share a series
+WRITE_TAGS = ("data_source",)
+
 
 class WriteInfluxDb:
     def __init__(self, conf: PyFusionSolarSettings, logger):
         self.conf = conf
         self.logger = logger
         self.logger.debug("WriteInfluxDb class instantiated")
-        self.import_client_classes()
         self.classes_instantiated = False
+        # Client and version of the open connection, the settings may change on config reload
+        self.instantiated_client = self.conf.influxdb_client
+        self.instantiated_is_v2 = self.conf.influxdb_is_v2
+        self.instantiate_lock = Lock()
+        # Descriptive tags last written to the metadata measurement per device identity
+        self.written_metadata = {}
+        self.metadata_lock = Lock()
+        if self.conf.influxdb_module_enabled:
+            self.import_client_classes()
 
     def write_pvdata_to_influxdb(self, measurement: FusionSolarInverterMeasurement):
-        if self.classes_instantiated == False:
-            self.classes_instantiated = self.instantiate()
+        self.ensure_instantiated()
 
         influxdb_record = self.make_inverter_measurement_influxdb_record(measurement)
-        self.logger.info(f"Writing InfluxDB FusionSolar record for inverter: {measurement.settings_descriptive_name} [{measurement.station_dn}]")
+        self.logger.debug(f"Writing InfluxDB FusionSolar record for inverter: {measurement.settings_descriptive_name} [{measurement.station_dn}]")
         try:
-            if self.conf.influxdb_is_v2:
-                self.logger.debug("Writing PvData to InfluxDB v2...")
-                self.ifwrite_api.write(
-                    bucket=self.conf.influxdb_v2_bucket,
-                    org=self.conf.influxdb_v2_org,
-                    record=influxdb_record,
-                    write_precision="s",
-                )
-            else:
-                self.logger.debug("Writing PvData to InfluxDB v1...")
-                self.influxclient.write_points(influxdb_record, time_precision="s")
+            self.logger.debug("Writing PvData to InfluxDB...")
+            self.write_records(influxdb_record)
         except ConnectionError as e:
             self.logger.error("Could not connect to InfluxDB: '{}'".format(str(e)))
         except Exception as e:
             self.logger.exception(f"InfluxDB PvData write error: '{e}'")
 
     def write_grid_data_to_influxdb(self, measurement: FusionSolarMeterMeasurement):
-        if self.classes_instantiated == False:
-            self.classes_instantiated = self.instantiate()
+        self.ensure_instantiated()
 
         influxdb_record = self.make_grid_meter_measurement_influxdb_record(measurement)
-        self.logger.info(f"Writing InfluxDB FusionSolar record for grid meter: {measurement.settings_descriptive_name} [{measurement.station_dn}]")
+        self.logger.debug(f"Writing InfluxDB FusionSolar record for grid meter: {measurement.settings_descriptive_name} [{measurement.station_dn}]")
         try:
-            if self.conf.influxdb_is_v2:
-                self.logger.debug("Writing PvData to InfluxDB v2...")
-                self.ifwrite_api.write(
-                    bucket=self.conf.influxdb_v2_bucket,
-                    org=self.conf.influxdb_v2_org,
-                    record=influxdb_record,
-                    write_precision="s",
-                )
-            else:
-                self.logger.debug("Writing PvData to InfluxDB v1...")
-                self.influxclient.write_points(influxdb_record, time_precision="s")
+            self.logger.debug("Writing PvData to InfluxDB...")
+            self.write_records(influxdb_record)
         except ConnectionError as e:
             self.logger.error("Could not connect to InfluxDB: '{}'".format(str(e)))
         except Exception as e:
             self.logger.exception(f"InfluxDB PvData write error: '{e}'")
 
+    def write_history_to_influxdb(self, measurements: list[Union[FusionSolarInverterMeasurement, FusionSolarMeterMeasurement]]):
+        """
+        Write backfilled inverter and grid meter measurements in one request, each with its original timestamp.
+        """
+        if not measurements:
+            return
+        self.ensure_instantiated()
+
+        influxdb_records = []
+        for measurement in measurements:
+            if isinstance(measurement, FusionSolarMeterMeasurement):
+                influxdb_records.extend(self.make_grid_meter_measurement_influxdb_record(measurement))
+            else:
+                influxdb_records.extend(self.make_inverter_measurement_influxdb_record(measurement))
+        self.logger.info(f"Writing {len(influxdb_records)} backfilled FusionSolar InfluxDB records")
+        try:
+            self.logger.debug("Writing backfilled PvData to InfluxDB...")
+            self.write_records(influxdb_records)
+        except ConnectionError as e:
+            self.logger.error("Could not connect to InfluxDB: '{}'".format(str(e)))
+        except Exception as e:
+            self.logger.exception(f"InfluxDB backfilled PvData write error: '{e}'")
+
     def write_kenterdata_to_influxdb(self, measurement: KenterTransformerMeasurements):
-        if self.classes_instantiated == False:
-            self.classes_instantiated = self.instantiate()
+        self.ensure_instantiated()
 
         influxdb_record = self.make_kenterdata_influxdb_record(measurement)
         self.logger.info(
             f"Writing GridData InfluxDB record for transformer [{measurement.descriptive_name}], connectionId: [{measurement.connection_id}], meteringPointId: [{measurement.metering_point_id}]"
         )
         try:
-            if self.conf.influxdb_is_v2:
-                self.logger.debug("Writing GridData to InfluxDB v2...")
-                self.ifwrite_api.write(
-                    bucket=self.conf.influxdb_v2_bucket,
-                    org=self.conf.influxdb_v2_org,
-                    record=influxdb_record,
-                    write_precision="s",
-                )
-            else:
-                self.logger.debug("Writing GridData to InfluxDB v1...")
-                self.influxclient.write_points(influxdb_record, time_precision="s")
+            self.logger.debug("Writing GridData to InfluxDB...")
+            self.write_records(influxdb_record)
         except ConnectionError as e:
             self.logger.error("Could not connect to InfluxDB: '{}'".format(str(e)))
         except Exception as e:
             self.logger.exception("InfluxDB GridData write error: '{}'".format(str(e)))
 
+    def start_bulk_import(self) -> Optional[InfluxDbBulkImport]:
+        """
+        Bulk import for large writes like Kenter backfills. None with the library client, or if InfluxDB could not be reached.
+        """
+        self.ensure_instantiated()
+        if not self.classes_instantiated or self.instantiated_client != "native":
+            return None
+        return InfluxDbBulkImport(self.conf, self.logger, self.influxclient)
+
+    def add_kenterdata_to_bulk_import(self, bulk_import: InfluxDbBulkImport, measurement: KenterTransformerMeasurements):
+        self.logger.debug(
+            f"Adding {len(measurement)} GridData points to the bulk import for transformer [{measurement.descriptive_name}], connectionId: [{measurement.connection_id}], meteringPointId: [{measurement.metering_point_id}]"
+        )
+        fields = {"interval_power_avg_w": measurement.interval_power_avg_w, "interval_energy_wh": measurement.interval_energy_wh}
+        try:
+            tags, metadata_records = self.apply_tag_mode(self.make_kenterdata_tags(measurement), TRANSFORMER_IDENTITY_TAGS, int(measurement.timestamps[0]) if len(measurement) else int(time.time()))
+            bulk_import.add_records(metadata_records)
+            bulk_import.add_columns("energy", tags, measurement.timestamps, fields)
+        except Exception as e:
+            self.forget_written_metadata()
+            self.logger.exception(f"InfluxDB GridData bulk import error: '{e}'")
+
+    def write_records(self, influxdb_records: list[dict]) -> None:
+        try:
+            if self.instantiated_client == "native":
+                self.influxclient.write_records(influxdb_records)
+            elif self.instantiated_is_v2:
+                self.ifwrite_api.write(bucket=self.conf.influxdb_v2_bucket, org=self.conf.influxdb_v2_org, record=influxdb_records, write_precision="s")
+            else:
+                self.influxclient.write_points(influxdb_records, time_precision="s")
+        except Exception:
+            # The metadata records may not have been written, so all metadata is written again with the next points
+            self.forget_written_metadata()
+            raise
+
+    def apply_tag_mode(self, tags: dict, identity_tag_keys: tuple, timestamp: int) -> tuple[dict, list[dict]]:
+        """
+        Returns the tags of a point and the metadata records to write with it. In minimal tag mode a point only has its
+        identity tags, the other tags are written as string fields of the metadata measurement when they change.
+        """
+        if self.conf.influxdb_tag_mode != "minimal":
+            return tags, []
+        identity_tags = {key: value for key, value in tags.items() if key in identity_tag_keys}
+        metadata = {key: value for key, value in tags.items() if key not in identity_tag_keys and key not in WRITE_TAGS}
+        identity = tuple(sorted(identity_tags.items()))
+        with self.metadata_lock:
+            if not metadata or self.written_metadata.get(identity) == metadata:
+                return identity_tags, []
+            self.written_metadata[identity] = metadata
+        return identity_tags, [{"measurement": METADATA_MEASUREMENT, "time": timestamp, "fields": metadata, "tags": identity_tags}]
+
+    def forget_written_metadata(self) -> None:
+        with self.metadata_lock:
+            self.written_metadata.clear()
+
     def make_inverter_measurement_influxdb_record(self, measurement: FusionSolarInverterMeasurement) -> list[dict]:
-        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        timestamp = self.make_measurement_timestamp(measurement.timestamp)
         influxdb_measurement = "energy"
         device_type = "inverter"
 
@@ -102,14 +173,14 @@ class WriteInfluxDb:
             "device_model": measurement.device_model,
         }
         # Do not set tag if string is empty
-        tags = {key: value for key, value in raw_tags.items() if value}
+        tags, metadata_records = self.apply_tag_mode({key: value for key, value in raw_tags.items() if value}, DEVICE_IDENTITY_TAGS, timestamp)
 
         fields = {"real_time_power_w": measurement.real_time_power_w, "liftetime_energy_wh": measurement.lifetime_energy_wh}
         record = {"measurement": influxdb_measurement, "time": timestamp, "fields": fields, "tags": tags}
-        return [record]
+        return metadata_records + [record]
     
     def make_grid_meter_measurement_influxdb_record(self, measurement: FusionSolarMeterMeasurement) -> list[dict]:
-        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        timestamp = self.make_measurement_timestamp(measurement.timestamp)
         influxdb_measurement = "energy"
         device_type = "grid_meter"
 
@@ -127,35 +198,45 @@ class WriteInfluxDb:
             "device_model": measurement.device_model,
         }
         # Do not set tag if string is empty
-        tags = {key: value for key, value in raw_tags.items() if value}
+        tags, metadata_records = self.apply_tag_mode({key: value for key, value in raw_tags.items() if value}, DEVICE_IDENTITY_TAGS, timestamp)
 
         fields = {"active_power_w": measurement.active_power_w}
         record = {"measurement": influxdb_measurement, "time": timestamp, "fields": fields, "tags": tags}
-        return [record]
-
-    def make_kenterdata_influxdb_record(self, transformer_data: KenterTransformerMeasurements):
-        influxdb_measurement_str = "energy"
-        device_type = "grid_transformer"
+        return metadata_records + [record]
 
-        influxdb_records = []
+    def make_measurement_timestamp(self, measurement_timestamp: float) -> int:
+        # Unix time in seconds, written with second precision. Measurements without a timestamp (0) are written with the current time
+        return int(measurement_timestamp or time.time())
 
-        tags = {
+    def make_kenterdata_tags(self, transformer_data: KenterTransformerMeasurements) -> dict:
+        return {
             "site_descriptive_name": self.conf.site_descriptive_name,
             "transformer_descriptive_name": transformer_data.descriptive_name,
             "connection_id": transformer_data.connection_id,
             "metering_point_id": transformer_data.metering_point_id,
             "channel_id": transformer_data.channel_id,
-            "device_type": device_type,
+            "device_type": "grid_transformer",
         }
 
-        for measurement in transformer_data.measurements:
-            fields = {"interval_power_avg_w": measurement.interval_power_avg_w, "interval_energy_wh": measurement.interval_energy_wh}
-            record = {"measurement": influxdb_measurement_str, "time": datetime.fromtimestamp(measurement.timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"), "fields": fields, "tags": tags}
+    def make_kenterdata_influxdb_record(self, transformer_data: KenterTransformerMeasurements):
+        influxdb_measurement_str = "energy"
+        tags, influxdb_records = self.apply_tag_mode(self.make_kenterdata_tags(transformer_data), TRANSFORMER_IDENTITY_TAGS, int(transformer_data.timestamps[0]) if len(transformer_data) else int(time.time()))
+
+        for timestamp, interval_energy_wh, interval_power_avg_w in zip(transformer_data.timestamps, transformer_data.interval_energy_wh, transformer_data.interval_power_avg_w):
+            fields = {"interval_power_avg_w": interval_power_avg_w, "interval_energy_wh": interval_energy_wh}
+            record = {"measurement": influxdb_measurement_str, "time": int(timestamp), "fields": fields, "tags": tags}
             influxdb_records.append(record)
 
         return influxdb_records
 
     def import_client_classes(self):
+        if self.conf.influxdb_client not in INFLUXDB_CLIENTS:
+            raise Exception(f"Invalid influxdb_client '{self.conf.influxdb_client}', should be one of: {', '.join(INFLUXDB_CLIENTS)}")
+        if self.conf.influxdb_tag_mode not in INFLUXDB_TAG_MODES:
+            raise Exception(f"Invalid influxdb_tag_mode '{self.conf.influxdb_tag_mode}', should be one of: {', '.join(INFLUXDB_TAG_MODES)}")
+        if self.conf.influxdb_client == "native":
+            self.logger.debug("InfluxDB native line protocol writer selected, no client library imported")
+            return
         try:
             if self.conf.influxdb_is_v2:
                 self.import_client_classes_v2()
@@ -188,9 +269,47 @@ class WriteInfluxDb:
         except Exception as e:
             raise Exception(f"Error importing InfluxDB client library: '{e}'")
 
+    def ensure_instantiated(self):
+        # Relays may write from multiple threads, e.g. when polling OpenAPI accounts concurrently
+        with self.instantiate_lock:
+            if self.classes_instantiated == False:
+                self.classes_instantiated = self.instantiate()
+
+    def close(self):
+        """
+        Flush pending writes and release the client connections, used on shutdown.
+        """
+        with self.instantiate_lock:
+            if not self.classes_instantiated:
+                return
+            try:
+                if self.instantiated_client == "library" and self.instantiated_is_v2:
+                    self.ifwrite_api.close()
+                self.influxclient.close()
+                self.logger.debug("InfluxDB client closed")
+            except Exception as e:
+                self.logger.exception(f"Error closing InfluxDB client: '{e}'")
+            self.classes_instantiated = False
+
+    def reload_config(self, changed_fields):
+        """
+        Reconnect with the new connection settings on the next write, called on config reload.
+        """
+        if not any(field_name.startswith("influxdb_") for field_name in changed_fields):
+            return
+        self.close()
+        self.forget_written_metadata()
+        if self.conf.influxdb_module_enabled:
+            self.import_client_classes()
+        self.logger.info("InfluxDB settings changed, reconnecting on the next write")
+
     def instantiate(self):
+        self.instantiated_client = self.conf.influxdb_client
+        self.instantiated_is_v2 = self.conf.influxdb_is_v2
         try:
-            if self.conf.influxdb_is_v2:
+            if self.conf.influxdb_client == "native":
+                self.influxclient = InfluxDbHttpWriter(self.conf, self.logger)
+            elif self.conf.influxdb_is_v2:
                 self.instantiate_v2()
             else:
                 self.instantiate_v1()
@@ -210,7 +329,7 @@ class WriteInfluxDb:
             self.influxclient = self.InfluxDBClient(
                 host=self.conf.influxdb_host,
                 port=self.conf.influxdb_port,
-                timeout=3,
+                timeout=self.conf.influxdb_timeout_seconds,
                 username=self.conf.influxdb_v1_username,
                 password=self.conf.influxdb_v1_password,
                 database=self.conf.influxdb_v1_db_name,
@@ -231,6 +350,8 @@ class WriteInfluxDb:
                 url=url,
                 org=self.conf.influxdb_v2_org,
                 token=self.conf.influxdb_v2_token,
+                # In milliseconds
+                timeout=int(self.conf.influxdb_timeout_seconds * 1000),
             )
             self.if2bucket_api = self.influxclient.buckets_api()
             self.if2organization_api = self.influxclient.organizations_api()
@@ -1,9 +1,17 @@
 import re
 import json
+import os
+import threading
+import time
 from socket import gaierror
-import paho.mqtt.publish as publish
+from typing import Dict, List, Optional, Tuple, Union
+import paho.mqtt.client as mqtt_client
 from modules.conf_models import PyFusionSolarSettings
 from modules.models import FusionSolarInverterMeasurement, FusionSolarMeterMeasurement
+from modules.mqtt_deadband import MqttDeadband
+
+# device publishes a state message per device, station one message per station per cycle with the fields of all its devices
+MQTT_PAYLOAD_MODES = ("device", "station")
 
 
 class WriteMqtt:
@@ -12,6 +20,54 @@ class WriteMqtt:
         self.logger = logger
         self.logger.debug("WriteMqtt class instantiated")
         self.hass_discovery_published = []
+        self.deadband = MqttDeadband(conf, logger)
+        if self.conf.mqtt_module_enabled and self.conf.mqtt_payload_mode not in MQTT_PAYLOAD_MODES:
+            raise Exception(f"Invalid mqtt_payload_mode '{self.conf.mqtt_payload_mode}', should be one of: {', '.join(MQTT_PAYLOAD_MODES)}")
+        # Devices of the cycle per (data source, station), in station payload mode. OpenAPI accounts add devices from their own threads
+        self.pending_stations: Dict[Tuple[str, str], dict] = {}
+        self.pending_stations_lock = threading.Lock()
+
+    def reload_config(self, changed_fields):
+        """
+        Publish the Home Assistant discovery configs and the states again if their topics, broker or device names changed, called on config reload.
+        """
+        discovery_fields = {"site_descriptive_name", "fusionsolar_kiosks", "fusionsolar_open_api_inverters", "fusionsolar_open_api_meters"}
+        if any(field_name.startswith("mqtt_") or field_name in discovery_fields for field_name in changed_fields):
+            self.hass_discovery_published = []
+            self.deadband.reset()
+
+    def publish_single(self, topic: str, payload: str, retain: bool, auth: Optional[dict]) -> None:
+        """
+        Connect, publish one message and disconnect, like paho's publish.single but within mqtt_timeout_seconds.
+        """
+        self.publish_messages([(topic, payload, retain)], auth)
+
+    def publish_messages(self, messages: List[Tuple[str, str, bool]], auth: Optional[dict]) -> None:
+        """
+        Connect, publish the (topic, payload, retain) messages and disconnect, like paho's publish.multiple but within
+        mqtt_timeout_seconds. publish.multiple reconnects forever when the broker accepts connections but does not respond.
+        """
+        deadline = time.monotonic() + self.conf.mqtt_timeout_seconds
+        # A broker disconnects the existing session of a client id, so each relay process and OpenAPI account thread uses its own
+        client_id = f"{self.conf.site_descriptive_name}-{os.getpid()}-{threading.get_native_id()}"
+        client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, client_id=client_id, reconnect_on_failure=False)
+        client.connect_timeout = self.conf.mqtt_timeout_seconds
+        if auth:
+            client.username_pw_set(auth["username"], auth["password"])
+        client.connect(self.conf.mqtt_host, self.conf.mqtt_port, keepalive=60)
+        try:
+            message_infos = None
+            while message_infos is None or not all(message_info.is_published() for message_info in message_infos):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"No response from MQTT broker within {self.conf.mqtt_timeout_seconds}s")
+                return_code = client.loop(timeout=0.1)
+                if return_code != mqtt_client.MQTT_ERR_SUCCESS:
+                    raise Exception(f"MQTT connection failed: {mqtt_client.error_string(return_code)}")
+                # Published once the broker accepted the connection, like publish.multiple
+                if message_infos is None and client.is_connected():
+                    message_infos = [client.publish(topic, payload, qos=0, retain=retain) for topic, payload, retain in messages]
+        finally:
+            client.disconnect()
 
     def publish_pvdata_to_mqtt(self, measurement: FusionSolarInverterMeasurement):
         """
@@ -51,20 +107,18 @@ class WriteMqtt:
             "day_energy_wh": measurement.day_energy_wh,
         }
 
+        if self.conf.mqtt_payload_mode == "station":
+            self.add_to_station_payload(measurement, station_dn_sanitized, device_dn_sanitized, data_points)
+            return
+
+        if not self.deadband.should_publish(topic, data_points, measurement.data_source):
+            return
+
         try:
             value = json.dumps(data_points)
-            self.logger.info(f"Publishing to MQTT topic: {topic}, value: {value}")
-            publish.single(
-                topic,
-                payload=value,
-                qos=0,
-                retain=False,
-                hostname=self.conf.mqtt_host,
-                port=self.conf.mqtt_port,
-                client_id=self.conf.site_descriptive_name,
-                keepalive=60,
-                auth=auth_obj,
-            )
+            self.logger.debug(f"Publishing to MQTT topic: {topic}, value: {value}")
+            self.publish_single(topic, value, retain=False, auth=auth_obj)
+            self.deadband.mark_published(topic, data_points)
 
         except TimeoutError as e:
             self.logger.error(f"Timeout while publishing to MQTT: '{e}'")
@@ -114,20 +168,18 @@ class WriteMqtt:
             "active_power_w": measurement.active_power_w,
         }
 
+        if self.conf.mqtt_payload_mode == "station":
+            self.add_to_station_payload(measurement, station_dn_sanitized, device_dn_sanitized, data_points)
+            return
+
+        if not self.deadband.should_publish(topic, data_points, measurement.data_source):
+            return
+
         try:
             value = json.dumps(data_points)
-            self.logger.info(f"Publishing to MQTT topic: {topic}, value: {value}")
-            publish.single(
-                topic,
-                payload=value,
-                qos=0,
-                retain=False,
-                hostname=self.conf.mqtt_host,
-                port=self.conf.mqtt_port,
-                client_id=self.conf.site_descriptive_name,
-                keepalive=60,
-                auth=auth_obj,
-            )
+            self.logger.debug(f"Publishing to MQTT topic: {topic}, value: {value}")
+            self.publish_single(topic, value, retain=False, auth=auth_obj)
+            self.deadband.mark_published(topic, data_points)
 
         except TimeoutError as e:
             self.logger.error(f"Timeout while publishing to MQTT: '{e}'")
@@ -141,11 +193,95 @@ class WriteMqtt:
         # Publish MQTT device discovery
         self.publish_homeassistant_discovery(station_dn_sanitized, device_dn_sanitized, measurement.measurement_type, measurement.data_source, measurement.device_model, topic, data_points)
 
-    def publish_homeassistant_discovery(self, station_dn_sanitized, device_dn_sanitized, measurement_type, data_source, device_model, state_topic, data_points):
+    def add_to_station_payload(self, measurement: Union[FusionSolarInverterMeasurement, FusionSolarMeterMeasurement], station_dn_sanitized: str, device_dn_sanitized: str, data_points: dict):
+        # Kiosks report the station as a single device without a device dn
+        device_key = device_dn_sanitized.lower() or measurement.measurement_type.lower()
+        with self.pending_stations_lock:
+            station = self.pending_stations.setdefault((measurement.data_source, station_dn_sanitized), {"station_name": measurement.station_name, "devices": {}})
+            station["devices"][device_key] = {
+                "measurement_type": measurement.measurement_type,
+                "device_dn_sanitized": device_dn_sanitized,
+                "device_model": measurement.device_model,
+                "data_points": data_points,
+            }
+
+    def publish_station_payloads(self):
+        """
+        Publish one state message per station with the devices of the cycle and station totals, over one connection.
+        Called at the end of each cycle, does nothing unless mqtt_payload_mode is station.
+        """
+        with self.pending_stations_lock:
+            stations, self.pending_stations = self.pending_stations, {}
+        if not stations:
+            return
+
+        # Prepare connection/auth info
+        if self.conf.mqtt_auth:
+            auth_obj = dict(username=self.conf.mqtt_username, password=self.conf.mqtt_password)
+        else:
+            auth_obj = None
+
+        messages = []
+        published_stations = []
+        for (data_source, station_dn_sanitized), station in stations.items():
+            # e.g. rootTopic / site_descriptive_name / sensors / openapi_realkpi / stations / stationDn / state
+            topic = "/".join(segment for segment in (self.conf.mqtt_root_topic.lower(), self.conf.site_descriptive_name.lower(), "sensors", data_source.lower(), "stations", station_dn_sanitized.lower(), "state") if segment)
+            totals = {}
+            for device in station["devices"].values():
+                for field_name, field_value in device["data_points"].items():
+                    if isinstance(field_value, (int, float)):
+                        totals[field_name] = totals.get(field_name, 0) + field_value
+            payload = {
+                "station_name": station["station_name"],
+                "device_count": len(station["devices"]),
+                "totals": totals,
+                "devices": {device_key: device["data_points"] for device_key, device in station["devices"].items()},
+            }
+
+            # Each device field is compared with its own deadband
+            flattened_data_points = {f"totals.{field_name}": field_value for field_name, field_value in totals.items()}
+            for device_key, device in station["devices"].items():
+                flattened_data_points.update({f"{device_key}.{field_name}": field_value for field_name, field_value in device["data_points"].items()})
+            if self.deadband.should_publish(topic, flattened_data_points, data_source):
+                messages.append((topic, json.dumps(payload), False))
+                published_stations.append((topic, flattened_data_points, data_source, station_dn_sanitized, station, totals))
+
+        if not messages:
+            return
+        try:
+            self.logger.debug(f"Publishing {len(messages)} station payloads to MQTT")
+            self.publish_messages(messages, auth_obj)
+            for topic, flattened_data_points, _, _, _, _ in published_stations:
+                self.deadband.mark_published(topic, flattened_data_points)
+        except TimeoutError as e:
+            self.logger.error(f"Timeout while publishing to MQTT: '{e}'")
+            return
+        except ConnectionRefusedError as e:
+            self.logger.error(f"Connection refused while connecting to MQTT host: '{e}'")
+            return
+        except gaierror as e:
+            self.logger.error(f"Could not get address info (resolve) MQTT host: '{e}'")
+            return
+        except Exception as e:
+            raise Exception(f"Exception while publishing to MQTT: '{e}'")
+
+        # Publish MQTT device discovery, the sensors of the devices and the station totals point into the station payload
+        for topic, _, data_source, station_dn_sanitized, station, totals in published_stations:
+            for device_key, device in station["devices"].items():
+                self.publish_homeassistant_discovery(
+                    station_dn_sanitized, device["device_dn_sanitized"], device["measurement_type"], data_source, device["device_model"], topic, device["data_points"], f"value_json.devices.get('{device_key}', {{}})"
+                )
+            # Kiosks report the station itself, which already has the totals
+            if any(device["measurement_type"] != "station" for device in station["devices"].values()):
+                totals_data_points = {"descriptive_name": station["station_name"] or station_dn_sanitized, **totals}
+                self.publish_homeassistant_discovery(station_dn_sanitized, "", "station_totals", data_source, "", topic, totals_data_points, "value_json.totals")
+
+    def publish_homeassistant_discovery(self, station_dn_sanitized, device_dn_sanitized, measurement_type, data_source, device_model, state_topic, data_points, value_json_path=None):
         """
         Publish Home Assistant discovery config for each data field.
         Any field ending in '_w' is treated as a power (W) sensor,
         and any field ending in '_wh' is treated as an energy (Wh) sensor.
+        value_json_path points to the data points within a station payload.
         """
 
         # Only proceed if HASS device discovery is enabled
@@ -219,6 +355,11 @@ class WriteMqtt:
                 },
                 "value_template": f"{{{{ none if value_json.{field_name} is none else ((value_json.{field_name}|float / 1000) if (value_json.{field_name}|float > 0) else 0) }}}}",
             }
+            if value_json_path:
+                # A device missing from a station payload, e.g. after a failed fetch, reads as unknown
+                config_payload["value_template"] = (
+                    f"{{% set field_value = {value_json_path}.get('{field_name}') %}}{{{{ none if field_value is none else ((field_value|float / 1000) if (field_value|float > 0) else 0) }}}}"
+                )
 
             # Add the sensor-specific attributes
             if device_class:
@@ -231,18 +372,9 @@ class WriteMqtt:
             # Publish discovery config
             try:
                 payload_str = json.dumps(config_payload)
-                self.logger.info(f"Publishing Home Assistant discovery config to MQTT topic: {discovery_topic}, payload: {payload_str}")
-                publish.single(
-                    discovery_topic,
-                    payload=payload_str,
-                    qos=0,
-                    retain=True,  # Retain so HA automatically loads these on restart
-                    hostname=self.conf.mqtt_host,
-                    port=self.conf.mqtt_port,
-                    client_id=self.conf.site_descriptive_name,
-                    keepalive=60,
-                    auth=auth_obj,
-                )
+                self.logger.debug(f"Publishing Home Assistant discovery config to MQTT topic: {discovery_topic}, payload: {payload_str}")
+                # Retain so HA automatically loads these on restart
+                self.publish_single(discovery_topic, payload_str, retain=True, auth=auth_obj)
             except TimeoutError as e:
                 self.logger.error(f"Timeout while publishing HA discovery to MQTT: '{e}'")
             except ConnectionRefusedError as e:
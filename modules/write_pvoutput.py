@@ -13,7 +13,7 @@ class WritePvOutput:
     def write_pvdata_to_pvoutput(self, measurement: FusionSolarInverterMeasurement, dev_id: str, pvoutput_system_id: int):
         if self.conf.pvoutput_module_enabled:
             if pvoutput_system_id == 0:
-                self.logger.info(f"Skipping PVOutput API call for (kk)id: {dev_id}, output_pvoutput_system_id is not configured")
+                self.logger.debug(f"Skipping PVOutput API call for (kk)id: {dev_id}, output_pvoutput_system_id is not configured")
             else:
                 pvoutput_header_obj = {
                     "X-Pvoutput-Apikey": self.conf.pvoutput_api_key,
@@ -23,7 +23,7 @@ class WritePvOutput:
                 pvoutput_data_obj = self.make_pvoutput_pvdata_obj(measurement)
 
                 try:
-                    self.logger.info(
+                    self.logger.debug(
                         "Writing to PVOutput. Header: {} Data: {}".format(
                             pvoutput_header_obj, pvoutput_data_obj
                         )
@@ -32,7 +32,8 @@ class WritePvOutput:
                         self.conf.pvoutput_record_url,
                         data=pvoutput_data_obj,
                         headers=pvoutput_header_obj,
-                        verify=False
+                        verify=False,
+                        timeout=(self.conf.http_connect_timeout_seconds, self.conf.http_read_timeout_seconds),
                     )
                     self.logger.debug("PVOutput response {}".format(api_response.text))
                     api_response.raise_for_status()
@@ -45,7 +46,7 @@ class WritePvOutput:
             self.logger.debug("PVOutput writing disabled")
 
     def make_pvoutput_pvdata_obj(self, inverter_kpi: FusionSolarInverterMeasurement):
-        localtime = time.localtime()
+        localtime = time.localtime(inverter_kpi.timestamp or None)
         pvodate = time.strftime("%Y%m%d", localtime)
         pvotime = time.strftime("%H:%M", localtime)
 
@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import time
+from threading import Lock
+from typing import Union
+
+from modules.conf_models import PyFusionSolarSettings
+from modules.models import FusionSolarInverterMeasurement, FusionSolarMeterMeasurement, KenterTransformerMeasurements
+
+# One table per device type, the primary key is the (device, time) index. WITHOUT ROWID stores the rows in that index
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS inverter (device_key TEXT NOT NULL, time INTEGER NOT NULL, real_time_power_w REAL, lifetime_energy_wh REAL, day_energy_wh REAL, PRIMARY KEY (device_key, time)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS grid_meter (device_key TEXT NOT NULL, time INTEGER NOT NULL, active_power_w REAL, PRIMARY KEY (device_key, time)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS grid_transformer (device_key TEXT NOT NULL, time INTEGER NOT NULL, interval_energy_wh REAL, interval_power_avg_w REAL, PRIMARY KEY (device_key, time)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS device (device_key TEXT PRIMARY KEY, device_type TEXT, descriptive_name TEXT, station_name TEXT, station_dn TEXT, device_name TEXT, device_model TEXT)",
+)
+INSERT_STATEMENTS = {
+    "inverter": "INSERT OR REPLACE INTO inverter (device_key, time, real_time_power_w, lifetime_energy_wh, day_energy_wh) VALUES (?, ?, ?, ?, ?)",
+    "grid_meter": "INSERT OR REPLACE INTO grid_meter (device_key, time, active_power_w) VALUES (?, ?, ?)",
+    "grid_transformer": "INSERT OR REPLACE INTO grid_transformer (device_key, time, interval_energy_wh, interval_power_avg_w) VALUES (?, ?, ?, ?)",
+}
+UPSERT_DEVICE = (
+    "INSERT INTO device (device_key, device_type, descriptive_name, station_name, station_dn, device_name, device_model) VALUES (?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(device_key) DO UPDATE SET device_type = excluded.device_type, descriptive_name = excluded.descriptive_name, station_name = excluded.station_name, "
+    "station_dn = excluded.station_dn, device_name = excluded.device_name, device_model = excluded.device_model"
+)
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+class WriteSqlite:
+    """
+    Stores measurements in a local SQLite database, for sites without an InfluxDB server. Rows are collected and
+    inserted with executemany in one transaction per cycle, or earlier when sqlite_batch_size rows are pending.
+    The database is in WAL mode, so dashboards and backups can read it while the relays write.
+    """
+
+    def __init__(self, conf: PyFusionSolarSettings, logger):
+        self.conf = conf
+        self.logger = logger
+        self.logger.debug("WriteSqlite class instantiated")
+        self.lock = Lock()
+        self.connection = None
+        self.pending_rows = {table: [] for table in INSERT_STATEMENTS}
+        self.pending_row_count = 0
+        self.pending_devices = {}
+        self.written_devices = {}
+        self.last_prune_time = 0.0
+
+    def connect(self) -> sqlite3.Connection:
+        # Resolved on every connect, the file setting may change on config reload
+        database_path = os.path.abspath(self.conf.sqlite_file)
+        database_dir = os.path.dirname(database_path)
+        if database_dir:
+            os.makedirs(database_dir, exist_ok=True)
+        # Used from the account threads of the OpenAPI relay, access is serialized by self.lock
+        connection = sqlite3.connect(database_path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode a commit survives an application crash with synchronous NORMAL, only a power loss may undo the last commits
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+        self.logger.info(f"SQLite database {database_path} opened")
+        return connection
+
+    def write_pvdata_to_sqlite(self, measurement: FusionSolarInverterMeasurement):
+        device_key = self.make_device_key(measurement)
+        self.add_device(device_key, "inverter", measurement)
+        self.add_rows("inverter", [(device_key, self.make_timestamp(measurement.timestamp), measurement.real_time_power_w, measurement.lifetime_energy_wh, measurement.day_energy_wh)])
+
+    def write_grid_data_to_sqlite(self, measurement: FusionSolarMeterMeasurement):
+        device_key = self.make_device_key(measurement)
+        self.add_device(device_key, "grid_meter", measurement)
+        self.add_rows("grid_meter", [(device_key, self.make_timestamp(measurement.timestamp), measurement.active_power_w)])
+
+    def write_kenterdata_to_sqlite(self, measurement: KenterTransformerMeasurements):
+        device_key = f"kenter/{measurement.connection_id}/{measurement.metering_point_id}"
+        with self.lock:
+            self.pending_devices[device_key] = ("grid_transformer", measurement.descriptive_name, "", "", "", "")
+        self.add_rows(
+            "grid_transformer",
+            [(device_key, int(timestamp), interval_energy_wh, interval_power_avg_w) for timestamp, interval_energy_wh, interval_power_avg_w in zip(measurement.timestamps, measurement.interval_energy_wh, measurement.interval_power_avg_w)],
+        )
+
+    def make_device_key(self, measurement: Union[FusionSolarInverterMeasurement, FusionSolarMeterMeasurement]) -> str:
+        # Same device keys as the stream filters and the measurement buffer
+        if measurement.data_source.startswith("kiosk"):
+            return f"kiosk/{measurement.settings.api_kkid}"
+        return f"openapi/{measurement.device_id}"
+
+    def make_timestamp(self, measurement_timestamp: float) -> int:
+        # Measurements without a timestamp (0) are stored with the current time
+        return int(measurement_timestamp or time.time())
+
+    def add_device(self, device_key: str, device_type: str, measurement: Union[FusionSolarInverterMeasurement, FusionSolarMeterMeasurement]) -> None:
+        device = (device_type, measurement.settings_descriptive_name, measurement.station_name, measurement.station_dn, measurement.device_name, measurement.device_model)
+        with self.lock:
+            self.pending_devices[device_key] = device
+
+    def add_rows(self, table: str, rows: list) -> None:
+        with self.lock:
+            self.pending_rows[table].extend(rows)
+            self.pending_row_count += len(rows)
+            if self.pending_row_count >= self.conf.sqlite_batch_size:
+                self.flush_locked()
+
+    def flush(self) -> None:
+        """
+        Insert the pending rows in one transaction and prune rows past the retention. Called at the end of each cycle and on shutdown.
+        """
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self) -> None:
+        pending_rows, self.pending_rows = self.pending_rows, {table: [] for table in INSERT_STATEMENTS}
+        self.pending_row_count = 0
+        # Only new or changed device metadata is written
+        changed_devices = [(device_key, *device) for device_key, device in self.pending_devices.items() if self.written_devices.get(device_key) != device]
+        self.pending_devices = {}
+        if not changed_devices and not any(pending_rows.values()):
+            return
+
+        try:
+            if self.connection is None:
+                self.connection = self.connect()
+            with self.connection:
+                for table, rows in pending_rows.items():
+                    if rows:
+                        self.connection.executemany(INSERT_STATEMENTS[table], rows)
+                self.connection.executemany(UPSERT_DEVICE, changed_devices)
+            for device_key, *device in changed_devices:
+                self.written_devices[device_key] = tuple(device)
+            self.logger.debug(f"Inserted {sum(len(rows) for rows in pending_rows.values())} rows into SQLite")
+        except Exception as e:
+            self.logger.exception(f"SQLite write error, {sum(len(rows) for rows in pending_rows.values())} rows dropped: '{e}'")
+            return
+
+        if self.conf.sqlite_retention_days > 0 and time.monotonic() - self.last_prune_time >= PRUNE_INTERVAL_SECONDS:
+            self.prune_locked()
+
+    def prune_locked(self) -> None:
+        self.last_prune_time = time.monotonic()
+        oldest_time = int(time.time() - self.conf.sqlite_retention_days * 86400)
+        try:
+            with self.connection:
+                deleted_rows = sum(self.connection.execute(f"DELETE FROM {table} WHERE time < ?", (oldest_time,)).rowcount for table in INSERT_STATEMENTS)
+            if deleted_rows:
+                self.logger.info(f"Pruned {deleted_rows} SQLite rows older than {self.conf.sqlite_retention_days} days")
+        except Exception as e:
+            self.logger.exception(f"SQLite retention pruning error: '{e}'")
+
+    def close(self) -> None:
+        """
+        Insert the pending rows and close the database, used on shutdown.
+        """
+        with self.lock:
+            self.flush_locked()
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def reload_config(self, changed_fields):
+        """
+        Reopen the database on the next write if the file changed, called on config reload.
+        """
+        if "sqlite_file" in changed_fields:
+            self.close()
+            self.written_devices = {}